@@ -2,7 +2,7 @@
 import os
 from dataclasses import dataclass
 from pathlib import Path
-from typing import List
+from typing import Dict, List
 
 import yaml
 from dotenv import load_dotenv
@@ -27,11 +27,176 @@ class PricingTier:
     subtext: str
 
 
+@dataclass
+class OpenRouterHttpConfig:
+    """Настройки пула HTTP-соединений к OpenRouter"""
+    max_connections: int
+    max_keepalive_connections: int
+    keepalive_expiry: float
+    http2: bool
+    # Таймаут записи тела и ожидания соединения из пула
+    timeout: float
+    # Таймаут установки соединения
+    connect_timeout: float
+    # Таймаут ожидания очередной порции ответа
+    read_timeout: float
+
+
+@dataclass
+class OpenRouterInputImageConfig:
+    """Подготовка исходного фото перед отправкой в OpenRouter"""
+    # Минимальное разрешение исходника для вертикального кадра 2:3
+    min_width: int
+    min_height: int
+    # Пережимать ли фото локально, если оно больше лимитов
+    resize: bool
+    max_side: int
+    max_bytes: int
+    jpeg_quality: int
+
+
+@dataclass
+class OpenRouterOutputImageConfig:
+    """Перекодирование сгенерированного изображения перед отправкой в Telegram"""
+    enabled: bool
+    # jpeg (прогрессивный) или webp
+    format: str
+    quality: int
+    # Максимальная длинная сторона в пикселях
+    max_side: int
+    # Бюджет на размер файла в байтах: качество понижается до попадания
+    max_bytes: int
+
+
+@dataclass
+class OpenRouterExecutorConfig:
+    """Пул для CPU-ёмкой работы с base64 и JSON"""
+    # none - в цикле событий, thread - пул потоков, process - пул процессов
+    kind: str
+    max_workers: int
+
+
+@dataclass
+class OpenRouterSSEConfig:
+    """Ответ событиями SSE (stream: true в запросе)"""
+    enabled: bool
+    # Прервать ответ, если до изображения модель написала больше стольких символов (0 - нет)
+    text_abort_chars: int
+
+
+@dataclass
+class OpenRouterHedgingConfig:
+    """Хеджирование медленных запросов резервной моделью"""
+    enabled: bool
+    # Перцентиль времени ответа модели, после которого запрос дублируется
+    quantile: float
+    # Сколько успешных ответов нужно, чтобы доверять перцентилю
+    min_samples: int
+    # Задержка дублирования, пока наблюдений недостаточно
+    initial_delay: float
+    # Нижняя граница задержки дублирования
+    min_delay: float
+
+
+@dataclass
+class OpenRouterRetryConfig:
+    """Повторы запросов генерации"""
+    max_attempts: int
+    # Общее время на генерацию со всеми повторами, секунды
+    deadline: float
+    # Экспоненциальная задержка между попытками: base * 2^(n-1), не больше max
+    backoff_base: float
+    backoff_max: float
+    # Бюджет повторов на процесс: доля от первичных запросов + минимум в секунду
+    budget_ratio: float
+    budget_min_per_second: float
+    # Окно учёта бюджета, секунды (несколько длительностей генерации)
+    budget_window_seconds: float
+
+
+@dataclass
+class OpenRouterCircuitBreakerConfig:
+    """Автомат защиты от деградации OpenRouter"""
+    enabled: bool
+    # Скользящее окно учёта запросов, секунды
+    window_seconds: float
+    # Минимум запросов в окне для принятия решения
+    min_requests: int
+    # Доля ошибок, при которой цепь размыкается
+    error_rate: float
+    # Запрос медленнее slow_call_seconds считается медленным
+    slow_call_seconds: float
+    # Доля медленных запросов, при которой цепь размыкается
+    slow_call_rate: float
+    # Сколько секунд цепь разомкнута до пробных запросов
+    open_seconds: float
+    # Сколько пробных запросов должно пройти успешно, чтобы замкнуть цепь
+    half_open_probes: int
+    # Записывать размыкание в БД, чтобы его видел бот при воркерах в
+    # отдельном процессе
+    share_state: bool
+    # Как часто бот перечитывает общее состояние, секунды
+    shared_refresh_seconds: float
+
+
 @dataclass
 class OpenRouterConfig:
     """Настройки OpenRouter"""
+    # Бэкенд генерации: openrouter или mock (локальная заглушка)
+    backend: str
+    # Адрес chat completions (можно направить на локальный mock-сервер)
+    api_url: str
     model: str
+    # Резервные модели, по очереди после основной
+    fallback_models: List[str]
+    hedging: OpenRouterHedgingConfig
+    retry: OpenRouterRetryConfig
+    circuit_breaker: OpenRouterCircuitBreakerConfig
     generation_prompt: str
+    http: OpenRouterHttpConfig
+    input_image: OpenRouterInputImageConfig
+    output_image: OpenRouterOutputImageConfig
+    # Декодировать изображение потоково, не загружая ответ целиком
+    stream_response: bool
+    sse: OpenRouterSSEConfig
+    executor: OpenRouterExecutorConfig
+
+
+@dataclass
+class MockLatencyConfig:
+    """Распределение задержки ответа заглушки провайдера"""
+    # fixed, uniform или lognormal
+    distribution: str
+    # Медиана (для fixed - сама задержка), секунды
+    median: float
+    # Разброс логнормального распределения (sigma логарифма)
+    sigma: float
+    # Границы задержки (для uniform - диапазон), секунды
+    min: float
+    max: float
+
+
+@dataclass
+class MockProviderConfig:
+    """Локальная заглушка провайдера генерации для нагрузочных тестов"""
+    # Адрес mock-сервера (python -m bot.mock_server)
+    host: str
+    port: int
+    latency: MockLatencyConfig
+    # Доля ответов с ошибкой и их статусы
+    error_rate: float
+    error_statuses: List[int]
+    # Retry-After для ответов 429 и 503, секунды
+    retry_after: float
+    # Доля запросов, на которые заглушка не отвечает timeout_seconds
+    timeout_rate: float
+    timeout_seconds: float
+    # Доля ответов без изображения (отказ модели)
+    empty_rate: float
+    # Размеры изображений в ответах [ширина, высота], выбираются случайно
+    image_sizes: List[List[int]]
+    # Шум вместо заливки: PNG не сжимается, размер ответа как у настоящей модели
+    noise: bool
 
 
 @dataclass
@@ -42,6 +207,25 @@ class BotConfig:
     support_url: str
 
 
+@dataclass
+class TelegramFilesConfig:
+    """Скачивание файлов из Telegram и собственный сервер Bot API"""
+    # Адрес собственного сервера Bot API; пусто - api.telegram.org
+    api_server: str
+    # Сервер запущен с --local: файлы читаются с диска, а не по HTTP
+    local_mode: bool
+    # Каталог файлов на сервере Bot API и он же, смонтированный у бота
+    # (пусто - пути совпадают)
+    server_files_dir: str
+    local_files_dir: str
+    # Сколько хранить file_path по file_id, секунды (Telegram гарантирует час)
+    path_ttl: float
+    path_cache_size: int
+    # Размер порции и таймаут скачивания по HTTP
+    chunk_size: int
+    timeout: int
+
+
 @dataclass
 class DocumentsConfig:
     """Ссылки на документы"""
@@ -73,6 +257,124 @@ class RobokassaConfig:
     test_mode: bool
 
 
+@dataclass
+class ResultCacheConfig:
+    """Настройки кеша результатов генерации"""
+    enabled: bool
+    directory: str
+    max_size_mb: int
+
+
+@dataclass
+class DeliveryConfig:
+    """Доставка результатов генерации с повторами"""
+    # Каталог для результатов, ожидающих доставки
+    directory: str
+    # Каталог общий для всех хостов с воркерами (сетевой диск)
+    shared_directory: bool
+    # Сколько раз пытаться отправить результат, прежде чем вернуть генерацию
+    max_attempts: int
+    # Экспоненциальная задержка между попытками, секунды
+    backoff_base: float
+    backoff_max: float
+    # Срок, на который попытка доставки закрепляется за воркером, секунды
+    lease_seconds: int
+    # Как часто искать результаты, ожидающие повторной доставки, секунды
+    poll_interval: float
+
+
+@dataclass
+class SingleFlightConfig:
+    """Настройки объединения одинаковых одновременных запросов"""
+    enabled: bool
+    # once - дубликат не оплачивается, twice - каждый запрос списывает генерацию
+    duplicate_charge: str
+
+
+@dataclass
+class WorkerConfig:
+    """Настройки пула воркеров генерации"""
+    enabled: bool
+    concurrency: int
+    poll_interval: float
+    lease_seconds: int
+    max_attempts: int
+
+
+@dataclass
+class PriorityLanesConfig:
+    """Классы приоритета задач генерации: paid, promo, free"""
+    enabled: bool
+    # Доли воркеров при очереди во всех классах
+    weights: Dict[str, float]
+    # Максимум задач класса в очереди (0 - без ограничения)
+    max_queued: Dict[str, int]
+
+
+@dataclass
+class QueueFeedbackConfig:
+    """Позиция в очереди и оценка ожидания в сообщении о начале обработки"""
+    enabled: bool
+    # Как часто пересчитывать позиции и править сообщения, секунды
+    update_interval: float
+    # Максимум правок сообщений за один проход
+    max_edits_per_update: int
+    # Как часто обновлять перцентили длительности из БД, секунды
+    stats_refresh: float
+    # Длительность обработки, пока выполненных задач ещё нет, секунды
+    default_seconds: float
+
+
+@dataclass
+class ThrottlingConfig:
+    """Ограничение обработки фото одного пользователя"""
+    enabled: bool
+    # Максимум незавершённых генераций пользователя
+    max_in_flight: int
+    # Корзина токенов: средняя частота фото в минуту и размер всплеска
+    rate_per_minute: float
+    burst: int
+    # Сколько фото может ждать токен, прежде чем будет отклонено, секунды
+    max_wait_seconds: float
+
+
+@dataclass
+class UserCacheConfig:
+    """Кеш снимков пользователей в памяти процесса"""
+    enabled: bool
+    # Срок жизни записи, секунды
+    ttl: float
+    # Максимум записей, старые вытесняются (LRU)
+    max_size: int
+    # Межпроцессная инвалидация через LISTEN/NOTIFY Postgres
+    notify: bool
+    channel: str
+
+
+@dataclass
+class LedgerConfig:
+    """Перенос журнала генераций в счётчики users и сверка"""
+    enabled: bool
+    # Как часто переносить новые записи, секунды
+    project_interval: float
+    # Пользователей за один запрос переноса
+    batch_size: int
+    # Как часто сверять счётчики с журналом, секунды (0 - не сверять)
+    reconcile_interval: float
+
+
+@dataclass
+class MetricsConfig:
+    """Настройки экспорта метрик"""
+    enabled: bool
+    host: str
+    port: int
+    # Порт метрик отдельного процесса воркеров (python -m bot.worker)
+    worker_port: int
+    # Период замера задержки цикла событий, секунды
+    loop_lag_interval: float
+
+
 @dataclass
 class OtherProcessingButton:
     """Кнопка в разделе 'Другие обработки'"""
@@ -92,11 +394,23 @@ class Config:
     generations: GenerationConfig
     pricing: List[PricingTier]
     openrouter: OpenRouterConfig
+    mock_provider: MockProviderConfig
     bot: BotConfig
+    telegram_files: TelegramFilesConfig
     documents: DocumentsConfig
     logging: LoggingConfig
     payment: PaymentConfig
     robokassa: RobokassaConfig
+    workers: WorkerConfig
+    result_cache: ResultCacheConfig
+    delivery: DeliveryConfig
+    single_flight: SingleFlightConfig
+    priority_lanes: PriorityLanesConfig
+    queue_feedback: QueueFeedbackConfig
+    throttling: ThrottlingConfig
+    user_cache: UserCacheConfig
+    ledger: LedgerConfig
+    metrics: MetricsConfig
     other_processing_buttons: List[OtherProcessingButton]
 
 
@@ -140,10 +454,125 @@ def load_config() -> Config:
         for tier in yaml_config["pricing"]
     ]
 
+    openrouter_http = yaml_config["openrouter"].get("http", {})
+    openrouter_input = yaml_config["openrouter"].get("input_image", {})
+    openrouter_output = yaml_config["openrouter"].get("output_image", {})
+    openrouter_executor = yaml_config["openrouter"].get("executor", {})
+    openrouter_sse = yaml_config["openrouter"].get("sse", {})
+    openrouter_hedging = yaml_config["openrouter"].get("hedging", {})
+    openrouter_retry = yaml_config["openrouter"].get("retry", {})
+    openrouter_breaker = yaml_config["openrouter"].get("circuit_breaker", {})
     openrouter = OpenRouterConfig(
+        backend=yaml_config["openrouter"].get("backend", "openrouter"),
+        api_url=yaml_config["openrouter"].get(
+            "api_url", "https://openrouter.ai/api/v1/chat/completions"
+        ),
         model=yaml_config["openrouter"]["model"],
-        generation_prompt=yaml_config["openrouter"]["generation_prompt"]
+        fallback_models=yaml_config["openrouter"].get("fallback_models") or [],
+        hedging=OpenRouterHedgingConfig(
+            enabled=openrouter_hedging.get("enabled", True),
+            quantile=openrouter_hedging.get("quantile", 0.9),
+            min_samples=openrouter_hedging.get("min_samples", 20),
+            initial_delay=openrouter_hedging.get("initial_delay", 90.0),
+            min_delay=openrouter_hedging.get("min_delay", 10.0),
+        ),
+        retry=OpenRouterRetryConfig(
+            max_attempts=openrouter_retry.get("max_attempts", 3),
+            deadline=openrouter_retry.get("deadline", 180.0),
+            backoff_base=openrouter_retry.get("backoff_base", 1.0),
+            backoff_max=openrouter_retry.get("backoff_max", 15.0),
+            budget_ratio=openrouter_retry.get("budget_ratio", 0.2),
+            budget_min_per_second=openrouter_retry.get("budget_min_per_second", 0.1),
+            budget_window_seconds=openrouter_retry.get("budget_window_seconds", 120.0),
+        ),
+        circuit_breaker=OpenRouterCircuitBreakerConfig(
+            enabled=openrouter_breaker.get("enabled", True),
+            window_seconds=openrouter_breaker.get("window_seconds", 60.0),
+            min_requests=openrouter_breaker.get("min_requests", 10),
+            error_rate=openrouter_breaker.get("error_rate", 0.5),
+            slow_call_seconds=openrouter_breaker.get("slow_call_seconds", 120.0),
+            slow_call_rate=openrouter_breaker.get("slow_call_rate", 0.8),
+            open_seconds=openrouter_breaker.get("open_seconds", 30.0),
+            half_open_probes=openrouter_breaker.get("half_open_probes", 2),
+            share_state=openrouter_breaker.get("share_state", True),
+            shared_refresh_seconds=openrouter_breaker.get("shared_refresh_seconds", 2.0),
+        ),
+        generation_prompt=yaml_config["openrouter"]["generation_prompt"],
+        http=OpenRouterHttpConfig(
+            max_connections=openrouter_http.get("max_connections", 50),
+            max_keepalive_connections=openrouter_http.get("max_keepalive_connections", 20),
+            keepalive_expiry=openrouter_http.get("keepalive_expiry", 60.0),
+            http2=openrouter_http.get("http2", True),
+            timeout=openrouter_http.get("timeout", 60.0),
+            connect_timeout=openrouter_http.get("connect_timeout", 10.0),
+            read_timeout=openrouter_http.get("read_timeout", 120.0),
+        ),
+        input_image=OpenRouterInputImageConfig(
+            min_width=openrouter_input.get("min_width", 683),
+            min_height=openrouter_input.get("min_height", 1024),
+            resize=openrouter_input.get("resize", True),
+            max_side=openrouter_input.get("max_side", 1536),
+            max_bytes=openrouter_input.get("max_bytes", 1048576),
+            jpeg_quality=openrouter_input.get("jpeg_quality", 90),
+        ),
+        output_image=OpenRouterOutputImageConfig(
+            enabled=openrouter_output.get("enabled", True),
+            format=openrouter_output.get("format", "jpeg"),
+            quality=openrouter_output.get("quality", 87),
+            max_side=openrouter_output.get("max_side", 2048),
+            max_bytes=openrouter_output.get("max_bytes", 2097152),
+        ),
+        stream_response=yaml_config["openrouter"].get("stream_response", True),
+        sse=OpenRouterSSEConfig(
+            enabled=openrouter_sse.get("enabled", False),
+            text_abort_chars=openrouter_sse.get("text_abort_chars", 0),
+        ),
+        executor=OpenRouterExecutorConfig(
+            kind=openrouter_executor.get("kind", "thread"),
+            max_workers=openrouter_executor.get("max_workers", 4),
+        )
+    )
+    if openrouter.backend not in ("openrouter", "mock"):
+        raise ValueError(
+            f"openrouter.backend должен быть openrouter или mock: {openrouter.backend}"
+        )
+    if openrouter.output_image.format not in ("jpeg", "webp"):
+        raise ValueError(
+            f"openrouter.output_image.format должен быть jpeg или webp: "
+            f"{openrouter.output_image.format}"
+        )
+    if openrouter.executor.kind not in ("none", "thread", "process"):
+        raise ValueError(
+            f"openrouter.executor.kind должен быть none, thread или process: "
+            f"{openrouter.executor.kind}"
+        )
+
+    mock_provider_config = yaml_config.get("mock_provider", {})
+    mock_latency = mock_provider_config.get("latency", {})
+    mock_provider = MockProviderConfig(
+        host=mock_provider_config.get("host", "127.0.0.1"),
+        port=mock_provider_config.get("port", 8090),
+        latency=MockLatencyConfig(
+            distribution=mock_latency.get("distribution", "lognormal"),
+            median=mock_latency.get("median", 20.0),
+            sigma=mock_latency.get("sigma", 0.5),
+            min=mock_latency.get("min", 1.0),
+            max=mock_latency.get("max", 120.0),
+        ),
+        error_rate=mock_provider_config.get("error_rate", 0.05),
+        error_statuses=mock_provider_config.get("error_statuses") or [429, 500, 502, 503],
+        retry_after=mock_provider_config.get("retry_after", 5.0),
+        timeout_rate=mock_provider_config.get("timeout_rate", 0.01),
+        timeout_seconds=mock_provider_config.get("timeout_seconds", 300.0),
+        empty_rate=mock_provider_config.get("empty_rate", 0.02),
+        image_sizes=mock_provider_config.get("image_sizes") or [[832, 1248]],
+        noise=mock_provider_config.get("noise", True),
     )
+    if mock_provider.latency.distribution not in ("fixed", "uniform", "lognormal"):
+        raise ValueError(
+            f"mock_provider.latency.distribution должен быть fixed, uniform или lognormal: "
+            f"{mock_provider.latency.distribution}"
+        )
 
     bot = BotConfig(
         image_caption=yaml_config["bot"]["image_caption"],
@@ -151,6 +580,20 @@ def load_config() -> Config:
         support_url=yaml_config["bot"]["support_url"]
     )
 
+    telegram_files_config = yaml_config.get("telegram_files", {})
+    telegram_files = TelegramFilesConfig(
+        api_server=telegram_files_config.get("api_server") or "",
+        local_mode=telegram_files_config.get("local_mode", False),
+        server_files_dir=telegram_files_config.get("server_files_dir") or "",
+        local_files_dir=telegram_files_config.get("local_files_dir") or "",
+        path_ttl=telegram_files_config.get("path_ttl", 3000.0),
+        path_cache_size=telegram_files_config.get("path_cache_size", 10000),
+        chunk_size=telegram_files_config.get("chunk_size", 65536),
+        timeout=telegram_files_config.get("timeout", 30)
+    )
+    if telegram_files.local_mode and not telegram_files.api_server:
+        raise ValueError("telegram_files.local_mode требует собственный сервер: telegram_files.api_server")
+
     documents = DocumentsConfig(
         privacy_policy=yaml_config["documents"]["privacy_policy"],
         terms_of_service=yaml_config["documents"]["terms_of_service"]
@@ -180,6 +623,103 @@ def load_config() -> Config:
         test_mode=robokassa_test_mode
     )
 
+    workers_config = yaml_config.get("workers", {})
+    workers = WorkerConfig(
+        enabled=workers_config.get("enabled", True),
+        concurrency=workers_config.get("concurrency", 8),
+        poll_interval=workers_config.get("poll_interval", 1.0),
+        lease_seconds=workers_config.get("lease_seconds", 900),
+        max_attempts=workers_config.get("max_attempts", 2)
+    )
+
+    result_cache_config = yaml_config.get("result_cache", {})
+    result_cache = ResultCacheConfig(
+        enabled=result_cache_config.get("enabled", True),
+        directory=result_cache_config.get("directory", "cache/results"),
+        max_size_mb=result_cache_config.get("max_size_mb", 1024)
+    )
+
+    delivery_config = yaml_config.get("delivery", {})
+    delivery = DeliveryConfig(
+        directory=delivery_config.get("directory", "cache/deliveries"),
+        shared_directory=delivery_config.get("shared_directory", False),
+        max_attempts=delivery_config.get("max_attempts", 8),
+        backoff_base=delivery_config.get("backoff_base", 5.0),
+        backoff_max=delivery_config.get("backoff_max", 600.0),
+        lease_seconds=delivery_config.get("lease_seconds", 120),
+        poll_interval=delivery_config.get("poll_interval", 5.0)
+    )
+
+    single_flight_config = yaml_config.get("single_flight", {})
+    single_flight = SingleFlightConfig(
+        enabled=single_flight_config.get("enabled", True),
+        duplicate_charge=single_flight_config.get("duplicate_charge", "once")
+    )
+    if single_flight.duplicate_charge not in ("once", "twice"):
+        raise ValueError(
+            f"single_flight.duplicate_charge должен быть once или twice: "
+            f"{single_flight.duplicate_charge}"
+        )
+
+    priority_lanes_config = yaml_config.get("priority_lanes", {})
+    priority_lanes = PriorityLanesConfig(
+        enabled=priority_lanes_config.get("enabled", True),
+        weights={
+            "paid": 6, "promo": 3, "free": 1,
+            **priority_lanes_config.get("weights", {})
+        },
+        max_queued={
+            "paid": 0, "promo": 500, "free": 200,
+            **priority_lanes_config.get("max_queued", {})
+        }
+    )
+
+    queue_feedback_config = yaml_config.get("queue_feedback", {})
+    queue_feedback = QueueFeedbackConfig(
+        enabled=queue_feedback_config.get("enabled", True),
+        update_interval=queue_feedback_config.get("update_interval", 10.0),
+        max_edits_per_update=queue_feedback_config.get("max_edits_per_update", 20),
+        stats_refresh=queue_feedback_config.get("stats_refresh", 30.0),
+        default_seconds=queue_feedback_config.get("default_seconds", 25.0)
+    )
+
+    throttling_config = yaml_config.get("throttling", {})
+    throttling = ThrottlingConfig(
+        enabled=throttling_config.get("enabled", True),
+        max_in_flight=throttling_config.get("max_in_flight", 2),
+        rate_per_minute=throttling_config.get("rate_per_minute", 6),
+        burst=throttling_config.get("burst", 3),
+        max_wait_seconds=throttling_config.get("max_wait_seconds", 5)
+    )
+
+    user_cache_config = yaml_config.get("user_cache", {})
+    user_cache = UserCacheConfig(
+        enabled=user_cache_config.get("enabled", True),
+        ttl=user_cache_config.get("ttl", 30.0),
+        max_size=user_cache_config.get("max_size", 10000),
+        notify=user_cache_config.get("notify", True),
+        channel=user_cache_config.get("channel", "user_cache")
+    )
+    if not user_cache.channel.isidentifier():
+        raise ValueError(f"user_cache.channel должен быть идентификатором: {user_cache.channel}")
+
+    ledger_config = yaml_config.get("ledger", {})
+    ledger = LedgerConfig(
+        enabled=ledger_config.get("enabled", True),
+        project_interval=ledger_config.get("project_interval", 2.0),
+        batch_size=ledger_config.get("batch_size", 500),
+        reconcile_interval=ledger_config.get("reconcile_interval", 3600.0)
+    )
+
+    metrics_config = yaml_config.get("metrics", {})
+    metrics = MetricsConfig(
+        enabled=metrics_config.get("enabled", False),
+        host=metrics_config.get("host", "0.0.0.0"),
+        port=metrics_config.get("port", 9100),
+        worker_port=metrics_config.get("worker_port", 9101),
+        loop_lag_interval=metrics_config.get("loop_lag_interval", 0.5)
+    )
+
     # Парсинг кнопок "Другие обработки"
     other_processing_buttons = [
         OtherProcessingButton(
@@ -196,11 +736,23 @@ def load_config() -> Config:
         generations=generations,
         pricing=pricing,
         openrouter=openrouter,
+        mock_provider=mock_provider,
         bot=bot,
+        telegram_files=telegram_files,
         documents=documents,
         logging=logging,
         payment=payment,
         robokassa=robokassa,
+        workers=workers,
+        result_cache=result_cache,
+        delivery=delivery,
+        single_flight=single_flight,
+        priority_lanes=priority_lanes,
+        queue_feedback=queue_feedback,
+        throttling=throttling,
+        user_cache=user_cache,
+        ledger=ledger,
+        metrics=metrics,
         other_processing_buttons=other_processing_buttons
     )
 
@@ -1,7 +1,9 @@
 """Модуль для работы с базой данных"""
-from contextlib import asynccontextmanager
-from typing import AsyncGenerator
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import AsyncGenerator, Iterator, List, Optional
 
+from sqlalchemy import event
 from sqlalchemy.ext.asyncio import (
     AsyncEngine,
     AsyncSession,
@@ -11,6 +13,14 @@ from sqlalchemy.ext.asyncio import (
 
 from bot.config import config
 from bot.logger import logger
+from bot.services.metrics import metrics
+
+db_roundtrips_total = metrics.counter(
+    "db_roundtrips_total", "Обращения к БД: begin, query, commit, rollback"
+)
+
+# Счётчик обращений к БД текущего апдейта или задачи (см. count_roundtrips)
+_roundtrips: ContextVar[Optional[List[int]]] = ContextVar("db_roundtrips", default=None)
 
 
 class Database:
@@ -39,8 +49,33 @@ class Database:
             autocommit=False,
         )
 
+        # Одиночные чтения без BEGIN/COMMIT: тот же пул, режим autocommit
+        self.autocommit_engine: AsyncEngine = self.engine.execution_options(
+            isolation_level="AUTOCOMMIT"
+        )
+
+        # Каждое из этих событий - отдельный запрос к серверу БД (у asyncpg
+        # BEGIN тоже отправляется отдельно перед первым запросом транзакции)
+        sync_engine = self.engine.sync_engine
+        for kind in ("begin", "commit", "rollback"):
+            event.listen(sync_engine, kind, self._roundtrip_listener(kind))
+        event.listen(sync_engine, "before_cursor_execute", self._roundtrip_listener("query"))
+
         logger.info("База данных инициализирована")
 
+    @staticmethod
+    def _roundtrip_listener(kind: str):
+        def listener(conn, *args):
+            # В autocommit BEGIN и COMMIT на сервер не отправляются
+            if kind != "query" and conn.get_execution_options().get("isolation_level") == "AUTOCOMMIT":
+                return
+            db_roundtrips_total.inc(kind=kind)
+            counter = _roundtrips.get()
+            if counter is not None:
+                counter[0] += 1
+
+        return listener
+
     @asynccontextmanager
     async def get_session(self) -> AsyncGenerator[AsyncSession, None]:
         """
@@ -60,6 +95,20 @@ class Database:
             finally:
                 await session.close()
 
+    @asynccontextmanager
+    async def get_autocommit_session(self) -> AsyncGenerator[AsyncSession, None]:
+        """
+        Сессия для одиночных чтений вне транзакции
+
+        Каждый запрос - одно обращение к БД, без BEGIN и COMMIT. Не для
+        записей и не для нескольких чтений, которым нужна согласованность
+
+        Yields:
+            AsyncSession: Сессия в режиме autocommit
+        """
+        async with self.session_factory(bind=self.autocommit_engine) as session:
+            yield session
+
     async def close(self):
         """Закрытие соединения с БД"""
         await self.engine.dispose()
@@ -70,6 +119,22 @@ class Database:
 database = Database(config.database_url)
 
 
+@contextmanager
+def count_roundtrips() -> Iterator[List[int]]:
+    """
+    Считать обращения к БД внутри блока (включая дочерние задачи asyncio)
+
+    Yields:
+        Список из одного элемента - число обращений
+    """
+    counter = [0]
+    token = _roundtrips.set(counter)
+    try:
+        yield counter
+    finally:
+        _roundtrips.reset(token)
+
+
 def get_db_session():
     """
     Helper функция для получения сессии БД в handlers
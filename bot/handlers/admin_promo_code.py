@@ -1,11 +1,13 @@
 """Обработчик генерации промокодов для администраторов"""
+from typing import Optional
+
 from aiogram import Router, F
 from aiogram.types import Message
 from aiogram.fsm.context import FSMContext
 
 from bot.database import get_db_session
 from bot.repositories.promo_code_repository import PromoCodeRepository
-from bot.repositories.user_repository import UserRepository
+from bot.repositories.user_repository import UserSnapshot
 from bot.states import AdminPromoCodeStates
 from bot.logger import logger
 
@@ -13,22 +15,20 @@ router = Router()
 
 
 @router.message(F.text == "🔧 Сгенерировать промокод")
-async def start_promo_code_generation(message: Message, state: FSMContext):
+async def start_promo_code_generation(
+    message: Message, state: FSMContext, user: Optional[UserSnapshot]
+):
     """Начало процесса генерации промокода (только для админов)"""
     telegram_id = message.from_user.id
 
     # Проверяем, является ли пользователь администратором
-    async with get_db_session() as session:
-        user_repo = UserRepository(session)
-        user = await user_repo.get_user_by_telegram_id(telegram_id)
-
-        if not user or not user.is_admin:
-            await message.answer(
-                "⛔️ <b>Доступ запрещён</b>\n\n"
-                "Эта функция доступна только администраторам."
-            )
-            logger.warning(f"Попытка доступа к админ-функции от {telegram_id}")
-            return
+    if not user or not user.is_admin:
+        await message.answer(
+            "⛔️ <b>Доступ запрещён</b>\n\n"
+            "Эта функция доступна только администраторам."
+        )
+        logger.warning(f"Попытка доступа к админ-функции от {telegram_id}")
+        return
 
     await message.answer(
         "🔧 <b>Генерация промокода</b>\n\n"
@@ -1,154 +1,172 @@
 """Обработчик изображений от пользователей"""
-from aiogram import Router, F, Bot
+from aiogram import Router, F
 from aiogram.types import Message
 
 from bot.config import config
-from bot.database import get_db_session
-from bot.repositories.user_repository import UserRepository
+from bot.database import database, get_db_session
+from bot.middlewares import UserContext
+from bot.repositories.user_repository import SpendContendedError, UserRepository
+from bot.repositories.generation_job_repository import GenerationJobRepository
+from bot.services import stage_timer
+from bot.services.generation import generation_service
+from bot.services.metrics import metrics
+from bot.services.queue_feedback import queue_feedback_service
 from bot.services.openrouter import openrouter_service
-from bot.keyboards import get_share_keyboard, get_main_menu_keyboard
 from bot.logger import logger
+from bot.middlewares import photo_throttle_middleware
+
+lane_rejected_total = metrics.counter(
+    "generation_lane_rejected_total", "Фото, отклонённые из-за переполнения очереди класса"
+)
 
 router = Router()
+# Ограничение частоты и числа фото в обработке на пользователя
+router.message.middleware(photo_throttle_middleware)
 
 
 @router.message(F.photo)
-async def process_photo(message: Message, bot: Bot):
-    """Обработка изображения от пользователя"""
+async def process_photo(message: Message, user_context: UserContext):
+    """
+    Обработка изображения от пользователя
+
+    Обработчик только списывает генерацию и ставит задачу в очередь
+    generation_jobs в одной короткой транзакции, после чего подтверждает
+    приём фото. Переполнение очереди проверяется до списания, позиция в
+    очереди считается после фиксации.
+    Генерацию и доставку результата выполняют воркеры (bot/worker.py)
+    """
     telegram_id = message.from_user.id
-    photo = message.photo[-1]  # Берем фото наибольшего размера
+    # Наименьший размер фото, достаточный для генерации (меньше трафика)
+    photo = openrouter_service.select_photo(message.photo)
 
     logger.info(f"Получено изображение от пользователя: {telegram_id}")
 
-    async with get_db_session() as session:
-        user_repo = UserRepository(session)
-
-        # Атомарно проверяем баланс и списываем генерацию
-        # Это предотвращает race condition при отправке нескольких фото одновременно
-        spent, new_balance = await user_repo.try_spend_generation(telegram_id)
-
-        if not spent:
-            # Не удалось списать - либо нет пользователя, либо недостаточно генераций
-            if new_balance is None:
-                # Пользователь не найден
-                await message.answer(
-                    "⚠️ <b>Упс! Что-то пошло не так</b>\n\n"
-                    "Похоже, ты ещё не зарегистрирован в боте.\n\n"
-                    "🎄 Нажми /start чтобы начать пользоваться ботом и получить бесплатные генерации!"
-                )
-                logger.error(f"Пользователь не найден: {telegram_id}")
-            else:
-                # Недостаточно генераций (new_balance содержит текущий баланс: 0 или больше)
-                await message.answer(
-                    "😔 <b>Генерации закончились!</b>\n\n"
-                    f"💎 На твоём балансе: <b>{new_balance} генераций</b>\n\n"
-                    "Но не расстраивайся! Ты можешь:\n\n"
-                    "💳 <b>Купить генерации</b>\n"
-                    "Нажми на кнопку в меню и выбери подходящий тариф\n\n"
-                    "🤝 <b>Пригласить друзей</b>\n"
-                    "Получи бонусные генерации за каждого приглашённого друга!\n\n"
-                    "✨ Используй меню ниже, чтобы пополнить баланс 👇"
-                )
-                logger.info(f"Недостаточно генераций у пользователя: {telegram_id}")
-            return
-
-        # Отправляем сообщение о начале обработки
-        processing_message = await message.answer(
-            "✨ <b>Начинаем волшебство!</b>\n\n"
-            "🎨 Превращаем твоё фото в винтажную фотографию в стиле 90х...\n"
-            "🎬 Это может занять 10-30 секунд\n\n"
-            "⏳ Пожалуйста, подожди немного..."
+    # Незарегистрированному пользователю не открываем транзакцию списания
+    if user_context.user is None:
+        await message.answer(
+            "⚠️ <b>Упс! Что-то пошло не так</b>\n\n"
+            "Похоже, ты ещё не зарегистрирован в боте.\n\n"
+            "🎄 Нажми /start чтобы начать пользоваться ботом и получить бесплатные генерации!"
         )
+        logger.error(f"Пользователь не найден: {telegram_id}")
+        return
+
+    # OpenRouter сейчас не справляется (по воркерам этого или другого процесса) -
+    # не списываем генерацию и не ставим задачу
+    if await openrouter_service.circuit_breaker.is_open_shared():
+        await message.answer(
+            "⏳ <b>Сервис генерации временно перегружен</b>\n\n"
+            "Мы уже знаем о проблеме. Генерация не списана - "
+            "попробуй отправить фото ещё раз через пару минут 🙏"
+        )
+        logger.warning(f"Фото от {telegram_id} отклонено: автомат защиты OpenRouter разомкнут")
+        return
+
+    # Переполнение очереди класса проверяем до списания и вне его транзакции
+    # (класс - по снимку пользователя, как его выберет списание)
+    lane = user_context.user.spend_lane
+    max_queued = config.priority_lanes.max_queued.get(lane, 0)
+    if (
+        config.priority_lanes.enabled
+        and max_queued
+        and user_context.user.available_generation > 0
+    ):
+        async with database.get_autocommit_session() as session:
+            queued = await GenerationJobRepository(session).count_queued(lane)
+        if queued >= max_queued:
+            lane_rejected_total.inc(lane=lane)
+            await message.answer(
+                "⏳ <b>Сейчас очень много желающих</b>\n\n"
+                "Очередь генераций переполнена. Генерация не списана - "
+                "попробуй отправить фото ещё раз через несколько минут 🙏"
+            )
+            logger.warning(f"Фото от {telegram_id} отклонено: очередь {lane} переполнена")
+            return
 
-        logger.info(f"Начата обработка изображения для {telegram_id}")
-
-        try:
-            # Обрабатываем изображение через OpenRouter
-            generated_image = await openrouter_service.process_user_image(bot, photo)
-
-            # Удаляем сообщение о обработке
-            await processing_message.delete()
-
-            if generated_image:
-                # Отправляем сгенерированное изображение с кнопкой "Поделиться"
-                # share_keyboard = get_share_keyboard(config.bot.bot_username)
-
-                await message.answer_photo(
-                    photo=generated_image,
-                    caption=config.bot.image_caption,
-                    # reply_markup=share_keyboard
-                )
-
-                logger.info(f"Изображение успешно отправлено пользователю: {telegram_id}")
-
-                # Получаем информацию о пользователе для обновления меню
-                user = await user_repo.get_user_by_telegram_id(telegram_id)
-
-                # Показываем обновленный баланс (new_balance уже получен из try_spend_generation)
-                balance_emoji = "🎉" if new_balance > 0 else "😊"
-
-                balance_info = (
-                    f"{balance_emoji} <b>Ретро фотография готова!</b>\n\n"
-                    f"💎 Осталось генераций: <b>{new_balance}</b>\n\n"
+    # Атомарно списываем генерацию и ставим задачу в очередь в одной короткой
+    # транзакции: строка пользователя заблокирована только до её фиксации
+    timings = {}
+    try:
+        async with get_db_session() as session:
+            user_repo = UserRepository(session)
+            with stage_timer.stage("spend", timings):
+                spent, new_balance, lane = await user_repo.try_spend_generation(telegram_id)
+
+            if spent:
+                job = await GenerationJobRepository(session).enqueue(
+                    telegram_id=telegram_id,
+                    chat_id=message.chat.id,
+                    file_id=photo.file_id,
+                    file_unique_id=photo.file_unique_id,
+                    balance_after=new_balance,
+                    lane=lane,
+                    timings=timings,
                 )
+    except SpendContendedError:
+        # Генерации есть, но баланс меняется прямо сейчас (например, покупка)
+        await message.answer(
+            "⏳ Баланс сейчас обновляется. Генерация не списана - "
+            "отправь фото ещё раз через пару секунд 🙏"
+        )
+        return
 
-                if new_balance == 0:
-                    balance_info += (
-                        "📸 Генерации закончились, но ты можешь:\n"
-                        "💳 Купить генерации в меню\n"
-                        "🤝 Пригласить друзей и получить бонусы"
-                    )
-                else:
-                    balance_info += (
-                        "📸 Отправь ещё фото, чтобы создать новую ретро фотографию!"
-                    )
-
-                await message.answer(
-                    balance_info,
-                    reply_markup=get_main_menu_keyboard(is_admin=user.is_admin if user else False)
-                )
+    if not spent:
+        # Не удалось списать - либо нет пользователя, либо недостаточно генераций
+        if new_balance is None:
+            # Пользователь не найден
+            await message.answer(
+                "⚠️ <b>Упс! Что-то пошло не так</b>\n\n"
+                "Похоже, ты ещё не зарегистрирован в боте.\n\n"
+                "🎄 Нажми /start чтобы начать пользоваться ботом и получить бесплатные генерации!"
+            )
+            logger.error(f"Пользователь не найден: {telegram_id}")
+        else:
+            # Недостаточно генераций (new_balance содержит текущий баланс: 0 или больше)
+            await message.answer(
+                "😔 <b>Генерации закончились!</b>\n\n"
+                f"💎 На твоём балансе: <b>{new_balance} генераций</b>\n\n"
+                "Но не расстраивайся! Ты можешь:\n\n"
+                "💳 <b>Купить генерации</b>\n"
+                "Нажми на кнопку в меню и выбери подходящий тариф\n\n"
+                "🤝 <b>Пригласить друзей</b>\n"
+                "Получи бонусные генерации за каждого приглашённого друга!\n\n"
+                "✨ Используй меню ниже, чтобы пополнить баланс 👇"
+            )
+            logger.info(f"Недостаточно генераций у пользователя: {telegram_id}")
+        return
 
-            else:
-                # Если генерация не удалась, возвращаем генерацию
-                await user_repo.update_generations(telegram_id, +1)
-
-                # Получаем информацию о пользователе для обновления меню
-                user = await user_repo.get_user_by_telegram_id(telegram_id)
-
-                await message.answer(
-                    "😞 <b>Не удалось создать ретро фотографию</b>\n\n"
-                    "К сожалению, произошла ошибка при генерации изображения.\n\n"
-                    "✅ <b>Хорошая новость:</b> генерация возвращена на твой баланс!\n\n"
-                    "🔄 Попробуй отправить фото ещё раз или выбери другую фотографию.\n\n"
-                    "💡 <b>Рекомендации для лучшего результата:</b>\n"
-                    "• Используй чёткие фотографии с хорошим освещением\n"
-                    "• Лица должны быть хорошо видны\n"
-                    "• Избегай слишком тёмных или размытых снимков",
-                    reply_markup=get_main_menu_keyboard(is_admin=user.is_admin if user else False)
-                )
+    # Снимок пользователя в контексте апдейта соответствует списанию
+    user_context.apply(available_generation=new_balance)
 
-                logger.error(f"Не удалось сгенерировать изображение для {telegram_id}")
+    # Позиция в очереди и оценка ожидания по живой статистике - после фиксации
+    async with database.get_autocommit_session() as session:
+        processing_text = await queue_feedback_service.initial_text(
+            GenerationJobRepository(session), lane
+        )
 
-        except Exception as e:
-            # Удаляем сообщение о обработке в случае ошибки
-            try:
-                await processing_message.delete()
-            except:
-                pass
+    # Подтверждаем приём фото
+    ack_timings = {}
+    with stage_timer.stage("ack", ack_timings):
+        processing_message = await message.answer(processing_text)
+    queue_feedback_service.remember(job.id, processing_text)
 
-            # Возвращаем генерацию
-            await user_repo.update_generations(telegram_id, +1)
+    # Сохраняем ID сообщения, чтобы воркер удалил его после обработки
+    async with get_db_session() as session:
+        job_repo = GenerationJobRepository(session)
+        saved = await job_repo.set_processing_message(
+            job.id, processing_message.message_id, ack_timings
+        )
 
-            # Получаем информацию о пользователе для обновления меню
-            user = await user_repo.get_user_by_telegram_id(telegram_id)
+    if not saved:
+        # Воркер успел завершить задачу раньше - сообщение больше не нужно
+        try:
+            await processing_message.delete()
+        except Exception:
+            pass
 
-            await message.answer(
-                "⚠️ <b>Произошла непредвиденная ошибка</b>\n\n"
-                "Не удалось обработать твоё фото из-за технической ошибки.\n\n"
-                "✅ <b>Генерация возвращена на твой баланс!</b>\n\n"
-                "🔄 Попробуй ещё раз через несколько секунд.\n\n"
-                "Если проблема повторяется, обратись в поддержку 💬",
-                reply_markup=get_main_menu_keyboard(is_admin=user.is_admin if user else False)
-            )
+    # Будим воркеры этого процесса
+    generation_service.notify()
 
-            logger.error(f"Ошибка при обработке изображения: {e}", exc_info=True)
+    stage_timer.log_summary(
+        f"Задача {job.id} для {telegram_id} поставлена в очередь", {**timings, **ack_timings}
+    )
@@ -4,11 +4,13 @@ from aiogram.types import Message, CallbackQuery
 from aiogram.exceptions import TelegramBadRequest
 
 from decimal import Decimal
+from typing import Optional
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
 from bot.config import config
 from bot.database import get_db_session
-from bot.repositories.user_repository import UserRepository
+from bot.middlewares import UserContext
+from bot.repositories.user_repository import UserRepository, UserSnapshot
 from bot.repositories.payment_repository import PaymentRepository
 from bot.services.robokassa import robokassa_service
 from bot.keyboards import (
@@ -23,72 +25,64 @@ router = Router()
 
 
 @router.message(F.text == "💰 Проверить баланс")
-async def check_balance(message: Message):
+async def check_balance(message: Message, user: Optional[UserSnapshot]):
     """Обработка кнопки 'Проверить баланс'"""
     telegram_id = message.from_user.id
 
-    async with get_db_session() as session:
-        user_repo = UserRepository(session)
-        user = await user_repo.get_user_by_telegram_id(telegram_id)
-
-        if user is not None:
-            balance = user.available_generation
-            balance_emoji = "🎉" if balance > 0 else "😔"
-            balance_message = (
-                f"{balance_emoji} <b>Твой баланс генераций</b>\n\n"
-                f"💎 Доступно: <b>{balance} генераций</b>\n\n"
-                f"📸 1 фото = 1 генерация\n"
-                f"✨ Каждая фотография превратится в уникальное ретро фото в стиле 90х!\n\n"
-            )
-
-            if balance == 0:
-                balance_message += (
-                    f"😊 <b>Генерации закончились?</b>\n"
-                    f"Ты можешь:\n"
-                    f"💳 Купить генерации\n"
-                    f"🤝 Пригласить друзей и получить бонусы"
-                )
-            else:
-                balance_message += (
-                    f"🎬 Отправь фото, чтобы создать ретро фотографию в стиле 90х!"
-                )
+    if user is not None:
+        balance = user.available_generation
+        balance_emoji = "🎉" if balance > 0 else "😔"
+        balance_message = (
+            f"{balance_emoji} <b>Твой баланс генераций</b>\n\n"
+            f"💎 Доступно: <b>{balance} генераций</b>\n\n"
+            f"📸 1 фото = 1 генерация\n"
+            f"✨ Каждая фотография превратится в уникальное ретро фото в стиле 90х!\n\n"
+        )
 
-            await message.answer(
-                balance_message,
-                reply_markup=get_main_menu_keyboard(is_admin=user.is_admin)
+        if balance == 0:
+            balance_message += (
+                f"😊 <b>Генерации закончились?</b>\n"
+                f"Ты можешь:\n"
+                f"💳 Купить генерации\n"
+                f"🤝 Пригласить друзей и получить бонусы"
             )
-            logger.info(f"Проверка баланса: {telegram_id} = {balance}")
         else:
-            await message.answer(
-                "Ошибка при получении баланса. Попробуй позже.",
-                reply_markup=get_main_menu_keyboard()
+            balance_message += (
+                f"🎬 Отправь фото, чтобы создать ретро фотографию в стиле 90х!"
             )
-            logger.error(f"Не удалось получить баланс для {telegram_id}")
+
+        await message.answer(
+            balance_message,
+            reply_markup=get_main_menu_keyboard(is_admin=user.is_admin)
+        )
+        logger.info(f"Проверка баланса: {telegram_id} = {balance}")
+    else:
+        await message.answer(
+            "Ошибка при получении баланса. Попробуй позже.",
+            reply_markup=get_main_menu_keyboard()
+        )
+        logger.error(f"Не удалось получить баланс для {telegram_id}")
 
 
 @router.message(F.text == "💳 Купить генерации")
-async def buy_generations(message: Message):
+async def buy_generations(message: Message, user: Optional[UserSnapshot]):
     """Обработка кнопки 'Купить генерации'"""
     telegram_id = message.from_user.id
 
-    async with get_db_session() as session:
-        user_repo = UserRepository(session)
-        balance = await user_repo.get_user_balance(telegram_id)
-
-        if balance is not None:
-            purchase_message = (
-                f"💳 <b>Покупка генераций</b>\n\n"
-                f"💎 Текущий баланс: <b>{balance} генераций</b>\n\n"
-                f"🎨 Каждая генерация = одно уникальное ретро фото в стиле 90х!\n\n"
-                f"📦 <b>Выбери подходящий тариф:</b>"
-            )
+    if user is not None:
+        purchase_message = (
+            f"💳 <b>Покупка генераций</b>\n\n"
+            f"💎 Текущий баланс: <b>{user.available_generation} генераций</b>\n\n"
+            f"🎨 Каждая генерация = одно уникальное ретро фото в стиле 90х!\n\n"
+            f"📦 <b>Выбери подходящий тариф:</b>"
+        )
 
-            keyboard = get_pricing_keyboard(config.pricing)
+        keyboard = get_pricing_keyboard(config.pricing)
 
-            await message.answer(purchase_message, reply_markup=keyboard)
-            logger.info(f"Открыто меню покупки: {telegram_id}")
-        else:
-            await message.answer("Ошибка при загрузке тарифов. Попробуй позже.")
+        await message.answer(purchase_message, reply_markup=keyboard)
+        logger.info(f"Открыто меню покупки: {telegram_id}")
+    else:
+        await message.answer("Ошибка при загрузке тарифов. Попробуй позже.")
 
 
 @router.callback_query(F.data.startswith("buy_"))
@@ -184,7 +178,7 @@ async def process_purchase(callback: CallbackQuery):
 
 
 @router.callback_query(F.data.startswith("check_payment_"))
-async def check_payment(callback: CallbackQuery):
+async def check_payment(callback: CallbackQuery, user_context: UserContext):
     """Проверка статуса платежа"""
     # Отвечаем на callback сразу, чтобы убрать "часики" в Telegram
     # Игнорируем ошибку если callback уже истек
@@ -255,8 +249,10 @@ async def check_payment(callback: CallbackQuery):
         if payment.payment_status == "success":
             # ВАЖНО: Проверяем credited - может быть уже зачислено фоновой задачей
             if payment.credited:
-                # Генерации уже зачислены (возможно фоновой задачей)
-                new_balance = await user_repo.get_user_balance(telegram_id)
+                # Генерации уже зачислены (возможно фоновой задачей, уже
+                # после загрузки снимка) - перечитываем баланс
+                snapshot = await user_context.refresh(user_repo)
+                new_balance = snapshot.available_generation if snapshot else None
                 try:
                     await callback.message.edit_text(
                         "✅ <b>Платеж уже обработан!</b>\n\n"
@@ -282,16 +278,18 @@ async def check_payment(callback: CallbackQuery):
                 f"через кнопку проверки"
             )
 
-            success = await user_repo.update_generations(
-                telegram_id, payment.generations
+            snapshot = await user_repo.update_generations(
+                telegram_id, payment.generations, lane="paid",
+                entry_type="payment", source_id=str(payment.id),
             )
 
-            if success:
+            if snapshot:
                 # Отмечаем платеж как зачисленный
                 await payment_repo.mark_as_credited(payment.id)
 
-                # Получаем новый баланс
-                new_balance = await user_repo.get_user_balance(telegram_id)
+                # UPDATE вернул пользователя после зачисления
+                user_context.user = snapshot
+                new_balance = snapshot.available_generation
 
                 try:
                     await callback.message.edit_text(
@@ -385,38 +383,34 @@ async def check_payment(callback: CallbackQuery):
 
 
 @router.message(F.text == "🤝 Бонусы за друзей")
-async def referral_program(message: Message):
+async def referral_program(message: Message, user: Optional[UserSnapshot]):
     """Обработка кнопки 'Бонусы за друзей'"""
     telegram_id = message.from_user.id
 
-    async with get_db_session() as session:
-        user_repo = UserRepository(session)
-        referral_stats = await user_repo.get_referral_stats(telegram_id)
-
-        if referral_stats is not None:
-            # Формируем реферальную ссылку
-            referral_link = f"https://t.me/{config.bot.bot_username}?start=ref_{telegram_id}"
-
-            referral_message = (
-                f"🤝 <b>Бонусы за друзей</b>\n\n"
-                f"💝 Приглашай друзей и получайте бонусы вместе!\n\n"
-                f"🎁 <b>Как это работает:</b>\n"
-                f"1️⃣ Отправь свою ссылку другу\n"
-                f"2️⃣ Друг запускает бота по твоей ссылке\n"
-                f"3️⃣ Вы оба получаете бонусные генерации!\n\n"
-                f"🔗 <b>Твоя личная ссылка:</b>\n"
-                f"<code>{referral_link}</code>\n\n"
-                f"📊 <b>Статистика:</b>\n"
-                f"✨ Всего получено от рефералов: <b>{referral_stats} генераций</b>\n\n"
-                f"💫 Нажми на кнопку ниже, чтобы поделиться ссылкой!"
-            )
+    if user is not None:
+        # Формируем реферальную ссылку
+        referral_link = f"https://t.me/{config.bot.bot_username}?start=ref_{telegram_id}"
+
+        referral_message = (
+            f"🤝 <b>Бонусы за друзей</b>\n\n"
+            f"💝 Приглашай друзей и получайте бонусы вместе!\n\n"
+            f"🎁 <b>Как это работает:</b>\n"
+            f"1️⃣ Отправь свою ссылку другу\n"
+            f"2️⃣ Друг запускает бота по твоей ссылке\n"
+            f"3️⃣ Вы оба получаете бонусные генерации!\n\n"
+            f"🔗 <b>Твоя личная ссылка:</b>\n"
+            f"<code>{referral_link}</code>\n\n"
+            f"📊 <b>Статистика:</b>\n"
+            f"✨ Всего получено от рефералов: <b>{user.referral_generation} генераций</b>\n\n"
+            f"💫 Нажми на кнопку ниже, чтобы поделиться ссылкой!"
+        )
 
-            keyboard = get_referral_keyboard(referral_link)
+        keyboard = get_referral_keyboard(referral_link)
 
-            await message.answer(referral_message, reply_markup=keyboard)
-            logger.info(f"Открыта программа 'Бонусы за друзей': {telegram_id}")
-        else:
-            await message.answer("Ошибка при загрузке информации. Попробуй позже.")
+        await message.answer(referral_message, reply_markup=keyboard)
+        logger.info(f"Открыта программа 'Бонусы за друзей': {telegram_id}")
+    else:
+        await message.answer("Ошибка при загрузке информации. Попробуй позже.")
 
 
 @router.message(F.text == "🎨 Другие обработки")
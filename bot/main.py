@@ -13,11 +13,18 @@ from bot.config import config
 from bot.logger import logger
 from bot.database import database, get_db_session
 from bot.repositories.payment_repository import PaymentRepository
-from bot.repositories.user_repository import UserRepository
+from bot.repositories.user_repository import UserRepository, user_cache
 from bot.services.robokassa import robokassa_service
+from bot.services.openrouter import openrouter_service
+from bot.services.queue_feedback import queue_feedback_service
+from bot.services.ledger import ledger_projector
+from bot.services.telegram_files import create_bot_session
+from bot.services.metrics import loop_lag_monitor, metrics_server
+from bot.worker import generation_worker_pool
 
 # Импорт роутеров
 from bot.handlers import start, menu, image_processing, promo_code, admin_promo_code
+from bot.middlewares import user_context_middleware
 
 
 async def check_pending_payments(bot: Bot):
@@ -71,19 +78,20 @@ async def check_pending_payments(bot: Bot):
                             await payment_repo.update_payment_status(payment.id, "success")
 
                             # Зачисляем генерации
-                            success = await user_repo.update_generations(
+                            snapshot = await user_repo.update_generations(
                                 payment.telegram_id,
-                                payment.generations
+                                payment.generations,
+                                lane="paid",
+                                entry_type="payment",
+                                source_id=str(payment.id)
                             )
 
-                            if success:
+                            if snapshot:
                                 # Отмечаем как зачисленный
                                 await payment_repo.mark_as_credited(payment.id)
 
-                                # Получаем новый баланс
-                                new_balance = await user_repo.get_user_balance(
-                                    payment.telegram_id
-                                )
+                                # Новый баланс вернул сам UPDATE
+                                new_balance = snapshot.available_generation
 
                                 # Отправляем сообщение пользователю
                                 try:
@@ -118,17 +126,46 @@ async def check_pending_payments(bot: Bot):
             await asyncio.sleep(60)  # Ждем минуту перед следующей попыткой
 
 
-async def on_startup():
+async def on_startup(bot: Bot):
     """Действия при запуске бота"""
     logger.info("Бот запущен")
     logger.info(f"Модель OpenRouter: {config.openrouter.model}")
+    if config.openrouter.fallback_models:
+        logger.info(f"Резервные модели: {', '.join(config.openrouter.fallback_models)}")
     logger.info(f"Начальные генерации: {config.generations.initial_count}")
     logger.info(f"Реферальный бонус: {config.generations.referral_bonus}")
 
+    # Общий пул HTTP-соединений к OpenRouter на всё время работы бота
+    await openrouter_service.start()
+
+    if config.metrics.enabled:
+        await metrics_server.start(config.metrics.host, config.metrics.port)
+        loop_lag_monitor.start(config.metrics.loop_lag_interval)
+
+    # Воркеры очереди генераций (или отдельный процесс: python -m bot.worker)
+    if config.workers.enabled:
+        await generation_worker_pool.start(bot)
+
+    # Обновление позиции в очереди в сообщениях о начале обработки
+    queue_feedback_service.start(bot)
+
+    # Сброс кеша пользователей по изменениям из других процессов
+    await user_cache.start(database.engine)
+
+    # Перенос начислений из журнала генераций в счётчики users
+    ledger_projector.start()
+
 
 async def on_shutdown():
     """Действия при остановке бота"""
     logger.info("Остановка бота...")
+    await queue_feedback_service.stop()
+    await user_cache.stop()
+    await ledger_projector.stop()
+    await generation_worker_pool.stop()
+    await openrouter_service.close()
+    await loop_lag_monitor.stop()
+    await metrics_server.stop()
     await database.close()
     logger.info("Бот остановлен")
 
@@ -139,6 +176,7 @@ async def main():
         # Инициализация бота
         bot = Bot(
             token=config.bot_token,
+            session=create_bot_session(),
             default=DefaultBotProperties(parse_mode=ParseMode.HTML)
         )
 
@@ -150,6 +188,9 @@ async def main():
         dp.startup.register(on_startup)
         dp.shutdown.register(on_shutdown)
 
+        # Снимок пользователя загружается один раз на апдейт
+        dp.update.outer_middleware(user_context_middleware)
+
         # Подключение роутеров
         dp.include_router(start.router)
         dp.include_router(menu.router)
@@ -0,0 +1,15 @@
+"""Middleware бота"""
+from bot.middlewares.throttling import PhotoThrottleMiddleware, photo_throttle_middleware
+from bot.middlewares.user_context import (
+    UserContext,
+    UserContextMiddleware,
+    user_context_middleware,
+)
+
+__all__ = [
+    "PhotoThrottleMiddleware",
+    "photo_throttle_middleware",
+    "UserContext",
+    "UserContextMiddleware",
+    "user_context_middleware",
+]
@@ -0,0 +1,149 @@
+"""Ограничение частоты и параллельности обработки фото одного пользователя"""
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import Message, TelegramObject
+
+from bot.config import ThrottlingConfig, config
+from bot.database import get_db_session
+from bot.logger import logger
+from bot.repositories.generation_job_repository import GenerationJobRepository
+from bot.services.metrics import metrics
+
+throttle_rejected_total = metrics.counter(
+    "photo_throttle_rejected_total", "Фото, отклонённые ограничителем до списания генерации"
+)
+throttle_delayed_total = metrics.counter(
+    "photo_throttle_delayed_total", "Фото, задержанные ограничителем до появления токена"
+)
+
+# Сколько пользователей хранить, прежде чем чистить простаивающие корзины
+BUCKETS_PRUNE_THRESHOLD = 10000
+
+
+@dataclass
+class TokenBucket:
+    """Корзина токенов одного пользователя"""
+    tokens: float
+    updated_at: float = field(default_factory=time.monotonic)
+
+    def refill(self, rate: float, capacity: float, now: float):
+        self.tokens = min(capacity, self.tokens + (now - self.updated_at) * rate)
+        self.updated_at = now
+
+
+class PhotoThrottleMiddleware(BaseMiddleware):
+    """
+    Ограничитель обработки фото на пользователя
+
+    Срабатывает до обработчика, то есть до списания генерации:
+    - корзина токенов ограничивает частоту фото (burst подряд, дальше
+      rate_per_minute); если токен появится в пределах max_wait_seconds,
+      фото ждёт его, иначе отклоняется
+    - не больше max_in_flight незавершённых задач пользователя в очереди
+
+    Фото одного пользователя обрабатываются по очереди, поэтому альбом
+    не занимает сразу несколько соединений с БД
+    """
+
+    def __init__(self, settings: ThrottlingConfig):
+        self.settings = settings
+        self.rate = settings.rate_per_minute / 60
+        self._buckets: Dict[int, TokenBucket] = {}
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._waiters: Dict[int, int] = {}
+
+    def _reserve_token(self, telegram_id: int) -> float:
+        """
+        Занять токен из корзины пользователя
+
+        Returns:
+            Сколько секунд ждать до появления токена (0 - токен есть).
+            Если ждать дольше max_wait_seconds, токен не занимается
+        """
+        now = time.monotonic()
+        bucket = self._buckets.get(telegram_id)
+        if bucket is None:
+            if len(self._buckets) >= BUCKETS_PRUNE_THRESHOLD:
+                self._prune(now)
+            bucket = self._buckets[telegram_id] = TokenBucket(tokens=self.settings.burst)
+
+        bucket.refill(self.rate, self.settings.burst, now)
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            return 0.0
+
+        wait = (1 - bucket.tokens) / self.rate
+        if wait <= self.settings.max_wait_seconds:
+            # Токен занят заранее: следующее фото будет ждать дольше
+            bucket.tokens -= 1
+        return wait
+
+    def _return_token(self, telegram_id: int):
+        """Вернуть токен, если фото так и не было обработано"""
+        bucket = self._buckets.get(telegram_id)
+        if bucket is not None:
+            bucket.tokens = min(self.settings.burst, bucket.tokens + 1)
+
+    def _prune(self, now: float):
+        """Удалить корзины, которые уже полностью восстановились"""
+        for telegram_id, bucket in list(self._buckets.items()):
+            bucket.refill(self.rate, self.settings.burst, now)
+            if bucket.tokens >= self.settings.burst:
+                del self._buckets[telegram_id]
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        if not self.settings.enabled or not isinstance(event, Message) or not event.photo:
+            return await handler(event, data)
+
+        telegram_id = event.from_user.id
+
+        wait = self._reserve_token(telegram_id)
+        if wait > self.settings.max_wait_seconds:
+            throttle_rejected_total.inc(reason="rate")
+            logger.info(f"Фото от {telegram_id} отклонено: слишком часто")
+            await event.answer(
+                "🐢 <b>Слишком много фото подряд</b>\n\n"
+                f"Отправь это фото ещё раз через {int(wait) + 1} сек."
+            )
+            return None
+        if wait > 0:
+            throttle_delayed_total.inc()
+            await asyncio.sleep(wait)
+
+        lock = self._locks.setdefault(telegram_id, asyncio.Lock())
+        self._waiters[telegram_id] = self._waiters.get(telegram_id, 0) + 1
+        try:
+            async with lock:
+                async with get_db_session() as session:
+                    active = await GenerationJobRepository(session).count_active(telegram_id)
+
+                if active >= self.settings.max_in_flight:
+                    throttle_rejected_total.inc(reason="in_flight")
+                    self._return_token(telegram_id)
+                    logger.info(f"Фото от {telegram_id} отклонено: {active} задач уже в обработке")
+                    await event.answer(
+                        "⏳ <b>Твои фото уже в работе</b>\n\n"
+                        f"Сейчас обрабатывается фото: <b>{active}</b>. "
+                        "Дождись результата и отправь это фото ещё раз."
+                    )
+                    return None
+
+                return await handler(event, data)
+        finally:
+            self._waiters[telegram_id] -= 1
+            if not self._waiters[telegram_id]:
+                del self._waiters[telegram_id]
+                self._locks.pop(telegram_id, None)
+
+
+# Глобальный экземпляр ограничителя
+photo_throttle_middleware = PhotoThrottleMiddleware(config.throttling)
@@ -0,0 +1,75 @@
+"""Снимок пользователя на время обработки апдейта"""
+import dataclasses
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+from bot.database import count_roundtrips, database
+from bot.repositories.user_repository import UserRepository, UserSnapshot
+from bot.services.metrics import metrics
+
+update_db_roundtrips = metrics.histogram(
+    "update_db_roundtrips",
+    "Обращения к БД за время обработки одного апдейта",
+    buckets=(0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20),
+)
+
+
+class UserContext:
+    """
+    Снимок пользователя текущего апдейта
+
+    Обработчик, изменивший пользователя, обновляет снимок: apply - значениями,
+    уже известными после записи, refresh - перечитав строку в своей сессии
+    """
+
+    def __init__(self, telegram_id: int, user: Optional[UserSnapshot]):
+        self.telegram_id = telegram_id
+        self.user = user
+
+    def apply(self, **changes):
+        """Обновить поля снимка без обращения к БД"""
+        if self.user is not None:
+            self.user = dataclasses.replace(self.user, **changes)
+
+    async def refresh(self, user_repo: UserRepository) -> Optional[UserSnapshot]:
+        """Перечитать снимок в сессии (и транзакции) вызывающего"""
+        self.user = await user_repo.get_snapshot(self.telegram_id)
+        return self.user
+
+
+class UserContextMiddleware(BaseMiddleware):
+    """
+    Загрузка пользователя один раз на апдейт
+
+    Внешний middleware апдейтов: до фильтров и обработчиков читает снимок
+    пользователя из кеша или одним запросом (без транзакции) и передаёт
+    обработчикам аргументы user (UserSnapshot или None, если пользователь не
+    зарегистрирован) и user_context. Заодно считает обращения к БД за апдейт
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any],
+    ) -> Any:
+        with count_roundtrips() as roundtrips:
+            try:
+                from_user = data.get("event_from_user")
+                if from_user is not None:
+                    async with database.get_autocommit_session() as session:
+                        snapshot = await UserRepository(session).get_cached_snapshot(
+                            from_user.id
+                        )
+                    data["user_context"] = UserContext(from_user.id, snapshot)
+                    data["user"] = snapshot
+
+                return await handler(event, data)
+            finally:
+                update_db_roundtrips.observe(roundtrips[0], event=event.event_type)
+
+
+# Глобальный экземпляр middleware
+user_context_middleware = UserContextMiddleware()
@@ -0,0 +1,213 @@
+"""
+Локальный mock-сервер провайдера генерации в формате OpenRouter
+
+Запуск: python -m bot.mock_server
+Бот направляется на него через openrouter.api_url, поведение (задержки,
+ошибки, размеры ответов) задаётся в секции mock_provider конфига
+"""
+import asyncio
+import base64
+import json
+import sys
+import time
+import uuid
+from typing import Dict, Optional, Tuple
+
+from aiohttp import web
+
+from bot.config import config
+from bot.logger import logger
+from bot.services.mock_provider import MockOutcome, MockProvider
+
+# Путь, совпадающий с OpenRouter
+COMPLETIONS_PATH = "/api/v1/chat/completions"
+
+# Текст заглушки вместо изображения (в режиме SSE отдаётся по словам)
+REFUSAL_TEXT = (
+    "Не могу обработать это изображение. Попробуйте другое фото, "
+    "на котором хорошо видно лицо, без посторонних людей и надписей. "
+) * 4
+
+# Пауза между текстовыми событиями SSE, секунды
+SSE_TEXT_INTERVAL = 0.02
+
+
+class MockServer:
+    """HTTP сервер, отвечающий на chat completions по профилю заглушки"""
+
+    def __init__(self, provider: MockProvider):
+        self.provider = provider
+        # Готовые тела ответов и события SSE с изображением по размеру
+        self._bodies: Dict[Tuple[int, int], bytes] = {}
+        self._events: Dict[Tuple[int, int], bytes] = {}
+        self._runner: Optional[web.AppRunner] = None
+
+    def warm_up(self):
+        """Заранее собрать JSON ответов: base64 многомегабайтного PNG не дёшев"""
+        self.provider.warm_up()
+        for width, height in self.provider.settings.image_sizes:
+            self._image_body((width, height))
+            self._image_event((width, height))
+
+    def _image_message(self, size: Tuple[int, int]) -> dict:
+        image_base64 = base64.b64encode(self.provider.render(size)).decode("ascii")
+        return {
+            "role": "assistant",
+            "content": "",
+            "images": [{
+                "type": "image_url",
+                "image_url": {"url": f"data:image/png;base64,{image_base64}"},
+            }],
+        }
+
+    def _image_body(self, size: Tuple[int, int]) -> bytes:
+        if size not in self._bodies:
+            self._bodies[size] = json.dumps(
+                self._completion(self._image_message(size))
+            ).encode("utf-8")
+        return self._bodies[size]
+
+    def _image_event(self, size: Tuple[int, int]) -> bytes:
+        if size not in self._events:
+            self._events[size] = self._event(
+                {"index": 0, "delta": self._image_message(size)}
+            )
+        return self._events[size]
+
+    @staticmethod
+    def _event(choice: dict) -> bytes:
+        chunk = {
+            "id": f"gen-mock-{uuid.uuid4().hex}",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": "mock",
+            "choices": [choice],
+        }
+        return b"data: " + json.dumps(chunk).encode("utf-8") + b"\n\n"
+
+    @staticmethod
+    def _completion(message: dict) -> dict:
+        return {
+            "id": f"gen-mock-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": "mock",
+            "choices": [{"index": 0, "finish_reason": "stop", "message": message}],
+        }
+
+    async def _handle_completion(self, request: web.Request) -> web.StreamResponse:
+        # Тело запроса читается целиком, как у настоящего провайдера
+        payload = json.loads(await request.read())
+        outcome = self.provider.next_outcome()
+
+        if payload.get("stream") and outcome.kind in ("image", "empty"):
+            return await self._stream_completion(request, outcome)
+
+        await asyncio.sleep(outcome.delay)
+
+        if outcome.kind == "timeout":
+            # Клиент к этому моменту обычно уже отвалился по таймауту
+            return web.json_response(
+                {"error": {"code": 504, "message": "mock timeout"}}, status=504
+            )
+
+        if outcome.kind == "error":
+            headers = {}
+            retry_after = self.provider.retry_after(outcome.status_code)
+            if retry_after is not None:
+                headers["Retry-After"] = str(int(retry_after))
+            return web.json_response(
+                {"error": {"code": outcome.status_code, "message": "mock provider error"}},
+                status=outcome.status_code,
+                headers=headers,
+            )
+
+        if outcome.kind == "empty":
+            return web.json_response(self._completion({
+                "role": "assistant",
+                "content": "Не могу обработать это изображение",
+            }))
+
+        return web.Response(body=self._image_body(outcome.size), content_type="application/json")
+
+    async def _stream_completion(
+        self, request: web.Request, outcome: MockOutcome
+    ) -> web.StreamResponse:
+        """
+        Ответ событиями SSE, как stream: true у OpenRouter
+
+        Пока "модель думает", идут комментарии keep-alive; ошибки и таймауты
+        отдаются до начала потока обычным ответом
+        """
+        response = web.StreamResponse(headers={
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-cache",
+        })
+        await response.prepare(request)
+        try:
+            await response.write(b": OPENROUTER PROCESSING\n\n")
+
+            remaining = outcome.delay
+            while remaining > 0:
+                await asyncio.sleep(min(remaining, 1.0))
+                remaining -= 1.0
+                if remaining > 0:
+                    await response.write(b": OPENROUTER PROCESSING\n\n")
+
+            await response.write(
+                self._event({"index": 0, "delta": {"role": "assistant", "content": ""}})
+            )
+            if outcome.kind == "image":
+                await response.write(self._image_event(outcome.size))
+            else:
+                for word in REFUSAL_TEXT.split(" "):
+                    await response.write(self._event({"index": 0, "delta": {"content": word + " "}}))
+                    await asyncio.sleep(SSE_TEXT_INTERVAL)
+
+            await response.write(self._event({"index": 0, "delta": {}, "finish_reason": "stop"}))
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+        except ConnectionResetError:
+            # Клиент прервал поток (например, увидев отказ модели)
+            logger.debug("Клиент закрыл поток SSE до конца ответа")
+        return response
+
+    async def start(self, host: str, port: int):
+        """Запустить сервер"""
+        await asyncio.to_thread(self.warm_up)
+
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post(COMPLETIONS_PATH, self._handle_completion)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+        logger.info(f"Mock-сервер провайдера запущен на http://{host}:{port}{COMPLETIONS_PATH}")
+
+    async def stop(self):
+        """Остановить сервер"""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+            logger.info("Mock-сервер провайдера остановлен")
+
+
+async def main():
+    """Запуск mock-сервера: python -m bot.mock_server"""
+    server = MockServer(MockProvider(config.mock_provider))
+    await server.start(config.mock_provider.host, config.mock_provider.port)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        logger.info("Mock-сервер остановлен пользователем (Ctrl+C)")
+    except Exception as e:
+        logger.error(f"Неожиданная ошибка: {e}", exc_info=True)
+        sys.exit(1)
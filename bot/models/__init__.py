@@ -1,5 +1,8 @@
 from bot.models.user import User, Base
 from bot.models.promo_code import PromoCode, PromoCodeUsage
 from bot.models.payment import Payment
+from bot.models.generation_job import GenerationJob
+from bot.models.generation_ledger import GenerationLedgerEntry
+from bot.models.circuit_breaker import CircuitBreakerState
 
-__all__ = ["User", "Base", "PromoCode", "PromoCodeUsage", "Payment"]
+__all__ = ["User", "Base", "PromoCode", "PromoCodeUsage", "Payment", "GenerationJob", "GenerationLedgerEntry", "CircuitBreakerState"]
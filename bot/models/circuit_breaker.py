@@ -0,0 +1,28 @@
+"""Модель общего состояния автомата защиты"""
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import DateTime, String
+from sqlalchemy.orm import Mapped, mapped_column
+
+from bot.models.user import Base
+
+
+class CircuitBreakerState(Base):
+    """
+    Состояние автомата защиты, общее для всех процессов
+
+    Процесс с воркерами, у которого разомкнулась цепь, записывает срок
+    размыкания. Процесс бота читает его перед списанием, даже если сам
+    запросов к провайдеру не отправляет (воркеры в python -m bot.worker)
+    """
+
+    __tablename__ = "circuit_breakers"
+
+    name: Mapped[str] = mapped_column(String(50), primary_key=True, comment="Имя автомата")
+    open_until: Mapped[Optional[datetime]] = mapped_column(
+        DateTime, nullable=True, comment="До какого времени цепь разомкнута"
+    )
+    updated_at: Mapped[datetime] = mapped_column(
+        DateTime, nullable=False, default=datetime.utcnow
+    )
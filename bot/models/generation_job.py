@@ -0,0 +1,98 @@
+"""Модель задачи генерации изображения"""
+import uuid
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import String, Integer, DateTime, BigInteger, Text, Index
+from sqlalchemy.dialects.postgresql import UUID, JSONB
+from sqlalchemy.orm import Mapped, mapped_column
+
+from bot.models.user import Base
+
+# Классы приоритета задач по источнику списанной генерации
+LANES = ("paid", "promo", "free")
+
+
+class GenerationJob(Base):
+    """
+    Задача генерации изображения в очереди
+
+    Статусы: queued -> processing -> delivering -> done | failed
+
+    В статусе delivering изображение уже сгенерировано и сохранено на диск,
+    остаётся только отправить его пользователю
+    """
+
+    __tablename__ = "generation_jobs"
+    __table_args__ = (
+        Index("ix_generation_jobs_status_created_at", "status", "created_at"),
+        Index("ix_generation_jobs_status_lane_created_at", "status", "lane", "created_at"),
+        Index("ix_generation_jobs_status_next_delivery_at", "status", "next_delivery_at"),
+    )
+
+    id: Mapped[uuid.UUID] = mapped_column(
+        UUID(as_uuid=True), primary_key=True, default=uuid.uuid4
+    )
+    telegram_id: Mapped[int] = mapped_column(
+        BigInteger, nullable=False, index=True, comment="Telegram ID пользователя"
+    )
+    chat_id: Mapped[int] = mapped_column(
+        BigInteger, nullable=False, comment="Чат для доставки результата"
+    )
+    file_id: Mapped[str] = mapped_column(
+        String(255), nullable=False, comment="file_id исходной фотографии"
+    )
+    file_unique_id: Mapped[str] = mapped_column(
+        String(64), nullable=False, comment="file_unique_id исходной фотографии"
+    )
+    status: Mapped[str] = mapped_column(
+        String(20),
+        nullable=False,
+        default="queued",
+        comment="Статус задачи: queued, processing, delivering, done, failed",
+    )
+    lane: Mapped[str] = mapped_column(
+        String(10),
+        nullable=False,
+        default="free",
+        comment="Класс приоритета: paid, promo, free",
+    )
+    attempts: Mapped[int] = mapped_column(
+        Integer, nullable=False, default=0, comment="Количество взятий в работу"
+    )
+    balance_after: Mapped[Optional[int]] = mapped_column(
+        Integer, nullable=True, comment="Баланс пользователя после списания"
+    )
+    processing_message_id: Mapped[Optional[int]] = mapped_column(
+        BigInteger, nullable=True, comment="ID сообщения 'Начинаем волшебство'"
+    )
+    delivery_attempts: Mapped[int] = mapped_column(
+        Integer, nullable=False, default=0, comment="Количество попыток доставки результата"
+    )
+    next_delivery_at: Mapped[Optional[datetime]] = mapped_column(
+        DateTime, nullable=True, comment="Время следующей попытки доставки"
+    )
+    result_file_id: Mapped[Optional[str]] = mapped_column(
+        String(255), nullable=True, comment="Telegram file_id результата из кеша"
+    )
+    worker_id: Mapped[Optional[str]] = mapped_column(
+        String(100), nullable=True, comment="Воркер, обрабатывающий задачу"
+    )
+    locked_until: Mapped[Optional[datetime]] = mapped_column(
+        DateTime, nullable=True, comment="Срок аренды задачи воркером"
+    )
+    error: Mapped[Optional[str]] = mapped_column(
+        Text, nullable=True, comment="Причина ошибки"
+    )
+    timings: Mapped[Optional[dict]] = mapped_column(
+        JSONB, nullable=True, comment="Длительность этапов обработки в секундах"
+    )
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime, nullable=False, default=datetime.utcnow
+    )
+    started_at: Mapped[Optional[datetime]] = mapped_column(
+        DateTime, nullable=True
+    )
+    finished_at: Mapped[Optional[datetime]] = mapped_column(
+        DateTime, nullable=True
+    )
@@ -0,0 +1,75 @@
+"""Модель журнала движений генераций"""
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import BigInteger, DateTime, Index, Integer, String, text
+from sqlalchemy.orm import Mapped, mapped_column
+
+from bot.models.user import Base
+
+# Виды записей журнала
+ENTRY_TYPES = (
+    "opening",     # остаток на момент перехода на журнал
+    "initial",     # начальные генерации при регистрации
+    "spend",       # списание за фото
+    "refund",      # возврат за неудачную или повторную генерацию
+    "payment",     # оплата
+    "referral",    # бонус за приглашённого пользователя
+    "promo",       # промокод
+    "adjustment",  # ручная корректировка
+)
+
+
+class GenerationLedgerEntry(Base):
+    """
+    Запись журнала движений генераций (только добавление)
+
+    Счётчики генераций в users - проекция журнала. Начисления добавляются
+    в журнал без блокировки строки пользователя и переносятся в users
+    позже (applied_at): фоновым проецированием пачками или при ближайшем
+    списании. Баланс пользователя - счётчики users плюс ещё не
+    перенесённые записи
+    """
+
+    __tablename__ = "generation_ledger"
+    __table_args__ = (
+        # Повтор начисления с тем же источником (платёж, задача, реферал) не
+        # создаёт второй записи
+        Index(
+            "ux_generation_ledger_source",
+            "telegram_id", "entry_type", "source_id",
+            unique=True,
+            postgresql_where=text("source_id IS NOT NULL"),
+        ),
+        # Поиск ещё не перенесённых в users записей
+        Index(
+            "ix_generation_ledger_pending",
+            "telegram_id",
+            postgresql_where=text("applied_at IS NULL"),
+        ),
+    )
+
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
+    telegram_id: Mapped[int] = mapped_column(
+        BigInteger, nullable=False, index=True, comment="Telegram ID пользователя"
+    )
+    entry_type: Mapped[str] = mapped_column(
+        String(20),
+        nullable=False,
+        comment="Вид записи: opening, initial, spend, refund, payment, referral, promo, adjustment",
+    )
+    delta: Mapped[int] = mapped_column(
+        Integer, nullable=False, comment="Изменение баланса"
+    )
+    lane: Mapped[str] = mapped_column(
+        String(10), nullable=False, default="free", comment="Класс генераций: paid, promo, free"
+    )
+    source_id: Mapped[Optional[str]] = mapped_column(
+        String(64), nullable=True, comment="Источник: платёж, задача, приглашённый, промокод"
+    )
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime, nullable=False, default=datetime.utcnow
+    )
+    applied_at: Mapped[Optional[datetime]] = mapped_column(
+        DateTime, nullable=True, comment="Когда запись перенесена в счётчики users"
+    )
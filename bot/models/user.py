@@ -49,13 +49,28 @@ class User(Base):
         nullable=True
     )
 
-    # Доступное количество генераций
+    # Доступное количество генераций. Счётчики генераций - проекция журнала
+    # generation_ledger без ещё не перенесённых начислений
     available_generation: Mapped[int] = mapped_column(
         Integer,
         nullable=False,
         default=0
     )
 
+    # Часть доступных генераций, купленная через оплату (приоритетная очередь)
+    paid_generation: Mapped[int] = mapped_column(
+        Integer,
+        nullable=False,
+        default=0
+    )
+
+    # Часть доступных генераций из промокодов и реферальных бонусов
+    promo_generation: Mapped[int] = mapped_column(
+        Integer,
+        nullable=False,
+        default=0
+    )
+
     # Telegram ID пригласившего пользователя (опционально)
     referral_telegram_id: Mapped[Optional[int]] = mapped_column(
         BigInteger,
@@ -0,0 +1,56 @@
+"""Репозиторий общего состояния автоматов защиты"""
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from bot.models.circuit_breaker import CircuitBreakerState
+
+
+class CircuitBreakerRepository:
+    """Класс для работы с состоянием автоматов защиты в БД"""
+
+    def __init__(self, session: AsyncSession):
+        """
+        Инициализация репозитория
+
+        Args:
+            session: Сессия БД
+        """
+        self.session = session
+
+    async def set_open_until(self, name: str, open_until: Optional[datetime]):
+        """
+        Записать срок размыкания цепи
+
+        Args:
+            name: Имя автомата
+            open_until: До какого времени цепь разомкнута (None - замкнута)
+        """
+        now = datetime.utcnow()
+        statement = insert(CircuitBreakerState).values(
+            name=name, open_until=open_until, updated_at=now
+        )
+        await self.session.execute(
+            statement.on_conflict_do_update(
+                index_elements=[CircuitBreakerState.name],
+                set_={"open_until": statement.excluded.open_until, "updated_at": now},
+            )
+        )
+
+    async def get_open_until(self, name: str) -> Optional[datetime]:
+        """
+        Срок размыкания цепи
+
+        Args:
+            name: Имя автомата
+
+        Returns:
+            До какого времени цепь разомкнута или None
+        """
+        result = await self.session.execute(
+            select(CircuitBreakerState.open_until).where(CircuitBreakerState.name == name)
+        )
+        return result.scalar_one_or_none()
@@ -0,0 +1,539 @@
+"""Репозиторий для работы с очередью задач генерации"""
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Sequence
+
+from sqlalchemy import case, cast, func, literal_column, or_, select, update
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from bot.models.generation_job import GenerationJob
+from bot.logger import logger
+
+
+def _merge_timings(timings: dict):
+    """
+    Дописать этапы к уже сохранённым в задаче
+
+    Этапы пишут и обработчик (списание, подтверждение), и воркер - чтобы
+    запись одного не затирала другого, JSONB объединяется в БД
+    """
+    # None в JSONB-колонке сохраняется как JSON null, а не NULL
+    current = func.nullif(GenerationJob.timings, literal_column("'null'::jsonb"))
+    return func.coalesce(current, cast({}, JSONB)).op("||")(cast(timings, JSONB))
+
+
+@dataclass
+class WaitingJob:
+    """Незавершённая задача с сообщением о начале обработки"""
+    id: uuid.UUID
+    lane: str
+    status: str
+    created_at: datetime
+    chat_id: int
+    processing_message_id: int
+    # Задач в том же статусе, поставленных раньше: того же класса и всех
+    ahead_in_lane: int
+    ahead_total: int
+
+
+class GenerationJobRepository:
+    """Класс для работы с задачами генерации в БД"""
+
+    def __init__(self, session: AsyncSession):
+        """
+        Инициализация репозитория
+
+        Args:
+            session: Сессия БД
+        """
+        self.session = session
+
+    async def enqueue(
+        self,
+        telegram_id: int,
+        chat_id: int,
+        file_id: str,
+        file_unique_id: str,
+        balance_after: Optional[int] = None,
+        lane: str = "free",
+        timings: Optional[dict] = None,
+    ) -> GenerationJob:
+        """
+        Поставить задачу в очередь
+
+        Запись не фиксируется здесь: задача должна попасть в ту же транзакцию,
+        что и списание генерации
+
+        Args:
+            telegram_id: Telegram ID пользователя
+            chat_id: ID чата для доставки результата
+            file_id: file_id исходной фотографии
+            file_unique_id: file_unique_id исходной фотографии
+            balance_after: Баланс пользователя после списания
+            lane: Класс приоритета (источник списанной генерации)
+            timings: Этапы, пройденные до постановки в очередь
+
+        Returns:
+            Созданная задача
+        """
+        job = GenerationJob(
+            telegram_id=telegram_id,
+            chat_id=chat_id,
+            file_id=file_id,
+            file_unique_id=file_unique_id,
+            balance_after=balance_after,
+            lane=lane,
+            status="queued",
+            attempts=0,
+            timings=timings,
+        )
+
+        self.session.add(job)
+        await self.session.flush()
+
+        logger.info(f"Задача генерации {job.id} ({lane}) поставлена в очередь для {telegram_id}")
+        return job
+
+    async def claim_next(
+        self,
+        worker_id: str,
+        lease_seconds: int,
+        lane_order: Optional[Sequence[str]] = None,
+    ) -> Optional[GenerationJob]:
+        """
+        Взять следующую задачу из очереди
+
+        Используется SELECT ... FOR UPDATE SKIP LOCKED, поэтому несколько
+        воркеров (в том числе в разных процессах) не получат одну задачу
+
+        Args:
+            worker_id: Идентификатор воркера
+            lease_seconds: Срок аренды задачи в секундах
+            lane_order: Порядок предпочтения классов приоритета; без него
+                задачи берутся строго по времени постановки
+
+        Returns:
+            GenerationJob или None, если очередь пуста
+        """
+        query = select(GenerationJob).where(GenerationJob.status == "queued")
+        if lane_order:
+            # Первая задача из самого предпочтительного непустого класса
+            query = query.order_by(
+                case(
+                    {lane: position for position, lane in enumerate(lane_order)},
+                    value=GenerationJob.lane,
+                    else_=len(lane_order),
+                )
+            )
+        result = await self.session.execute(
+            query
+            .order_by(GenerationJob.created_at)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+        )
+        job = result.scalar_one_or_none()
+
+        if not job:
+            return None
+
+        now = datetime.utcnow()
+        job.status = "processing"
+        job.attempts += 1
+        job.worker_id = worker_id
+        job.started_at = now
+        job.locked_until = now + timedelta(seconds=lease_seconds)
+        await self.session.commit()
+
+        logger.info(f"Задача {job.id} взята в работу воркером {worker_id} (попытка {job.attempts})")
+        return job
+
+    async def set_processing_message(
+        self, job_id: uuid.UUID, message_id: int, timings: Optional[dict] = None
+    ) -> bool:
+        """
+        Сохранить ID сообщения о начале обработки
+
+        Args:
+            job_id: ID задачи
+            message_id: ID сообщения
+            timings: Этапы обработчика, которые нужно дописать к задаче
+
+        Returns:
+            True, если задача ещё не завершена и сообщение сохранено
+        """
+        values = {"processing_message_id": message_id}
+        if timings:
+            values["timings"] = _merge_timings(timings)
+
+        result = await self.session.execute(
+            update(GenerationJob)
+            .where(GenerationJob.id == job_id)
+            .where(GenerationJob.status.in_(["queued", "processing"]))
+            .values(**values)
+        )
+        return result.rowcount > 0
+
+    async def count_queued(self, lane: str) -> int:
+        """
+        Количество задач класса, ожидающих в очереди
+
+        Args:
+            lane: Класс приоритета
+
+        Returns:
+            Число задач в статусе queued
+        """
+        result = await self.session.execute(
+            select(func.count())
+            .select_from(GenerationJob)
+            .where(GenerationJob.status == "queued")
+            .where(GenerationJob.lane == lane)
+        )
+        return result.scalar_one()
+
+    async def get_queue_depths(self) -> Dict[str, int]:
+        """
+        Длина очереди по классам приоритета
+
+        Returns:
+            Словарь класс -> число задач в статусе queued
+        """
+        result = await self.session.execute(
+            select(GenerationJob.lane, func.count())
+            .where(GenerationJob.status == "queued")
+            .group_by(GenerationJob.lane)
+        )
+        return {lane: count for lane, count in result.all()}
+
+    async def get_waiting_with_messages(self) -> List[WaitingJob]:
+        """
+        Незавершённые задачи с сообщением о начале обработки
+
+        Позиции в очереди считаются оконными функциями по всем ожидающим
+        задачам, но возвращаются только задачи с processing_message_id и
+        только нужные для правки сообщения колонки
+
+        Returns:
+            Задачи в статусах queued и processing по времени постановки
+        """
+        waiting = (
+            select(
+                GenerationJob.id,
+                GenerationJob.lane,
+                GenerationJob.status,
+                GenerationJob.created_at,
+                GenerationJob.chat_id,
+                GenerationJob.processing_message_id,
+                (
+                    func.row_number().over(
+                        partition_by=(GenerationJob.status, GenerationJob.lane),
+                        order_by=GenerationJob.created_at,
+                    ) - 1
+                ).label("ahead_in_lane"),
+                (
+                    func.row_number().over(
+                        partition_by=GenerationJob.status,
+                        order_by=GenerationJob.created_at,
+                    ) - 1
+                ).label("ahead_total"),
+            )
+            .where(GenerationJob.status.in_(["queued", "processing"]))
+            .subquery("waiting")
+        )
+        result = await self.session.execute(
+            select(waiting)
+            .where(waiting.c.processing_message_id.isnot(None))
+            .order_by(waiting.c.created_at)
+        )
+        return [WaitingJob(**row._mapping) for row in result.all()]
+
+    async def get_duration_percentiles(
+        self, quantiles: Sequence[float], limit: int = 200
+    ) -> Optional[List[float]]:
+        """
+        Перцентили длительности обработки последних выполненных задач
+
+        Дубликаты, получившие результат чужого запроса (coalesced), не
+        учитываются: их длительность короче реальной генерации
+
+        Args:
+            quantiles: Квантили от 0 до 1
+            limit: Сколько последних задач учитывать
+
+        Returns:
+            Значения перцентилей в секундах или None, если задач ещё нет
+        """
+        recent = (
+            select(GenerationJob.timings["total"].as_float().label("total"))
+            .where(GenerationJob.status == "done")
+            .where(~GenerationJob.timings.has_key("coalesced"))
+            .order_by(GenerationJob.created_at.desc())
+            .limit(limit)
+            .subquery()
+        )
+        result = await self.session.execute(
+            select(
+                *[
+                    func.percentile_cont(quantile).within_group(recent.c.total)
+                    for quantile in quantiles
+                ]
+            ).where(recent.c.total.isnot(None))
+        )
+        row = result.one()
+        if row[0] is None:
+            return None
+        return [float(value) for value in row]
+
+    async def count_active(self, telegram_id: int) -> int:
+        """
+        Количество незавершённых задач пользователя
+
+        Args:
+            telegram_id: Telegram ID пользователя
+
+        Returns:
+            Число задач в статусах queued и processing
+        """
+        result = await self.session.execute(
+            select(func.count())
+            .select_from(GenerationJob)
+            .where(GenerationJob.telegram_id == telegram_id)
+            .where(GenerationJob.status.in_(["queued", "processing"]))
+        )
+        return result.scalar_one()
+
+    async def get_processing_message_id(self, job_id: uuid.UUID) -> Optional[int]:
+        """
+        Получить ID сообщения о начале обработки
+
+        Args:
+            job_id: ID задачи
+
+        Returns:
+            ID сообщения или None
+        """
+        result = await self.session.execute(
+            select(GenerationJob.processing_message_id).where(GenerationJob.id == job_id)
+        )
+        return result.scalar_one_or_none()
+
+    async def mark_delivering(
+        self,
+        job_id: uuid.UUID,
+        timings: dict,
+        lease_seconds: int,
+        balance_after: Optional[int] = None,
+        result_file_id: Optional[str] = None,
+    ) -> bool:
+        """
+        Отметить, что изображение сгенерировано и сохранено, и начать доставку
+
+        После этого задача не возвращается в очередь генерации: при сбое
+        доставки повторяется только отправка сохранённого результата
+
+        Args:
+            job_id: ID задачи
+            timings: Длительность этапов обработки
+            lease_seconds: Срок, на который первая попытка доставки
+                закреплена за воркером
+            balance_after: Баланс пользователя после списания
+            result_file_id: Telegram file_id, если результат взят из кеша
+
+        Returns:
+            True, если задача была в работе и обновлена
+        """
+        result = await self.session.execute(
+            update(GenerationJob)
+            .where(GenerationJob.id == job_id)
+            .where(GenerationJob.status == "processing")
+            .values(
+                status="delivering",
+                timings=_merge_timings(timings),
+                balance_after=balance_after,
+                result_file_id=result_file_id,
+                delivery_attempts=1,
+                next_delivery_at=datetime.utcnow() + timedelta(seconds=lease_seconds),
+                locked_until=None,
+            )
+        )
+        return result.rowcount > 0
+
+    async def claim_delivery(
+        self, worker_id: str, lease_seconds: int, host: Optional[str] = None
+    ) -> Optional[GenerationJob]:
+        """
+        Взять результат, ожидающий повторной доставки
+
+        Args:
+            worker_id: Идентификатор воркера
+            lease_seconds: Срок, на который попытка закрепляется за воркером
+            host: Брать только результаты, сгенерированные на этом хосте
+                (ID воркера вида "хост:pid/..."), и результаты с file_id
+                из кеша, которым локальный файл не нужен. None - любые
+
+        Returns:
+            GenerationJob или None, если доставлять нечего
+        """
+        now = datetime.utcnow()
+        query = (
+            select(GenerationJob)
+            .where(GenerationJob.status == "delivering")
+            .where(GenerationJob.next_delivery_at <= now)
+            .order_by(GenerationJob.next_delivery_at)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+        )
+        if host is not None:
+            query = query.where(
+                or_(
+                    GenerationJob.result_file_id.is_not(None),
+                    GenerationJob.worker_id.startswith(f"{host}:", autoescape=True),
+                )
+            )
+        result = await self.session.execute(query)
+        job = result.scalar_one_or_none()
+
+        if not job:
+            return None
+
+        job.delivery_attempts += 1
+        job.worker_id = worker_id
+        job.next_delivery_at = now + timedelta(seconds=lease_seconds)
+        await self.session.commit()
+
+        logger.info(
+            f"Доставка результата задачи {job.id} взята воркером {worker_id} "
+            f"(попытка {job.delivery_attempts})"
+        )
+        return job
+
+    async def schedule_delivery(self, job_id: uuid.UUID, delay: float, error: str) -> bool:
+        """
+        Отложить следующую попытку доставки
+
+        Args:
+            job_id: ID задачи
+            delay: Задержка до следующей попытки в секундах
+            error: Причина неудачной попытки
+
+        Returns:
+            True, если задача ожидает доставки и обновлена
+        """
+        result = await self.session.execute(
+            update(GenerationJob)
+            .where(GenerationJob.id == job_id)
+            .where(GenerationJob.status == "delivering")
+            .values(
+                next_delivery_at=datetime.utcnow() + timedelta(seconds=delay),
+                error=error,
+            )
+        )
+        return result.rowcount > 0
+
+    async def mark_done(
+        self, job_id: uuid.UUID, timings: dict, from_status: str = "processing"
+    ) -> bool:
+        """
+        Отметить задачу как выполненную
+
+        Args:
+            job_id: ID задачи
+            timings: Длительность этапов обработки
+            from_status: Ожидаемый текущий статус задачи
+
+        Returns:
+            True, если задача была в ожидаемом статусе и обновлена
+        """
+        result = await self.session.execute(
+            update(GenerationJob)
+            .where(GenerationJob.id == job_id)
+            .where(GenerationJob.status == from_status)
+            .values(
+                status="done",
+                timings=_merge_timings(timings),
+                locked_until=None,
+                finished_at=datetime.utcnow(),
+            )
+        )
+        return result.rowcount > 0
+
+    async def mark_failed(
+        self,
+        job_id: uuid.UUID,
+        error: str,
+        timings: Optional[dict] = None,
+        from_status: str = "processing",
+    ) -> bool:
+        """
+        Отметить задачу как неудавшуюся
+
+        Args:
+            job_id: ID задачи
+            error: Причина ошибки
+            timings: Длительность этапов обработки
+            from_status: Ожидаемый текущий статус задачи
+
+        Returns:
+            True, если задача была в ожидаемом статусе и обновлена
+        """
+        result = await self.session.execute(
+            update(GenerationJob)
+            .where(GenerationJob.id == job_id)
+            .where(GenerationJob.status == from_status)
+            .values(
+                status="failed",
+                error=error,
+                timings=_merge_timings(timings or {}),
+                locked_until=None,
+                finished_at=datetime.utcnow(),
+            )
+        )
+        return result.rowcount > 0
+
+    async def release(self, job_id: uuid.UUID) -> bool:
+        """
+        Вернуть задачу в очередь (например, при остановке воркера)
+
+        Попытка не засчитывается: задача не была обработана по вине воркера
+
+        Args:
+            job_id: ID задачи
+
+        Returns:
+            True, если обновление успешно
+        """
+        result = await self.session.execute(
+            update(GenerationJob)
+            .where(GenerationJob.id == job_id)
+            .where(GenerationJob.status == "processing")
+            .values(
+                status="queued",
+                attempts=GenerationJob.attempts - 1,
+                worker_id=None,
+                locked_until=None,
+            )
+        )
+        return result.rowcount > 0
+
+    async def requeue_stale(self) -> int:
+        """
+        Вернуть в очередь задачи, аренда которых истекла
+
+        Такие задачи остаются после падения или перезапуска воркера
+
+        Returns:
+            Количество возвращённых задач
+        """
+        result = await self.session.execute(
+            update(GenerationJob)
+            .where(GenerationJob.status == "processing")
+            .where(GenerationJob.locked_until < datetime.utcnow())
+            .values(status="queued", worker_id=None, locked_until=None)
+        )
+
+        if result.rowcount > 0:
+            logger.warning(f"Возвращено в очередь зависших задач: {result.rowcount}")
+
+        return result.rowcount
@@ -0,0 +1,193 @@
+"""Репозиторий журнала движений генераций"""
+from dataclasses import dataclass
+from datetime import datetime
+from typing import List, Optional
+
+from sqlalchemy import func, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from bot.models.generation_ledger import GenerationLedgerEntry
+from bot.models.user import User
+from bot.logger import logger
+
+
+def ledger_totals(entries):
+    """
+    Суммы записей журнала в разрезе счётчиков users
+
+    Args:
+        entries: Таблица, подзапрос или CTE с колонками delta, lane, entry_type
+
+    Returns:
+        Колонки total, paid, promo, referral и entries (число записей)
+    """
+    delta = entries.c.delta
+    return (
+        func.coalesce(func.sum(delta), 0).label("total"),
+        func.coalesce(func.sum(delta).filter(entries.c.lane == "paid"), 0).label("paid"),
+        func.coalesce(func.sum(delta).filter(entries.c.lane == "promo"), 0).label("promo"),
+        func.coalesce(
+            func.sum(delta).filter(entries.c.entry_type == "referral"), 0
+        ).label("referral"),
+        func.count().label("entries"),
+    )
+
+
+def fold_pending(locked):
+    """
+    Отметить перенесёнными записи пользователей из locked и просуммировать их
+
+    Вызывающий блокирует строки users в locked (CTE с колонкой telegram_id)
+    до вызова, поэтому параллельный перенос тех же записей невозможен
+
+    Returns:
+        CTE с telegram_id и суммами ledger_totals по каждому пользователю
+    """
+    entries = GenerationLedgerEntry.__table__
+    folded = (
+        update(entries)
+        .where(
+            entries.c.telegram_id == locked.c.telegram_id,
+            entries.c.applied_at.is_(None),
+        )
+        .values(applied_at=datetime.utcnow())
+        .returning(entries.c.telegram_id, entries.c.delta, entries.c.lane, entries.c.entry_type)
+        .cte("folded")
+    )
+    return (
+        select(folded.c.telegram_id, *ledger_totals(folded))
+        .group_by(folded.c.telegram_id)
+        .cte("folded_totals")
+    )
+
+
+@dataclass
+class LedgerMismatch:
+    """Расхождение счётчиков пользователя с журналом"""
+    telegram_id: int
+    # (available, paid, promo, referral) в users и по журналу
+    projected: tuple
+    expected: tuple
+
+
+class GenerationLedgerRepository:
+    """Класс для работы с журналом движений генераций в БД"""
+
+    def __init__(self, session: AsyncSession):
+        """
+        Инициализация репозитория
+
+        Args:
+            session: Сессия БД
+        """
+        self.session = session
+
+    async def apply_pending(
+        self, limit: int, telegram_id: Optional[int] = None, skip_locked: bool = True
+    ) -> int:
+        """
+        Перенести не применённые записи журнала в счётчики users
+
+        Один запрос на пачку пользователей. Пользователи, чья строка сейчас
+        заблокирована (идёт списание или другой перенос), пропускаются до
+        следующего вызова
+
+        Args:
+            limit: Максимум пользователей за вызов
+            telegram_id: Перенести записи только этого пользователя
+            skip_locked: False - дождаться блокировки строки, а не пропускать её
+
+        Returns:
+            Количество обновлённых пользователей
+        """
+        entries = GenerationLedgerEntry.__table__
+        pending_users = (
+            select(entries.c.telegram_id)
+            .where(entries.c.applied_at.is_(None))
+            .distinct()
+            .limit(limit)
+        )
+        if telegram_id is not None:
+            pending_users = pending_users.where(entries.c.telegram_id == telegram_id)
+        locked = (
+            select(
+                User.id,
+                User.telegram_id,
+                User.available_generation,
+                User.paid_generation,
+                User.promo_generation,
+                User.referral_generation,
+            )
+            .where(User.telegram_id.in_(pending_users))
+            .with_for_update(skip_locked=skip_locked)
+            .cte("locked")
+        )
+        totals = fold_pending(locked)
+        projected = (
+            update(User)
+            .where(User.id == locked.c.id, totals.c.telegram_id == locked.c.telegram_id)
+            .values(
+                available_generation=locked.c.available_generation + totals.c.total,
+                paid_generation=locked.c.paid_generation + totals.c.paid,
+                promo_generation=locked.c.promo_generation + totals.c.promo,
+                referral_generation=locked.c.referral_generation + totals.c.referral,
+            )
+            .returning(User.telegram_id)
+            .cte("projected")
+        )
+
+        result = await self.session.execute(select(func.count()).select_from(projected))
+        count = result.scalar_one()
+        if count:
+            logger.debug(f"Перенесены записи журнала генераций: {count} пользователей")
+        return count
+
+    async def count_pending(self) -> int:
+        """Количество записей журнала, ещё не перенесённых в users"""
+        result = await self.session.execute(
+            select(func.count())
+            .select_from(GenerationLedgerEntry)
+            .where(GenerationLedgerEntry.applied_at.is_(None))
+        )
+        return result.scalar_one()
+
+    async def reconcile(self, limit: int = 100) -> List[LedgerMismatch]:
+        """
+        Сверить счётчики users с суммами перенесённых записей журнала
+
+        Args:
+            limit: Максимум расхождений в ответе
+
+        Returns:
+            Список расхождений (пустой, если проекция сходится)
+        """
+        entries = GenerationLedgerEntry.__table__
+        applied = (
+            select(entries.c.telegram_id, *ledger_totals(entries))
+            .where(entries.c.applied_at.isnot(None))
+            .group_by(entries.c.telegram_id)
+            .subquery("applied")
+        )
+        expected = (
+            func.coalesce(applied.c.total, 0),
+            func.coalesce(applied.c.paid, 0),
+            func.coalesce(applied.c.promo, 0),
+            func.coalesce(applied.c.referral, 0),
+        )
+        projected = (
+            User.available_generation,
+            User.paid_generation,
+            User.promo_generation,
+            User.referral_generation,
+        )
+
+        result = await self.session.execute(
+            select(User.telegram_id, *projected, *expected)
+            .outerjoin(applied, applied.c.telegram_id == User.telegram_id)
+            .where(or_(*(column != total for column, total in zip(projected, expected))))
+            .limit(limit)
+        )
+        return [
+            LedgerMismatch(telegram_id=row[0], projected=tuple(row[1:5]), expected=tuple(row[5:9]))
+            for row in result.all()
+        ]
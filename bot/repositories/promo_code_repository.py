@@ -9,6 +9,7 @@ from sqlalchemy.ext.asyncio import AsyncSession
 
 from bot.models.promo_code import PromoCode, PromoCodeUsage
 from bot.models.user import User
+from bot.repositories.user_repository import UserRepository
 from bot.logger import logger
 
 
@@ -117,8 +118,14 @@ class PromoCodeRepository:
                 )
                 return False, "already_used"
 
-            # Начисляем генерации
-            user.available_generation += promo_code.generation
+            # Начисляем генерации записью в журнал (строку пользователя не трогаем)
+            await UserRepository(self.session).update_generations(
+                user_telegram_id,
+                promo_code.generation,
+                lane="promo",
+                entry_type="promo",
+                source_id=str(promo_code.id),
+            )
 
             # Увеличиваем счетчик использований
             promo_code.usage_count += 1
@@ -1,11 +1,354 @@
 """Репозиторий для работы с пользователями"""
-from typing import Optional
-
-from sqlalchemy import select, update
-from sqlalchemy.ext.asyncio import AsyncSession
-
+import asyncio
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional, Tuple
+
+from sqlalchemy import (
+    String,
+    and_,
+    case,
+    event,
+    func,
+    literal,
+    literal_column,
+    or_,
+    select,
+    true,
+    update,
+)
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+from sqlalchemy.orm import Session
+
+from bot.config import UserCacheConfig, config
+from bot.models.generation_ledger import GenerationLedgerEntry
 from bot.models.user import User
+from bot.repositories.generation_ledger_repository import (
+    GenerationLedgerRepository,
+    ledger_totals,
+)
 from bot.logger import logger
+from bot.services.metrics import metrics
+
+user_cache_total = metrics.counter(
+    "user_cache_total", "Поиск снимка пользователя в кеше: hit, miss"
+)
+user_cache_invalidations_total = metrics.counter(
+    "user_cache_invalidations_total",
+    "Сброшенные записи кеша пользователей: local - изменение в этом процессе, "
+    "notify - в другом процессе, reconnect - переподключение LISTEN",
+)
+
+# Ключ в session.info со списком пользователей, изменённых в транзакции
+_CHANGED_KEY = "user_cache_changed"
+
+# Пауза перед переподключением LISTEN и период проверки соединения, секунды
+LISTEN_RECONNECT_DELAY = 5.0
+LISTEN_PING_INTERVAL = 30.0
+
+# Попыток списания: повтор нужен, только если у пользователя есть не
+# перенесённые записи журнала или строку изменили во время списания
+SPEND_ATTEMPTS = 5
+
+
+class SpendContendedError(Exception):
+    """Генерация не списана: строку пользователя всё время меняли конкурентно"""
+
+
+@dataclass(frozen=True)
+class UserSnapshot:
+    """Часто используемые поля пользователя без ORM-объекта"""
+    telegram_id: int
+    available_generation: int
+    paid_generation: int
+    promo_generation: int
+    referral_generation: int
+    referral_telegram_id: Optional[int]
+    is_admin: bool
+
+    @property
+    def spend_lane(self) -> str:
+        """Класс, из которого будет списана следующая генерация"""
+        if self.paid_generation > 0:
+            return "paid"
+        if self.promo_generation > 0:
+            return "promo"
+        return "free"
+
+
+def snapshot_query(telegram_id: int, added=None):
+    """
+    Запрос снимка пользователя: счётчики users плюс не перенесённые записи журнала
+
+    Args:
+        telegram_id: Telegram ID пользователя
+        added: CTE с записями, добавленными этим же запросом (их ещё не видно
+            в таблице журнала); число добавленных - в последней колонке
+
+    Returns:
+        Select с колонками в порядке полей UserSnapshot
+    """
+    entries = GenerationLedgerEntry.__table__
+    pending = (
+        select(*ledger_totals(entries))
+        .where(entries.c.telegram_id == telegram_id, entries.c.applied_at.is_(None))
+        .subquery("pending")
+    )
+    sums = [pending]
+    if added is not None:
+        sums.append(select(*ledger_totals(added)).subquery("added"))
+
+    def total(column, name: str):
+        value = column
+        for subquery in sums:
+            value = value + subquery.c[name]
+        return value.label(column.key)
+
+    query = select(
+        User.telegram_id,
+        total(User.available_generation, "total"),
+        total(User.paid_generation, "paid"),
+        total(User.promo_generation, "promo"),
+        total(User.referral_generation, "referral"),
+        User.referral_telegram_id,
+        User.is_admin,
+    )
+    source = User.__table__
+    for subquery in sums:
+        source = source.join(subquery, true())
+    query = query.select_from(source)
+    if added is not None:
+        query = query.add_columns(sums[-1].c.entries)
+    return query.where(User.telegram_id == telegram_id)
+
+
+def spend_statement(telegram_id: int):
+    """
+    Запрос списания одной генерации
+
+    Условный UPDATE users с записью spend в журнале. Класс списания (paid,
+    promo, free) определяется по счётчикам строки до изменения; если строку
+    успели изменить, условие на них не выполнится и запрос ничего не вернёт.
+    Пока у пользователя есть не перенесённые записи журнала, запрос тоже ничего
+    не возвращает: иначе оплаченная генерация была бы списана как бесплатная
+
+    Returns:
+        Select с колонками new_balance и lane (ни одной строки, если списать
+        не удалось)
+    """
+    before = (
+        select(User.paid_generation, User.promo_generation)
+        .where(User.telegram_id == telegram_id)
+        .cte("before")
+    )
+    lane = case(
+        (before.c.paid_generation > 0, "paid"),
+        (before.c.promo_generation > 0, "promo"),
+        else_="free",
+    )
+    entries = GenerationLedgerEntry.__table__
+    pending = select(entries.c.id).where(
+        entries.c.telegram_id == telegram_id, entries.c.applied_at.is_(None)
+    )
+    spent = (
+        update(User)
+        .where(
+            User.telegram_id == telegram_id,
+            User.available_generation > 0,
+            User.paid_generation == before.c.paid_generation,
+            User.promo_generation == before.c.promo_generation,
+            ~pending.exists(),
+        )
+        .values(
+            available_generation=User.available_generation - 1,
+            paid_generation=User.paid_generation - case(
+                (User.paid_generation > 0, 1), else_=0
+            ),
+            promo_generation=User.promo_generation - case(
+                (and_(User.paid_generation <= 0, User.promo_generation > 0), 1), else_=0
+            ),
+        )
+        .returning(User.available_generation.label("new_balance"), lane.label("lane"))
+        .cte("spent")
+    )
+    now = datetime.utcnow()
+    entry = (
+        insert(entries)
+        .from_select(
+            ["telegram_id", "entry_type", "delta", "lane", "created_at", "applied_at"],
+            select(
+                literal(telegram_id),
+                literal("spend", String),
+                literal(-1),
+                spent.c.lane,
+                literal(now),
+                literal(now),
+            ),
+        )
+        .returning(entries.c.id)
+        .cte("entry")
+    )
+    return select(spent.c.new_balance, spent.c.lane).add_cte(entry)
+
+
+class UserCache:
+    """
+    Кеш снимков пользователей в памяти процесса (TTL + LRU)
+
+    Изменяющие пользователя методы репозиториев вызывают changed: запись
+    сбрасывается сразу и ещё раз после фиксации или отката транзакции, а при
+    notify изменение публикуется через NOTIFY в той же транзакции (Postgres
+    доставит его только после COMMIT). Чтение, начатое до сброса, в кеш не
+    попадает - см. epoch
+    """
+
+    def __init__(self, settings: UserCacheConfig):
+        self.settings = settings
+        self._entries: "OrderedDict[int, Tuple[UserSnapshot, float]]" = OrderedDict()
+        # Растёт при каждом сбросе: снимок, прочитанный до сброса, устарел
+        self._epoch = 0
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def epoch(self) -> int:
+        """Метка для put: запоминается перед чтением из БД"""
+        return self._epoch
+
+    def get(self, telegram_id: int) -> Optional[UserSnapshot]:
+        """
+        Снимок пользователя из кеша
+
+        Returns:
+            UserSnapshot или None, если записи нет или она устарела
+        """
+        if not self.settings.enabled:
+            return None
+
+        entry = self._entries.get(telegram_id)
+        if entry is None or entry[1] <= time.monotonic():
+            user_cache_total.inc(result="miss")
+            return None
+
+        self._entries.move_to_end(telegram_id)
+        user_cache_total.inc(result="hit")
+        return entry[0]
+
+    def put(self, snapshot: UserSnapshot, epoch: int):
+        """
+        Сохранить снимок, прочитанный из БД
+
+        Args:
+            snapshot: Снимок пользователя
+            epoch: Значение epoch до начала чтения
+        """
+        if not self.settings.enabled or epoch != self._epoch:
+            return
+
+        self._entries[snapshot.telegram_id] = (snapshot, time.monotonic() + self.settings.ttl)
+        self._entries.move_to_end(snapshot.telegram_id)
+        while len(self._entries) > self.settings.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, telegram_id: int, source: str = "local"):
+        """Сбросить запись пользователя"""
+        self._epoch += 1
+        if self._entries.pop(telegram_id, None) is not None:
+            user_cache_invalidations_total.inc(source=source)
+
+    def clear(self, source: str = "reconnect"):
+        """Сбросить весь кеш"""
+        self._epoch += 1
+        if self._entries:
+            user_cache_invalidations_total.inc(len(self._entries), source=source)
+            self._entries.clear()
+
+    async def changed(self, session: AsyncSession, telegram_id: int):
+        """
+        Отметить изменение пользователя в транзакции сессии
+
+        Args:
+            session: Сессия, в которой изменён пользователь
+            telegram_id: Telegram ID пользователя
+        """
+        if not self.settings.enabled:
+            return
+
+        self.invalidate(telegram_id)
+        session.info.setdefault(_CHANGED_KEY, set()).add(telegram_id)
+        if self.settings.notify:
+            await session.execute(
+                select(func.pg_notify(self.settings.channel, str(telegram_id)))
+            )
+
+    def _after_transaction(self, session: Session):
+        """Сбросить записи изменённых пользователей (событие сессии SQLAlchemy)"""
+        for telegram_id in session.info.pop(_CHANGED_KEY, ()):
+            self.invalidate(telegram_id)
+
+    def _on_notify(self, connection, pid: int, channel: str, payload: str):
+        try:
+            telegram_id = int(payload)
+        except ValueError:
+            logger.warning(f"Некорректное уведомление кеша пользователей: {payload!r}")
+            return
+        self.invalidate(telegram_id, source="notify")
+
+    async def start(self, engine: AsyncEngine):
+        """Начать слушать изменения из других процессов (при notify)"""
+        if self.settings.enabled and self.settings.notify and self._task is None:
+            self._task = asyncio.create_task(self._listen_loop(engine))
+
+    async def stop(self):
+        """Остановить прослушивание"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _listen_loop(self, engine: AsyncEngine):
+        channel = self.settings.channel
+        while True:
+            try:
+                async with engine.connect() as connection:
+                    raw_connection = await connection.get_raw_connection()
+                    driver_connection = raw_connection.driver_connection
+                    lost = asyncio.Event()
+                    driver_connection.add_termination_listener(lambda _: lost.set())
+                    await driver_connection.add_listener(channel, self._on_notify)
+                    # Пока LISTEN не работал, уведомления могли пройти мимо
+                    self.clear()
+                    logger.info(f"Кеш пользователей слушает канал {channel}")
+                    try:
+                        while not lost.is_set():
+                            try:
+                                await asyncio.wait_for(lost.wait(), LISTEN_PING_INTERVAL)
+                            except asyncio.TimeoutError:
+                                # Обрыв сети без закрытия соединения сам не заметен
+                                await driver_connection.fetchval("SELECT 1")
+                    finally:
+                        if not driver_connection.is_closed():
+                            await driver_connection.remove_listener(channel, self._on_notify)
+                logger.warning("Соединение LISTEN кеша пользователей закрыто")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка LISTEN кеша пользователей: {e}")
+
+            self.clear()
+            await asyncio.sleep(LISTEN_RECONNECT_DELAY)
+
+
+# Глобальный экземпляр кеша пользователей
+user_cache = UserCache(config.user_cache)
+event.listen(Session, "after_commit", user_cache._after_transaction)
+event.listen(Session, "after_rollback", user_cache._after_transaction)
 
 
 class UserRepository:
@@ -42,182 +385,332 @@ class UserRepository:
 
         return user
 
-    async def create_user(
+    async def get_snapshot(self, telegram_id: int) -> Optional[UserSnapshot]:
+        """
+        Получить снимок пользователя одним запросом только нужных колонок
+
+        Баланс включает начисления журнала, ещё не перенесённые в users
+
+        Args:
+            telegram_id: Telegram ID пользователя
+
+        Returns:
+            UserSnapshot или None, если пользователь не найден
+        """
+        result = await self.session.execute(snapshot_query(telegram_id))
+        row = result.one_or_none()
+        return UserSnapshot(*row) if row is not None else None
+
+    async def get_cached_snapshot(self, telegram_id: int) -> Optional[UserSnapshot]:
+        """
+        Получить снимок пользователя из кеша или из БД
+
+        Не для транзакций, изменяющих пользователя: там нужен get_snapshot
+
+        Args:
+            telegram_id: Telegram ID пользователя
+
+        Returns:
+            UserSnapshot или None, если пользователь не найден
+        """
+        snapshot = user_cache.get(telegram_id)
+        if snapshot is not None:
+            return snapshot
+
+        epoch = user_cache.epoch
+        snapshot = await self.get_snapshot(telegram_id)
+        if snapshot is not None:
+            user_cache.put(snapshot, epoch)
+        return snapshot
+
+    async def register_user(
         self,
         telegram_id: int,
         first_name: str,
         last_name: Optional[str] = None,
         username: Optional[str] = None,
-        referral_telegram_id: Optional[int] = None,
+        referrer_telegram_id: Optional[int] = None,
         initial_generations: int = 0,
-    ) -> User:
+        referral_bonus: int = 0,
+    ) -> tuple[bool, Optional[int]]:
         """
-        Создать нового пользователя
+        Зарегистрировать пользователя по /start одним запросом
+
+        INSERT ... ON CONFLICT по telegram_id: новый пользователь создаётся
+        вместе с записью журнала о начальных генерациях и бонусом
+        пригласившему (запись журнала, строка пригласившего не блокируется).
+        У зарегистрированного пользователя обновляются изменившиеся имя,
+        фамилия и username. Одновременные /start не приводят к ошибке
+        уникальности
 
         Args:
             telegram_id: Telegram ID
             first_name: Имя
             last_name: Фамилия (опционально)
             username: Username (опционально)
-            referral_telegram_id: ID пригласившего (опционально)
+            referrer_telegram_id: ID пригласившего из реферальной ссылки;
+                сохраняется, только если такой пользователь существует
             initial_generations: Начальное количество генераций
+            referral_bonus: Бонус пригласившему
 
         Returns:
-            Созданный пользователь
+            Кортеж (создан_ли_пользователь, кому_начислен_реферальный_бонус)
         """
-        user = User(
+        now = datetime.utcnow()
+        entries = GenerationLedgerEntry.__table__
+
+        referrer = None
+        if referrer_telegram_id is not None and referrer_telegram_id != telegram_id:
+            referrer = (
+                select(User.telegram_id)
+                .where(User.telegram_id == referrer_telegram_id)
+                .scalar_subquery()
+            )
+
+        statement = insert(User).values(
+            id=uuid.uuid4(),
             telegram_id=telegram_id,
             first_name=first_name,
             last_name=last_name,
             username=username,
-            referral_telegram_id=referral_telegram_id,
+            referral_telegram_id=referrer,
             available_generation=initial_generations,
+            paid_generation=0,
+            promo_generation=0,
+            referral_generation=0,
+            created_at=now,
+            is_admin=False,
         )
-
-        self.session.add(user)
-        await self.session.flush()
-
-        logger.info(
-            f"Создан пользователь: {telegram_id} (@{username}), "
-            f"реферал: {referral_telegram_id}"
+        excluded = statement.excluded
+        registered = (
+            statement.on_conflict_do_update(
+                index_elements=[User.telegram_id],
+                set_={
+                    "first_name": excluded.first_name,
+                    "last_name": excluded.last_name,
+                    "username": excluded.username,
+                },
+                # Без изменений строка не перезаписывается и не возвращается
+                where=or_(
+                    User.first_name.is_distinct_from(excluded.first_name),
+                    User.last_name.is_distinct_from(excluded.last_name),
+                    User.username.is_distinct_from(excluded.username),
+                ),
+            )
+            # xmax = 0 только у вставленной, а не обновлённой строки
+            .returning(
+                User.telegram_id,
+                User.referral_telegram_id,
+                literal_column("xmax = 0").label("created"),
+            )
+            .cte("registered")
         )
 
-        return user
-
-    async def update_generations(self, telegram_id: int, delta: int) -> bool:
-        """
-        Обновить количество доступных генераций
+        ledger_ctes = []
+        if initial_generations:
+            ledger_ctes.append(
+                insert(entries)
+                .from_select(
+                    ["telegram_id", "entry_type", "delta", "lane", "created_at", "applied_at"],
+                    select(
+                        registered.c.telegram_id,
+                        literal("initial", String),
+                        literal(initial_generations),
+                        literal("free", String),
+                        literal(now),
+                        literal(now),
+                    ).where(registered.c.created),
+                )
+                .returning(entries.c.id)
+                .cte("initial")
+            )
 
-        Args:
-            telegram_id: Telegram ID пользователя
-            delta: Изменение количества генераций (может быть отрицательным)
+        credited = literal(0)
+        if referral_bonus:
+            bonus = (
+                insert(entries)
+                .from_select(
+                    ["telegram_id", "entry_type", "delta", "lane", "source_id", "created_at"],
+                    select(
+                        registered.c.referral_telegram_id,
+                        literal("referral", String),
+                        literal(referral_bonus),
+                        literal("promo", String),
+                        literal(str(telegram_id), String),
+                        literal(now),
+                    ).where(registered.c.created, registered.c.referral_telegram_id.isnot(None)),
+                )
+                .on_conflict_do_nothing(
+                    index_elements=["telegram_id", "entry_type", "source_id"],
+                    index_where=entries.c.source_id.isnot(None),
+                )
+                .returning(entries.c.telegram_id)
+                .cte("bonus")
+            )
+            credited = select(func.count()).select_from(bonus).scalar_subquery()
 
-        Returns:
-            True, если обновление прошло успешно
-        """
         result = await self.session.execute(
-            update(User)
-            .where(User.telegram_id == telegram_id)
-            .values(available_generation=User.available_generation + delta)
+            select(
+                registered.c.created,
+                registered.c.referral_telegram_id,
+                credited.label("credited"),
+            ).add_cte(*ledger_ctes)
         )
+        row = result.one_or_none()
 
-        if result.rowcount > 0:
-            logger.info(
-                f"Обновлены генерации для {telegram_id}: "
-                f"{'+'if delta >= 0 else ''}{delta}"
-            )
-            return True
-
-        logger.warning(f"Не удалось обновить генерации для {telegram_id}")
-        return False
-
-    async def add_referral_bonus(
-        self, referrer_telegram_id: int, bonus_generations: int
-    ) -> bool:
-        """
-        Начислить бонус за реферала
+        if row is None:
+            logger.debug(f"Пользователь уже зарегистрирован: {telegram_id}")
+            return False, None
 
-        Args:
-            referrer_telegram_id: Telegram ID пригласившего пользователя
-            bonus_generations: Количество бонусных генераций
+        if not row.created:
+            logger.info(f"Обновлены имя и username пользователя {telegram_id} (@{username})")
+            return False, None
 
-        Returns:
-            True, если начисление прошло успешно
-        """
-        result = await self.session.execute(
-            update(User)
-            .where(User.telegram_id == referrer_telegram_id)
-            .values(
-                available_generation=User.available_generation + bonus_generations,
-                referral_generation=User.referral_generation + bonus_generations,
-            )
+        logger.info(
+            f"Создан пользователь: {telegram_id} (@{username}), "
+            f"реферал: {row.referral_telegram_id}"
         )
 
-        if result.rowcount > 0:
-            logger.info(
-                f"Начислен реферальный бонус {referrer_telegram_id}: "
-                f"+{bonus_generations} генераций"
-            )
-            return True
+        if not row.credited:
+            return True, None
 
-        logger.warning(
-            f"Не удалось начислить реферальный бонус для {referrer_telegram_id}"
+        await user_cache.changed(self.session, row.referral_telegram_id)
+        logger.info(
+            f"Начислен реферальный бонус {row.referral_telegram_id}: "
+            f"+{referral_bonus} генераций"
         )
-        return False
-
-    async def get_user_balance(self, telegram_id: int) -> Optional[int]:
-        """
-        Получить баланс генераций пользователя
+        return True, row.referral_telegram_id
 
-        Args:
-            telegram_id: Telegram ID пользователя
-
-        Returns:
-            Количество доступных генераций или None
+    async def update_generations(
+        self,
+        telegram_id: int,
+        delta: int,
+        lane: str = "free",
+        entry_type: str = "adjustment",
+        source_id: Optional[str] = None,
+    ) -> Optional[UserSnapshot]:
         """
-        user = await self.get_user_by_telegram_id(telegram_id)
-        return user.available_generation if user else None
+        Начислить (или списать) генерации записью в журнал
 
-    async def get_referral_stats(self, telegram_id: int) -> Optional[int]:
-        """
-        Получить статистику рефералов
+        Строка пользователя не блокируется и не изменяется: запись переносится
+        в счётчики users позже (фоновое проецирование или ближайшее списание).
+        Повторная запись с тем же entry_type и source_id игнорируется, поэтому
+        один платёж или возврат не начисляется дважды
 
         Args:
             telegram_id: Telegram ID пользователя
+            delta: Изменение количества генераций (может быть отрицательным)
+            lane: Источник генераций: paid (оплата), promo (промокод, бонус)
+                или free. Определяет приоритет задач при их списании
+            entry_type: Вид записи журнала (см. ENTRY_TYPES)
+            source_id: Платёж, задача, приглашённый пользователь или промокод
 
         Returns:
-            Количество генераций, полученных от рефералов, или None
+            Снимок пользователя с учётом записи или None, если пользователь
+            не найден
         """
-        user = await self.get_user_by_telegram_id(telegram_id)
-        return user.referral_generation if user else None
+        entries = GenerationLedgerEntry.__table__
+        added = (
+            insert(entries)
+            .from_select(
+                ["telegram_id", "entry_type", "delta", "lane", "source_id", "created_at"],
+                select(
+                    User.telegram_id,
+                    literal(entry_type, String),
+                    literal(delta),
+                    literal(lane, String),
+                    literal(source_id, String),
+                    literal(datetime.utcnow()),
+                ).where(User.telegram_id == telegram_id),
+            )
+            .on_conflict_do_nothing(
+                index_elements=["telegram_id", "entry_type", "source_id"],
+                index_where=entries.c.source_id.isnot(None),
+            )
+            .returning(entries.c.delta, entries.c.lane, entries.c.entry_type)
+            .cte("added")
+        )
+        result = await self.session.execute(snapshot_query(telegram_id, added))
+        row = result.one_or_none()
 
-    async def has_referred_by(self, telegram_id: int) -> bool:
-        """
-        Проверить, был ли пользователь приглашен кем-то
+        if row is None:
+            logger.warning(f"Не удалось обновить генерации для {telegram_id}")
+            return None
 
-        Args:
-            telegram_id: Telegram ID пользователя
+        snapshot = UserSnapshot(*row[:-1])
+        if not row[-1]:
+            logger.info(f"Запись {entry_type} {source_id} для {telegram_id} уже в журнале")
+            return snapshot
 
-        Returns:
-            True, если пользователь был приглашен
-        """
-        user = await self.get_user_by_telegram_id(telegram_id)
-        return user.referral_telegram_id is not None if user else False
+        await user_cache.changed(self.session, telegram_id)
+        logger.info(
+            f"Обновлены генерации для {telegram_id} ({entry_type}): "
+            f"{'+'if delta >= 0 else ''}{delta}, баланс {snapshot.available_generation}"
+        )
+        return snapshot
 
-    async def try_spend_generation(self, telegram_id: int) -> tuple[bool, Optional[int]]:
+    async def try_spend_generation(
+        self, telegram_id: int
+    ) -> tuple[bool, Optional[int], Optional[str]]:
         """
         Атомарно проверить баланс и списать одну генерацию
 
+        Изменение фиксируется вместе с транзакцией сессии, чтобы вызывающий код
+        мог в той же транзакции поставить задачу генерации в очередь.
+        Сначала списываются купленные генерации, затем промо, затем бесплатные.
+
+        Списание - один условный UPDATE ... WHERE available_generation > 0
+        RETURNING, блокировку строки берёт сам UPDATE; в журнал тем же запросом
+        добавляется уже перенесённая запись spend. Записи журнала, ещё не
+        перенесённые в users, списание не трогает: если они есть, их переносит
+        проецирование (GenerationLedgerRepository.apply_pending) и списание
+        повторяется
+
         Args:
             telegram_id: Telegram ID пользователя
 
         Returns:
-            Кортеж (успешно_ли_списано, новый_баланс_или_текущий)
-            - (True, new_balance) - успешно списано
-            - (False, current_balance) - недостаточно генераций (0 или больше)
-            - (False, None) - пользователь не найден
-        """
-        # Используем SELECT FOR UPDATE для блокировки строки
-        # Это предотвращает race condition при параллельных запросах
-        result = await self.session.execute(
-            select(User)
-            .where(User.telegram_id == telegram_id)
-            .with_for_update()  # Блокируем строку для обновления
-        )
-        user = result.scalar_one_or_none()
+            Кортеж (успешно_ли_списано, новый_баланс_или_текущий, класс_приоритета)
+            - (True, new_balance, lane) - успешно списано
+            - (False, current_balance, None) - недостаточно генераций (0 или больше)
+            - (False, None, None) - пользователь не найден
 
-        if not user:
-            logger.warning(f"Пользователь не найден: {telegram_id}")
-            return False, None
-
-        # Проверяем баланс
-        if user.available_generation <= 0:
-            logger.info(f"Недостаточно генераций у {telegram_id}: {user.available_generation}")
-            return False, user.available_generation
-
-        # Списываем генерацию
-        user.available_generation -= 1
-        await self.session.commit()
+        Raises:
+            SpendContendedError: Баланс есть, но списать за SPEND_ATTEMPTS не удалось
+        """
+        current = 0
+        for attempt in range(1, SPEND_ATTEMPTS + 1):
+            row = (await self.session.execute(spend_statement(telegram_id))).one_or_none()
+            if row is not None:
+                await user_cache.changed(self.session, telegram_id)
+                logger.info(
+                    f"Списана генерация ({row.lane}) у {telegram_id}: "
+                    f"новый баланс {row.new_balance}"
+                )
+                return True, row.new_balance, row.lane
+
+            # Отдельное чтение только когда списать не удалось
+            snapshot = await self.get_snapshot(telegram_id)
+            if snapshot is None:
+                logger.warning(f"Пользователь не найден: {telegram_id}")
+                return False, None, None
+
+            current = snapshot.available_generation
+            if current <= 0:
+                logger.info(f"Недостаточно генераций у {telegram_id}: {current}")
+                return False, current, None
+
+            if attempt == SPEND_ATTEMPTS:
+                break
+            # Баланс есть: записи ещё не перенесены из журнала или строку
+            # изменили во время списания. Перед последней попыткой ждём
+            # блокировку, чтобы не уступать её проецированию снова
+            await GenerationLedgerRepository(self.session).apply_pending(
+                1, telegram_id, skip_locked=attempt < SPEND_ATTEMPTS - 1
+            )
 
-        logger.info(f"Списана генерация у {telegram_id}: новый баланс {user.available_generation}")
-        return True, user.available_generation
+        logger.warning(
+            f"Не удалось списать генерацию у {telegram_id} за {SPEND_ATTEMPTS} попыток, "
+            f"баланс {current}"
+        )
+        raise SpendContendedError(f"Баланс {telegram_id} меняется конкурентно")
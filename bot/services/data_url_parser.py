@@ -0,0 +1,146 @@
+"""Потоковый разбор base64 data URL изображения из JSON-ответа"""
+import base64
+import binascii
+import re
+from typing import Optional
+
+# Начало data URL изображения внутри JSON-строки ("/" может быть экранирован)
+_DATA_URL_RE = re.compile(rb"data:image\\?/([A-Za-z0-9.+-]+);base64,")
+
+# Максимальная длина маркера data:image/<тип>;base64,
+_WINDOW_SIZE = 96
+
+# Сколько байт JSON вне изображения сохранять для диагностики
+TEXT_LIMIT = 64 * 1024
+
+
+class ImageDataURLParser:
+    """
+    Инкрементальный поиск и декодирование data:image/...;base64,... в потоке
+
+    Тело ответа подаётся кусками через feed(). Base64 декодируется по мере
+    поступления прямо в один выходной буфер, поэтому многомегабайтный ответ
+    не хранится целиком ни в виде bytes, ни в виде разобранного JSON
+    """
+
+    def __init__(self, text_limit: int = TEXT_LIMIT):
+        self.text_limit = text_limit
+        self.mime_type: Optional[str] = None
+        self.image = bytearray()
+        self.text = bytearray()
+        self.peak_bytes = 0
+        self._window = b""
+        self._pending = bytearray()
+        self._escape: Optional[bytes] = None
+        self._state = "search"
+
+    @property
+    def found(self) -> bool:
+        """Найдено ли начало изображения"""
+        return self._state != "search"
+
+    @property
+    def complete(self) -> bool:
+        """Изображение прочитано до закрывающей кавычки"""
+        return self._state == "done"
+
+    def _keep_text(self, data: bytes):
+        free = self.text_limit - len(self.text)
+        if free > 0:
+            self.text += data[:free]
+
+    def feed(self, chunk: bytes):
+        """Обработать очередной кусок тела ответа"""
+        if self._state == "search":
+            data = self._window + chunk
+            match = _DATA_URL_RE.search(data)
+            if match is None:
+                # Храним хвост на случай, если маркер разрезан между кусками
+                if len(data) > _WINDOW_SIZE:
+                    self._keep_text(data[:-_WINDOW_SIZE])
+                    self._window = data[-_WINDOW_SIZE:]
+                else:
+                    self._window = data
+                self._track_peak()
+                return
+
+            self._keep_text(data[: match.start()])
+            self.mime_type = "image/" + match.group(1).decode("ascii")
+            self._window = b""
+            self._state = "data"
+            chunk = data[match.end():]
+
+        if self._state == "data":
+            end = chunk.find(b'"')
+            if end == -1:
+                self._consume_base64(chunk)
+            else:
+                self._consume_base64(chunk[:end])
+                self._flush(final=True)
+                self._state = "done"
+                self._keep_text(chunk[end:])
+            self._track_peak()
+            return
+
+        # После изображения остаётся только хвост JSON
+        self._keep_text(chunk)
+
+    def close(self):
+        """Завершить разбор после окончания потока"""
+        if self._state == "search" and self._window:
+            self._keep_text(self._window)
+            self._window = b""
+
+    def _consume_base64(self, data: bytes):
+        """Добавить base64-символы, раскрывая JSON-экранирование"""
+        if self._escape is not None:
+            data = self._escape + data
+            self._escape = None
+
+        if b"\\" in data:
+            cleaned = bytearray()
+            index = 0
+            while index < len(data):
+                byte = data[index:index + 1]
+                if byte != b"\\":
+                    cleaned += byte
+                    index += 1
+                    continue
+                if index + 1 >= len(data):
+                    self._escape = data[index:]
+                    break
+                escaped = data[index + 1:index + 2]
+                if escaped == b"u":
+                    if index + 6 > len(data):
+                        self._escape = data[index:]
+                        break
+                    index += 6
+                    continue
+                if escaped == b"/":
+                    cleaned += b"/"
+                # \n, \r, \t и прочие переносы внутри base64 пропускаем
+                index += 2
+            data = bytes(cleaned)
+
+        self._pending += data
+        self._flush()
+
+    def _flush(self, final: bool = False):
+        """Декодировать накопленный base64 кратно 4 символам"""
+        if final:
+            usable = len(self._pending)
+        else:
+            usable = len(self._pending) - len(self._pending) % 4
+        if usable <= 0:
+            return
+
+        try:
+            self.image += base64.b64decode(bytes(self._pending[:usable]))
+        except binascii.Error as e:
+            raise ValueError(f"Некорректный base64 в ответе: {e}") from e
+        del self._pending[:usable]
+
+    def _track_peak(self):
+        held = len(self._window) + len(self._pending) + len(self.image) + len(self.text)
+        if held > self.peak_bytes:
+            self.peak_bytes = held
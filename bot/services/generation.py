@@ -0,0 +1,488 @@
+"""Сервис выполнения задач генерации из очереди"""
+import asyncio
+import dataclasses
+import hashlib
+import time
+from typing import Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.types import BufferedInputFile
+
+from bot.config import config
+from bot.database import get_db_session
+from bot.keyboards import get_main_menu_keyboard
+from bot.logger import logger
+from bot.models.generation_job import GenerationJob
+from bot.repositories.generation_job_repository import GenerationJobRepository
+from bot.repositories.user_repository import UserRepository
+from bot.services.openrouter import GeneratedImage, openrouter_service
+from bot.services import stage_timer
+from bot.services.metrics import metrics
+from bot.services.result_cache import result_cache
+from bot.services.result_store import result_store
+from bot.services.single_flight import SingleFlight
+
+queue_wait_seconds = metrics.histogram(
+    "generation_queue_wait_seconds",
+    "Время ожидания задачи в очереди до взятия воркером по классам приоритета",
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600),
+)
+upload_seconds = metrics.histogram(
+    "telegram_upload_seconds",
+    "Время отправки сгенерированного изображения файлом в Telegram",
+    buckets=(0.1, 0.25, 0.5, 1, 2, 3, 5, 10, 20),
+)
+upload_bytes = metrics.histogram(
+    "telegram_upload_bytes",
+    "Размер сгенерированного изображения, загруженного в Telegram",
+    buckets=(100_000, 250_000, 500_000, 1_000_000, 2_000_000, 5_000_000, 10_000_000),
+)
+delivery_attempts_total = metrics.counter(
+    "generation_delivery_attempts_total",
+    "Попытки отправки результата пользователю: success, retry, failed",
+)
+
+GENERATION_FAILED_MESSAGE = (
+    "😞 <b>Не удалось создать ретро фотографию</b>\n\n"
+    "К сожалению, произошла ошибка при генерации изображения.\n\n"
+    "✅ <b>Хорошая новость:</b> генерация возвращена на твой баланс!\n\n"
+    "🔄 Попробуй отправить фото ещё раз или выбери другую фотографию.\n\n"
+    "💡 <b>Рекомендации для лучшего результата:</b>\n"
+    "• Используй чёткие фотографии с хорошим освещением\n"
+    "• Лица должны быть хорошо видны\n"
+    "• Избегай слишком тёмных или размытых снимков"
+)
+
+UNEXPECTED_ERROR_MESSAGE = (
+    "⚠️ <b>Произошла непредвиденная ошибка</b>\n\n"
+    "Не удалось обработать твоё фото из-за технической ошибки.\n\n"
+    "✅ <b>Генерация возвращена на твой баланс!</b>\n\n"
+    "🔄 Попробуй ещё раз через несколько секунд.\n\n"
+    "Если проблема повторяется, обратись в поддержку 💬"
+)
+
+
+def _add_stages(timings: dict, stages: dict):
+    """Прибавить этапы к словарю задачи, не учитывая их в метриках повторно"""
+    for name, seconds in stages.items():
+        timings[name] = round(timings.get(name, 0) + seconds, 3)
+
+
+class GenerationService:
+    """
+    Выполнение задач из таблицы generation_jobs
+
+    Каждая задача проходит короткие фазы: взятие из очереди (сессия БД),
+    генерация без открытой сессии, затем подтверждение или возврат генерации
+    """
+
+    def __init__(self):
+        self.max_attempts = config.workers.max_attempts
+        self.single_flight_config = config.single_flight
+        self.delivery_config = config.delivery
+        self._single_flight = SingleFlight()
+        # Событие для мгновенного пробуждения воркеров этого процесса
+        self._job_available = asyncio.Event()
+
+    def notify(self):
+        """Сообщить воркерам процесса о новой задаче в очереди"""
+        self._job_available.set()
+
+    async def wait_for_job(self, timeout: float):
+        """Дождаться новой задачи или истечения таймаута"""
+        try:
+            await asyncio.wait_for(self._job_available.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self._job_available.clear()
+
+    async def run_job(self, bot: Bot, job: GenerationJob):
+        """
+        Выполнить задачу генерации и доставить результат пользователю
+
+        Args:
+            bot: Экземпляр бота
+            job: Задача, взятая в работу
+        """
+        started = time.monotonic()
+        queue_wait = (job.started_at - job.created_at).total_seconds()
+        queue_wait_seconds.observe(queue_wait, lane=job.lane)
+
+        # Этапы обработчика (списание, подтверждение) уже сохранены в задаче
+        timings = dict(job.timings or {})
+        stage_timer.record("queue_wait", queue_wait, timings)
+
+        # Вложенные этапы (скачивание, запрос к модели) пишут в timings сами
+        with stage_timer.bind(timings):
+            await self._run_job(bot, job, timings, started)
+
+    async def _run_job(self, bot: Bot, job: GenerationJob, timings: dict, started: float):
+        """Сгенерировать результат, сохранить его и передать на доставку"""
+        if job.attempts > self.max_attempts:
+            logger.error(
+                f"Задача {job.id} превысила лимит попыток ({job.attempts}/{self.max_attempts})"
+            )
+            await self._fail(bot, job, "max_attempts", timings, GENERATION_FAILED_MESSAGE)
+            return
+
+        try:
+            generated_image, _ = await self._generate(bot, job, timings)
+
+            await self._delete_processing_message(bot, job)
+
+            if not generated_image:
+                stage_timer.record("total", time.monotonic() - started, timings)
+                await self._fail(bot, job, "generation_failed", timings, GENERATION_FAILED_MESSAGE)
+                logger.error(f"Не удалось сгенерировать изображение для {job.telegram_id}")
+                return
+
+            # Результат уже оплачен у провайдера: сохраняем его до отправки,
+            # чтобы сбой Telegram не привёл к повторной генерации
+            await self._persist(job, generated_image, timings)
+
+        except asyncio.CancelledError:
+            # Воркер останавливается - возвращаем задачу в очередь без ожидания аренды
+            await self._release(job)
+            raise
+
+        except Exception as e:
+            logger.error(f"Ошибка при обработке задачи {job.id}: {e}", exc_info=True)
+            await self._delete_processing_message(bot, job)
+            stage_timer.record("total", time.monotonic() - started, timings)
+            await self._fail(bot, job, str(e)[:500], timings, UNEXPECTED_ERROR_MESSAGE)
+            return
+
+        await self._deliver_and_complete(bot, job, generated_image, timings, started)
+
+    async def retry_delivery(self, bot: Bot, job: GenerationJob):
+        """
+        Повторно отправить сохранённый результат задачи
+
+        Args:
+            bot: Экземпляр бота
+            job: Задача в статусе delivering, взятая на доставку
+        """
+        timings = dict(job.timings or {})
+
+        if job.result_file_id:
+            photo = job.result_file_id
+        else:
+            data = await result_store.read(job.id)
+            if data is None:
+                logger.error(f"Результат задачи {job.id} не найден, доставка невозможна")
+                delivery_attempts_total.inc(result="failed")
+                await self._fail(
+                    bot, job, "result_missing", timings, UNEXPECTED_ERROR_MESSAGE,
+                    from_status="delivering",
+                )
+                return
+            photo = BufferedInputFile(file=data, filename=openrouter_service.result_filename)
+
+        with stage_timer.bind(timings):
+            await self._deliver_and_complete(bot, job, GeneratedImage(photo=photo), timings)
+
+    def _single_flight_key(self, job: GenerationJob) -> str:
+        """Ключ идентичности запроса: фото, промпт и модель"""
+        prompt_hash = hashlib.sha256(openrouter_service.prompt.encode("utf-8")).hexdigest()[:16]
+        return f"{job.file_unique_id}:{prompt_hash}:{openrouter_service.model}"
+
+    async def _generate(
+        self, bot: Bot, job: GenerationJob, timings: dict
+    ) -> tuple[Optional[GeneratedImage], bool]:
+        """
+        Получить результат генерации, объединяя одинаковые одновременные запросы
+
+        Returns:
+            Кортеж (результат или None, получен_ли_результат_чужого_запроса)
+        """
+        if not self.single_flight_config.enabled:
+            result = await openrouter_service.process_user_image(bot, job.file_id, timings)
+            return result, False
+
+        async def generate():
+            # Этапы генерации пишутся отдельно, чтобы передать их и дубликатам
+            stages = {}
+            try:
+                with stage_timer.bind(stages):
+                    image = await openrouter_service.process_user_image(bot, job.file_id, stages)
+                return image, stages
+            finally:
+                _add_stages(timings, stages)
+
+        (result, stages), shared = await self._single_flight.do(
+            self._single_flight_key(job), generate
+        )
+        if shared:
+            # Дубликат получает этапы ведущего запроса, чтобы в задаче была
+            # видна реальная стоимость генерации (метрики учли их один раз).
+            # Длительность дубликата не попадает в оценку ожидания
+            _add_stages(timings, stages)
+            timings["coalesced"] = True
+            if result is not None:
+                # Каждая доставка меняет photo независимо
+                result = dataclasses.replace(result)
+        return result, shared
+
+    async def _persist(self, job: GenerationJob, result: GeneratedImage, timings: dict):
+        """Сохранить результат и перевести задачу в статус delivering"""
+        with stage_timer.stage("persist", timings):
+            result_file_id = None
+            if isinstance(result.photo, str):
+                # Результат из кеша уже лежит в Telegram - достаточно file_id
+                result_file_id = result.photo
+            else:
+                await result_store.save(job.id, result.photo.data)
+
+            async with get_db_session() as session:
+                updated = await GenerationJobRepository(session).mark_delivering(
+                    job.id,
+                    timings,
+                    lease_seconds=self.delivery_config.lease_seconds,
+                    balance_after=job.balance_after,
+                    result_file_id=result_file_id,
+                )
+
+        if not updated:
+            logger.warning(f"Задача {job.id} уже не в работе, результат всё равно будет отправлен")
+        job.delivery_attempts = 1
+
+    async def _deliver_and_complete(
+        self,
+        bot: Bot,
+        job: GenerationJob,
+        result: GeneratedImage,
+        timings: dict,
+        started: Optional[float] = None,
+    ):
+        """
+        Отправить результат и завершить задачу или запланировать повтор
+
+        Генерация возвращается, только если доставка окончательно невозможна
+        """
+        try:
+            with stage_timer.stage("deliver", timings):
+                await self._deliver(bot, job, result)
+        except asyncio.CancelledError:
+            # Задача остаётся в delivering: по истечении аренды доставку повторят
+            raise
+        except Exception as e:
+            await self._delivery_failed(bot, job, timings, e)
+            return
+
+        timings["delivery_attempts"] = job.delivery_attempts
+        if started is not None:
+            stage_timer.record("total", time.monotonic() - started, timings)
+        delivery_attempts_total.inc(result="success")
+
+        stage_timer.log_summary(
+            f"Изображение отправлено пользователю {job.telegram_id}, задача {job.id}", timings
+        )
+
+        try:
+            async with get_db_session() as session:
+                job_repo = GenerationJobRepository(session)
+                user_repo = UserRepository(session)
+                done = await job_repo.mark_done(job.id, timings, from_status="delivering")
+
+                # Дубликат получил результат чужого запроса - не берём плату дважды
+                user = None
+                if (
+                    done
+                    and timings.get("coalesced")
+                    and self.single_flight_config.duplicate_charge == "once"
+                ):
+                    with stage_timer.stage("refund"):
+                        user = await user_repo.update_generations(
+                            job.telegram_id, +1, lane=job.lane,
+                            entry_type="refund", source_id=str(job.id),
+                        )
+                    if user:
+                        job.balance_after = user.available_generation
+                    logger.info(f"Генерация за дубликат возвращена пользователю {job.telegram_id}")
+
+                if user is None:
+                    user = await user_repo.get_snapshot(job.telegram_id)
+
+            await result_store.delete(job.id)
+            with stage_timer.stage("balance_message"):
+                await self._send_balance_message(
+                    bot, job, is_admin=user.is_admin if user else False
+                )
+        except Exception as e:
+            logger.error(f"Ошибка при завершении доставленной задачи {job.id}: {e}", exc_info=True)
+
+    async def _delivery_failed(
+        self, bot: Bot, job: GenerationJob, timings: dict, error: Exception
+    ):
+        """Запланировать повторную доставку или вернуть генерацию"""
+        # Бот заблокирован или чат недоступен - повтор не поможет
+        permanent = isinstance(error, (TelegramForbiddenError, TelegramBadRequest))
+
+        if permanent or job.delivery_attempts >= self.delivery_config.max_attempts:
+            delivery_attempts_total.inc(result="failed")
+            logger.error(
+                f"Не удалось доставить результат задачи {job.id} "
+                f"(попытка {job.delivery_attempts}): {error}"
+            )
+            await self._fail(
+                bot, job, f"delivery: {error}"[:500], timings, UNEXPECTED_ERROR_MESSAGE,
+                from_status="delivering",
+            )
+            await result_store.delete(job.id)
+            return
+
+        delay = min(
+            self.delivery_config.backoff_max,
+            self.delivery_config.backoff_base * 2 ** (job.delivery_attempts - 1),
+        )
+        if isinstance(error, TelegramRetryAfter):
+            delay = max(delay, error.retry_after)
+
+        delivery_attempts_total.inc(result="retry")
+        logger.warning(
+            f"Не удалось отправить результат задачи {job.id} "
+            f"(попытка {job.delivery_attempts}), повтор через {delay:.0f} сек: {error}"
+        )
+        try:
+            async with get_db_session() as session:
+                await GenerationJobRepository(session).schedule_delivery(
+                    job.id, delay, str(error)[:500]
+                )
+        except Exception as e:
+            # Повтор всё равно случится по истечении аренды первой попытки
+            logger.error(f"Не удалось запланировать доставку задачи {job.id}: {e}")
+
+    async def _deliver(self, bot: Bot, job: GenerationJob, result: GeneratedImage):
+        """
+        Отправить результат пользователю и запомнить его Telegram file_id
+
+        Если результат из кеша отдаётся по file_id, повторной загрузки нет.
+        Если Telegram не принял file_id, результат загружается из кеша заново
+        """
+        try:
+            sent = await self._send_photo(bot, job, result.photo)
+        except TelegramBadRequest as e:
+            if not isinstance(result.photo, str) or not result.cache_key:
+                raise
+
+            logger.warning(f"Telegram не принял file_id из кеша: {e}")
+            await result_cache.invalidate_file_id(result.cache_key)
+            cached_bytes = await result_cache.read(result.cache_key)
+            if not cached_bytes:
+                raise
+
+            result.photo = BufferedInputFile(
+                file=cached_bytes, filename=openrouter_service.result_filename
+            )
+            sent = await self._send_photo(bot, job, result.photo)
+
+        if result.cache_key and not isinstance(result.photo, str) and sent.photo:
+            await result_cache.set_file_id(result.cache_key, sent.photo[-1].file_id)
+
+    async def _send_photo(self, bot: Bot, job: GenerationJob, photo):
+        """Отправить фото, замеряя загрузку файла в Telegram"""
+        if isinstance(photo, str):
+            return await bot.send_photo(
+                chat_id=job.chat_id, photo=photo, caption=config.bot.image_caption
+            )
+
+        started = time.monotonic()
+        sent = await bot.send_photo(
+            chat_id=job.chat_id, photo=photo, caption=config.bot.image_caption
+        )
+        upload_seconds.observe(time.monotonic() - started)
+        upload_bytes.observe(len(photo.data))
+        return sent
+
+    async def _fail(
+        self,
+        bot: Bot,
+        job: GenerationJob,
+        error: str,
+        timings: dict,
+        text: str,
+        from_status: str = "processing",
+    ):
+        """Отметить задачу неудавшейся, вернуть генерацию и уведомить пользователя"""
+        async with get_db_session() as session:
+            job_repo = GenerationJobRepository(session)
+            user_repo = UserRepository(session)
+
+            # Возвращаем генерацию только если задача ещё была в работе:
+            # так повторная обработка не вернёт генерацию дважды
+            with stage_timer.stage("refund", timings):
+                if not await job_repo.mark_failed(job.id, error, timings, from_status):
+                    logger.warning(f"Задача {job.id} уже завершена, возврат не требуется")
+                    return
+
+                user = await user_repo.update_generations(
+                    job.telegram_id, +1, lane=job.lane,
+                    entry_type="refund", source_id=str(job.id),
+                )
+
+        stage_timer.log_summary(f"Задача {job.id} не выполнена ({error[:100]})", timings)
+
+        try:
+            await bot.send_message(
+                job.chat_id,
+                text,
+                reply_markup=get_main_menu_keyboard(is_admin=user.is_admin if user else False)
+            )
+        except Exception as e:
+            logger.error(f"Не удалось уведомить пользователя {job.telegram_id}: {e}")
+
+    async def _release(self, job: GenerationJob):
+        """Вернуть задачу в очередь"""
+        try:
+            async with get_db_session() as session:
+                await GenerationJobRepository(session).release(job.id)
+            logger.info(f"Задача {job.id} возвращена в очередь")
+        except Exception as e:
+            logger.error(f"Не удалось вернуть задачу {job.id} в очередь: {e}")
+
+    async def _delete_processing_message(self, bot: Bot, job: GenerationJob):
+        """Удалить сообщение о начале обработки"""
+        try:
+            if not job.processing_message_id:
+                # Задачу могли взять раньше, чем обработчик сохранил ID сообщения
+                async with get_db_session() as session:
+                    job_repo = GenerationJobRepository(session)
+                    job.processing_message_id = await job_repo.get_processing_message_id(job.id)
+
+            if job.processing_message_id:
+                await bot.delete_message(job.chat_id, job.processing_message_id)
+        except Exception as e:
+            logger.debug(f"Не удалось удалить сообщение о обработке задачи {job.id}: {e}")
+
+    async def _send_balance_message(self, bot: Bot, job: GenerationJob, is_admin: bool):
+        """Показать обновлённый баланс после успешной генерации"""
+        new_balance = job.balance_after or 0
+        balance_emoji = "🎉" if new_balance > 0 else "😊"
+
+        balance_info = (
+            f"{balance_emoji} <b>Ретро фотография готова!</b>\n\n"
+            f"💎 Осталось генераций: <b>{new_balance}</b>\n\n"
+        )
+
+        if new_balance == 0:
+            balance_info += (
+                "📸 Генерации закончились, но ты можешь:\n"
+                "💳 Купить генерации в меню\n"
+                "🤝 Пригласить друзей и получить бонусы"
+            )
+        else:
+            balance_info += (
+                "📸 Отправь ещё фото, чтобы создать новую ретро фотографию!"
+            )
+
+        await bot.send_message(
+            job.chat_id,
+            balance_info,
+            reply_markup=get_main_menu_keyboard(is_admin=is_admin)
+        )
+
+
+# Глобальный экземпляр сервиса
+generation_service = GenerationService()
@@ -0,0 +1,52 @@
+"""Интерфейс бэкенда генерации изображений"""
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional, Protocol
+
+
+class ImageBackendError(Exception):
+    """Провайдер ответил ошибкой"""
+
+    def __init__(self, status_code: int, text: str, retry_after: Optional[float] = None):
+        self.status_code = status_code
+        self.text = text
+        self.retry_after = retry_after
+        super().__init__(f"Ошибка провайдера: {status_code} - {text}")
+
+
+@dataclass
+class GenerationOptions:
+    """Параметры одного запроса генерации"""
+    # Модель провайдера
+    model: str
+    # Префикс для логов (номер попытки)
+    log_prefix: str = ""
+    # Общее на все попытки одной генерации место для подготовленных
+    # бэкендом данных (например, собранного тела запроса по модели)
+    scratch: Dict[str, Any] = field(default_factory=dict)
+
+
+class ImageBackend(Protocol):
+    """
+    Бэкенд генерации: одна попытка запроса к провайдеру
+
+    Повторы, хеджирование, дедлайн и автомат защиты остаются в
+    OpenRouterService и одинаково работают с любым бэкендом.
+
+    generate возвращает изображение или None, если провайдер ответил без
+    изображения (отказ модели). Ошибочный ответ провайдера - ImageBackendError,
+    таймаут - TimeoutError, обрыв соединения - ConnectionError
+    (бэкенды на httpx могут выбрасывать исключения httpx)
+    """
+
+    name: str
+
+    async def start(self):
+        """Открыть соединения"""
+
+    async def close(self):
+        """Закрыть соединения"""
+
+    async def generate(
+        self, image: bytes, prompt: str, options: GenerationOptions
+    ) -> Optional[bytes]:
+        """Сгенерировать изображение по исходному и промпту"""
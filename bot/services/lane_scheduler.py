@@ -0,0 +1,65 @@
+"""Взвешенное справедливое распределение воркеров между классами приоритета"""
+from typing import Dict, List
+
+from bot.models.generation_job import LANES
+
+
+class LaneScheduler:
+    """
+    Шаговое (stride) планирование классов приоритета
+
+    У каждого класса есть виртуальное время. Воркер предпочитает класс с
+    наименьшим временем, после взятия задачи время класса растёт на
+    1 / вес. При постоянной очереди во всех классах доли задач
+    пропорциональны весам, и ни один класс не голодает полностью
+    """
+
+    def __init__(self, weights: Dict[str, float]):
+        self.weights = {lane: max(float(weights.get(lane, 1)), 0.001) for lane in LANES}
+        self._pass: Dict[str, float] = {lane: 0.0 for lane in LANES}
+
+    def order(self) -> List[str]:
+        """Классы в порядке предпочтения для следующей задачи"""
+        return sorted(LANES, key=lambda lane: (self._pass[lane], -self.weights[lane]))
+
+    def charge(self, lane: str):
+        """
+        Учесть задачу, взятую из класса
+
+        Классы, которые были впереди по очереди, но пропущены, были пусты:
+        их время подтягивается, чтобы после простоя они не забирали все
+        воркеры, отыгрывая накопленную разницу
+        """
+        if lane not in self._pass:
+            return
+        current = self._pass[lane]
+        for other in LANES:
+            if self._pass[other] < current:
+                self._pass[other] = current
+        self._pass[lane] = current + 1 / self.weights[lane]
+
+    def estimate_position(
+        self, lane: str, ahead_in_lane: int, depths: Dict[str, int]
+    ) -> int:
+        """
+        Оценить, сколько задач будет взято раньше данной
+
+        Пока класс обслуживает ahead_in_lane + 1 задач, другой класс успевает
+        получить пропорционально своему весу, но не больше своей очереди
+
+        Args:
+            lane: Класс задачи
+            ahead_in_lane: Задач того же класса впереди
+            depths: Длина очереди по классам
+
+        Returns:
+            Примерное число задач впереди
+        """
+        served = ahead_in_lane + 1
+        ahead = ahead_in_lane
+        for other in LANES:
+            if other == lane:
+                continue
+            share = int(served * self.weights[other] / self.weights[lane])
+            ahead += min(depths.get(other, 0), share)
+        return ahead
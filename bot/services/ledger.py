@@ -0,0 +1,118 @@
+"""Проецирование журнала генераций в счётчики users и сверка"""
+import asyncio
+import time
+from typing import Optional
+
+from bot.config import LedgerConfig, config
+from bot.database import get_db_session
+from bot.logger import logger
+from bot.repositories.generation_ledger_repository import GenerationLedgerRepository
+from bot.services.metrics import metrics
+
+ledger_projected_total = metrics.counter(
+    "generation_ledger_projected_total", "Пользователи, чьи записи журнала перенесены в users"
+)
+ledger_pending_entries = metrics.gauge(
+    "generation_ledger_pending_entries", "Записи журнала генераций, ещё не перенесённые в users"
+)
+ledger_mismatches = metrics.gauge(
+    "generation_ledger_mismatches", "Пользователи, чьи счётчики расходятся с журналом (последняя сверка)"
+)
+
+
+class LedgerProjector:
+    """
+    Фоновый перенос начислений из журнала в счётчики users
+
+    Начисления (оплата, возвраты, бонусы, промокоды) только добавляются в
+    журнал, поэтому частые начисления одному пользователю не ждут блокировки
+    его строки. Цикл раз в project_interval переносит их пачками по
+    batch_size пользователей, а раз в reconcile_interval сверяет счётчики с
+    суммами журнала. Несколько процессов могут работать одновременно:
+    заблокированные строки пропускаются
+    """
+
+    def __init__(self, settings: LedgerConfig):
+        self.settings = settings
+        self._task: Optional[asyncio.Task] = None
+        self._reconciled_at = time.monotonic()
+
+    def start(self):
+        """Запустить фоновый перенос и сверку"""
+        if self.settings.enabled and self._task is None:
+            self._task = asyncio.create_task(self._project_loop())
+
+    async def stop(self):
+        """Остановить фоновый перенос"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def project(self) -> int:
+        """
+        Перенести все накопившиеся записи
+
+        Returns:
+            Количество обновлённых пользователей
+        """
+        total = 0
+        while True:
+            async with get_db_session() as session:
+                projected = await GenerationLedgerRepository(session).apply_pending(
+                    self.settings.batch_size
+                )
+            total += projected
+            ledger_projected_total.inc(projected)
+            if projected < self.settings.batch_size:
+                break
+
+        async with get_db_session() as session:
+            ledger_pending_entries.set(await GenerationLedgerRepository(session).count_pending())
+        return total
+
+    async def reconcile(self) -> int:
+        """
+        Сверить счётчики users с журналом
+
+        Returns:
+            Количество пользователей с расхождениями (не больше 100)
+        """
+        async with get_db_session() as session:
+            mismatches = await GenerationLedgerRepository(session).reconcile()
+
+        ledger_mismatches.set(len(mismatches))
+        for mismatch in mismatches:
+            logger.error(
+                f"Счётчики генераций пользователя {mismatch.telegram_id} расходятся "
+                f"с журналом (available, paid, promo, referral): "
+                f"{mismatch.projected} вместо {mismatch.expected}"
+            )
+        if not mismatches:
+            logger.info("Сверка журнала генераций: расхождений нет")
+        return len(mismatches)
+
+    async def _project_loop(self):
+        while True:
+            try:
+                await self.project()
+
+                if (
+                    self.settings.reconcile_interval
+                    and time.monotonic() - self._reconciled_at >= self.settings.reconcile_interval
+                ):
+                    self._reconciled_at = time.monotonic()
+                    await self.reconcile()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка при переносе журнала генераций: {e}", exc_info=True)
+
+            await asyncio.sleep(self.settings.project_interval)
+
+
+# Глобальный экземпляр проецирования журнала
+ledger_projector = LedgerProjector(config.ledger)
@@ -0,0 +1,365 @@
+"""Метрики приложения в текстовом формате Prometheus"""
+import asyncio
+import bisect
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, Optional, Sequence, Tuple
+
+from aiohttp import web
+
+from bot.logger import logger
+
+LabelValues = Tuple[Tuple[str, str], ...]
+
+
+def _labels_key(labels: Dict[str, object]) -> LabelValues:
+    """Преобразовать словарь меток в хешируемый ключ"""
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(key: LabelValues) -> str:
+    """Отформатировать метки для вывода"""
+    if not key:
+        return ""
+    pairs = ",".join(f'{name}="{value}"' for name, value in key)
+    return "{" + pairs + "}"
+
+
+def _percentile(ordered: Sequence[float], q: float) -> float:
+    """Перцентиль отсортированной непустой последовательности"""
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Counter:
+    """Монотонно растущий счётчик"""
+
+    metric_type = "counter"
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        """Увеличить счётчик"""
+        key = _labels_key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        """Получить текущее значение счётчика"""
+        return self._values.get(_labels_key(labels), 0)
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield self.name, key, value
+
+
+class Gauge:
+    """Значение, которое может как расти, так и уменьшаться"""
+
+    metric_type = "gauge"
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self._values: Dict[LabelValues, float] = {}
+        self._callback: Optional[Callable[[], Dict[LabelValues, float]]] = None
+
+    def set(self, value: float, **labels) -> None:
+        """Установить значение"""
+        self._values[_labels_key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        """Увеличить значение"""
+        key = _labels_key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        """Уменьшить значение"""
+        self.inc(-amount, **labels)
+
+    def set_function(self, callback: Callable[[], float]) -> None:
+        """Вычислять значение при каждом чтении метрик"""
+        self._callback = lambda: {(): callback()}
+
+    def get(self, **labels) -> float:
+        """Получить текущее значение"""
+        if self._callback is not None:
+            return self._callback().get(_labels_key(labels), 0)
+        return self._values.get(_labels_key(labels), 0)
+
+    def samples(self):
+        values = self._callback() if self._callback is not None else self._values
+        for key, value in values.items():
+            yield self.name, key, value
+
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+
+class Histogram:
+    """
+    Гистограмма с фиксированными корзинами
+
+    Дополнительно хранит окно последних наблюдений для расчёта перцентилей
+    """
+
+    metric_type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+        window: int = 1000,
+    ):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets))
+        self.window = window
+        self._counts: Dict[LabelValues, list] = {}
+        self._sums: Dict[LabelValues, float] = {}
+        self._recent: Dict[LabelValues, Deque[float]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        """Добавить наблюдение"""
+        key = _labels_key(labels)
+        counts = self._counts.get(key)
+        if counts is None:
+            counts = self._counts[key] = [0] * (len(self.buckets) + 1)
+            self._sums[key] = 0.0
+            self._recent[key] = deque(maxlen=self.window)
+
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._sums[key] += value
+        self._recent[key].append(value)
+
+    def count(self, **labels) -> int:
+        """Количество наблюдений"""
+        counts = self._counts.get(_labels_key(labels))
+        return sum(counts) if counts else 0
+
+    def percentile(self, q: float, **labels) -> Optional[float]:
+        """
+        Перцентиль по окну последних наблюдений
+
+        Args:
+            q: Квантиль от 0 до 1 (например, 0.9)
+
+        Returns:
+            Значение перцентиля или None, если наблюдений нет
+        """
+        recent = self._recent.get(_labels_key(labels))
+        if not recent:
+            return None
+        return _percentile(sorted(recent), q)
+
+    def samples(self):
+        for key, counts in self._counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield f"{self.name}_bucket", key + (("le", str(bound)),), cumulative
+            yield f"{self.name}_bucket", key + (("le", "+Inf"),), sum(counts)
+            yield f"{self.name}_sum", key, self._sums[key]
+            yield f"{self.name}_count", key, sum(counts)
+
+
+class Summary:
+    """
+    Перцентили по скользящему окну последних наблюдений
+
+    В отличие от гистограммы, перцентили считаются в процессе и
+    отдаются готовыми значениями (например, p50/p90/p99)
+    """
+
+    metric_type = "summary"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        quantiles: Sequence[float] = (0.5, 0.9, 0.99),
+        window: int = 1000,
+    ):
+        self.name = name
+        self.description = description
+        self.quantiles = tuple(quantiles)
+        self.window = window
+        self._counts: Dict[LabelValues, int] = {}
+        self._sums: Dict[LabelValues, float] = {}
+        self._recent: Dict[LabelValues, Deque[float]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        """Добавить наблюдение"""
+        key = _labels_key(labels)
+        recent = self._recent.get(key)
+        if recent is None:
+            recent = self._recent[key] = deque(maxlen=self.window)
+            self._counts[key] = 0
+            self._sums[key] = 0.0
+
+        recent.append(value)
+        self._counts[key] += 1
+        self._sums[key] += value
+
+    def percentile(self, q: float, **labels) -> Optional[float]:
+        """Перцентиль по окну последних наблюдений или None"""
+        recent = self._recent.get(_labels_key(labels))
+        if not recent:
+            return None
+        return _percentile(sorted(recent), q)
+
+    def samples(self):
+        for key, recent in self._recent.items():
+            ordered = sorted(recent)
+            for q in self.quantiles:
+                yield self.name, key + (("quantile", str(q)),), _percentile(ordered, q)
+            yield f"{self.name}_sum", key, self._sums[key]
+            yield f"{self.name}_count", key, self._counts[key]
+
+
+class MetricsRegistry:
+    """Реестр метрик процесса"""
+
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+
+    def _register(self, metric_class, name: str, description: str):
+        existing = self._metrics.get(name)
+        if existing is not None:
+            return existing
+        metric = metric_class(name, description)
+        self._metrics[name] = metric
+        return metric
+
+    def counter(self, name: str, description: str) -> Counter:
+        """Получить или создать счётчик"""
+        return self._register(Counter, name, description)
+
+    def gauge(self, name: str, description: str) -> Gauge:
+        """Получить или создать gauge"""
+        return self._register(Gauge, name, description)
+
+    def histogram(
+        self,
+        name: str,
+        description: str,
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        """Получить или создать гистограмму"""
+        existing = self._metrics.get(name)
+        if existing is not None:
+            return existing
+        metric = Histogram(name, description, buckets)
+        self._metrics[name] = metric
+        return metric
+
+    def summary(
+        self,
+        name: str,
+        description: str,
+        quantiles: Sequence[float] = (0.5, 0.9, 0.99),
+    ) -> Summary:
+        """Получить или создать summary с перцентилями по окну"""
+        existing = self._metrics.get(name)
+        if existing is not None:
+            return existing
+        metric = Summary(name, description, quantiles)
+        self._metrics[name] = metric
+        return metric
+
+    def render(self) -> str:
+        """Сформировать текст в формате Prometheus"""
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.metric_type}")
+            for sample_name, key, value in metric.samples():
+                lines.append(f"{sample_name}{_format_labels(key)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """HTTP сервер, отдающий метрики на /metrics"""
+
+    def __init__(self, registry: MetricsRegistry):
+        self.registry = registry
+        self._runner: Optional[web.AppRunner] = None
+
+    async def _handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.registry.render(), content_type="text/plain")
+
+    async def start(self, host: str, port: int) -> None:
+        """Запустить HTTP сервер метрик"""
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle_metrics)
+
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+
+        logger.info(f"Сервер метрик запущен на {host}:{port}/metrics")
+
+    async def stop(self) -> None:
+        """Остановить HTTP сервер метрик"""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+            logger.info("Сервер метрик остановлен")
+
+
+LOOP_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+
+class EventLoopLagMonitor:
+    """
+    Замер задержки цикла событий
+
+    Периодически засыпает на interval и измеряет, насколько позже
+    запланированного проснулся. Задержка показывает, как долго цикл был
+    занят синхронной работой и не обрабатывал апдейты
+    """
+
+    def __init__(self, registry: "MetricsRegistry"):
+        self.lag_seconds = registry.histogram(
+            "event_loop_lag_seconds",
+            "Задержка пробуждения задачи в цикле событий относительно запланированного",
+            buckets=LOOP_LAG_BUCKETS,
+        )
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self, interval: float):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(interval)
+            lag = max(0.0, time.monotonic() - started - interval)
+            self.lag_seconds.observe(lag)
+            if lag >= 1:
+                logger.warning(f"Цикл событий был заблокирован на {lag:.2f} с")
+
+    def start(self, interval: float) -> None:
+        """Запустить замер в фоне"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(interval))
+
+    async def stop(self) -> None:
+        """Остановить замер"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+# Глобальный реестр метрик
+metrics = MetricsRegistry()
+
+# Глобальный сервер метрик
+metrics_server = MetricsServer(metrics)
+
+# Глобальный замер задержки цикла событий
+loop_lag_monitor = EventLoopLagMonitor(metrics)
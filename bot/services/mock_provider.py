@@ -0,0 +1,161 @@
+"""Заглушка провайдера генерации для нагрузочных тестов без сети"""
+import asyncio
+import math
+import os
+import random
+from dataclasses import dataclass
+from io import BytesIO
+from typing import Dict, Optional, Tuple
+
+from PIL import Image
+
+from bot.config import MockProviderConfig, config
+from bot.logger import logger
+from bot.services.image_backend import GenerationOptions, ImageBackendError
+
+# Статусы, с которыми заглушка возвращает Retry-After
+RETRY_AFTER_STATUSES = {429, 503}
+
+
+@dataclass
+class MockOutcome:
+    """Исход одного запроса к заглушке"""
+    # image, empty, error или timeout
+    kind: str
+    # Через сколько секунд ответить
+    delay: float
+    status_code: int = 200
+    # Размер изображения для ответа image
+    size: Tuple[int, int] = (0, 0)
+
+
+class MockProvider:
+    """
+    Поведение заглушки провайдера по настройкам mock_provider
+
+    Задержка берётся из заданного распределения, доли таймаутов, ошибок и
+    ответов без изображения - по настройкам. Изображения рендерятся один
+    раз на размер, поэтому сама заглушка почти не тратит CPU
+    """
+
+    def __init__(self, settings: MockProviderConfig, seed: Optional[int] = None):
+        self.settings = settings
+        self._random = random.Random(seed)
+        self._images: Dict[Tuple[int, int], bytes] = {}
+
+    def sample_latency(self) -> float:
+        """Задержка ответа из настроенного распределения, секунды"""
+        latency = self.settings.latency
+        if latency.distribution == "fixed":
+            value = latency.median
+        elif latency.distribution == "uniform":
+            value = self._random.uniform(latency.min, latency.max)
+        else:
+            value = self._random.lognormvariate(math.log(max(latency.median, 1e-3)), latency.sigma)
+        return min(max(value, latency.min), latency.max)
+
+    def next_outcome(self) -> MockOutcome:
+        """Разыграть исход очередного запроса"""
+        settings = self.settings
+        roll = self._random.random()
+
+        if roll < settings.timeout_rate:
+            return MockOutcome(kind="timeout", delay=settings.timeout_seconds)
+        roll -= settings.timeout_rate
+
+        delay = self.sample_latency()
+        if roll < settings.error_rate:
+            status_code = self._random.choice(settings.error_statuses)
+            return MockOutcome(kind="error", delay=delay, status_code=status_code)
+        roll -= settings.error_rate
+
+        if roll < settings.empty_rate:
+            return MockOutcome(kind="empty", delay=delay)
+
+        width, height = self._random.choice(settings.image_sizes)
+        return MockOutcome(kind="image", delay=delay, size=(width, height))
+
+    def retry_after(self, status_code: int) -> Optional[float]:
+        """Retry-After для ошибки или None"""
+        if status_code in RETRY_AFTER_STATUSES:
+            return self.settings.retry_after
+        return None
+
+    def render(self, size: Tuple[int, int]) -> bytes:
+        """
+        PNG заданного размера
+
+        Функция синхронная при первом вызове на размер - вызывать вне
+        event loop или заранее через warm_up
+        """
+        if size not in self._images:
+            width, height = size
+            if self.settings.noise:
+                image = Image.frombytes("RGB", size, os.urandom(width * height * 3))
+            else:
+                image = Image.new("RGB", size, (196, 128, 64))
+            output = BytesIO()
+            image.save(output, format="PNG")
+            self._images[size] = output.getvalue()
+        return self._images[size]
+
+    def warm_up(self):
+        """Отрендерить изображения всех настроенных размеров"""
+        for width, height in self.settings.image_sizes:
+            data = self.render((width, height))
+            logger.info(f"Заглушка провайдера: изображение {width}x{height}, {len(data)} байт")
+
+
+class MockBackend:
+    """
+    Бэкенд генерации без сети
+
+    Отвечает по профилю mock_provider прямо в процессе: удобно для
+    нагрузочного теста очереди, воркеров и доставки без OpenRouter.
+    Чтобы нагрузить ещё и HTTP-клиент с разбором ответа, используйте
+    бэкенд openrouter с api_url на mock-сервер (python -m bot.mock_server)
+    """
+
+    name = "mock"
+
+    def __init__(self):
+        self.provider = MockProvider(config.mock_provider)
+        # Клиент openrouter не ждёт ответа дольше таймаута чтения
+        self.read_timeout = config.openrouter.http.read_timeout
+
+    async def start(self):
+        """Заранее отрендерить изображения ответов"""
+        await asyncio.to_thread(self.provider.warm_up)
+
+    async def close(self):
+        """Ресурсов, требующих закрытия, нет"""
+
+    async def generate(
+        self, image: bytes, prompt: str, options: GenerationOptions
+    ) -> Optional[bytes]:
+        """
+        Ответить изображением, ошибкой или пустым ответом по профилю
+
+        Raises:
+            ImageBackendError: Разыгранная ошибка провайдера
+            TimeoutError: Разыгранный таймаут
+        """
+        outcome = self.provider.next_outcome()
+
+        if outcome.kind == "timeout":
+            await asyncio.sleep(min(outcome.delay, self.read_timeout))
+            raise TimeoutError("Заглушка провайдера не ответила")
+
+        await asyncio.sleep(outcome.delay)
+
+        if outcome.kind == "error":
+            raise ImageBackendError(
+                outcome.status_code,
+                "Ошибка заглушки провайдера",
+                self.provider.retry_after(outcome.status_code),
+            )
+        if outcome.kind == "empty":
+            logger.warning(f"{options.log_prefix}: Заглушка ответила без изображения")
+            return None
+
+        return await asyncio.to_thread(self.provider.render, outcome.size)
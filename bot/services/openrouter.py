@@ -1,46 +1,937 @@
 """Сервис для работы с OpenRouter API"""
 import asyncio
-import base64
+import multiprocessing
+import random
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 from io import BytesIO
-from typing import Optional
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple, Union
 
 import httpx
-from aiogram.types import PhotoSize, BufferedInputFile
+from aiogram.types import BufferedInputFile, PhotoSize
+from PIL import Image
 
-from bot.config import config
+from bot.config import (
+    OpenRouterCircuitBreakerConfig,
+    OpenRouterInputImageConfig,
+    OpenRouterOutputImageConfig,
+    config,
+)
 from bot.logger import logger
+from bot.repositories.circuit_breaker_repository import CircuitBreakerRepository
+from bot.services.data_url_parser import ImageDataURLParser
+from bot.services.image_backend import GenerationOptions, ImageBackend, ImageBackendError
+from bot.services import stage_timer
+from bot.services.metrics import metrics
+from bot.services.mock_provider import MockBackend
+from bot.services.payload_codec import decode_response, describe_response, encode_request
+from bot.services.result_cache import result_cache
+from bot.services.retry_budget import RetryBudget
+from bot.services.sse_parser import ChatStreamParser
+from bot.services.telegram_files import telegram_file_downloader
 
+requests_total = metrics.counter(
+    "openrouter_http_requests_total", "Запросы к OpenRouter, отправленные через пул"
+)
+connections_opened_total = metrics.counter(
+    "openrouter_http_connections_opened_total", "Новые TCP-соединения к OpenRouter"
+)
+connections_reused_total = metrics.counter(
+    "openrouter_http_connections_reused_total",
+    "Запросы, отправленные по уже открытому соединению",
+)
+upload_bytes_total = metrics.counter(
+    "openrouter_upload_bytes_total", "Байты тел запросов, отправленные в OpenRouter"
+)
+upload_seconds = metrics.histogram(
+    "openrouter_upload_seconds",
+    "Время отправки запроса в OpenRouter (от заголовков до конца тела)",
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+response_peak_bytes = metrics.histogram(
+    "openrouter_response_peak_bytes",
+    "Пиковая память на разбор ответа OpenRouter (stream - потоково, buffered - response.json())",
+    buckets=(1_000_000, 2_000_000, 5_000_000, 10_000_000, 20_000_000, 50_000_000),
+)
+generation_seconds = metrics.histogram(
+    "openrouter_generation_seconds",
+    "Время успешной генерации по моделям (по окну считается порог хеджирования)",
+    buckets=(5, 10, 15, 20, 30, 45, 60, 90, 120, 180, 300),
+)
+model_results_total = metrics.counter(
+    "openrouter_model_results_total", "Запросы генерации по моделям и результату"
+)
+hedges_total = metrics.counter(
+    "openrouter_hedges_total", "Дублирующие запросы, отправленные в резервную модель"
+)
+hedge_wins_total = metrics.counter(
+    "openrouter_hedge_wins_total", "Гонки с дублирующим запросом по модели-победителю"
+)
+deadline_exceeded_total = metrics.counter(
+    "openrouter_deadline_exceeded_total", "Генерации, прерванные по общему дедлайну"
+)
+circuit_state = metrics.gauge(
+    "openrouter_circuit_state", "Состояние автомата защиты OpenRouter (0 - closed, 1 - half_open, 2 - open)"
+)
+circuit_transitions_total = metrics.counter(
+    "openrouter_circuit_transitions_total", "Переходы автомата защиты OpenRouter по новому состоянию"
+)
+circuit_rejected_total = metrics.counter(
+    "openrouter_circuit_rejected_total", "Запросы к OpenRouter, отклонённые автоматом защиты"
+)
+output_image_bytes = metrics.histogram(
+    "openrouter_output_image_bytes",
+    "Размер сгенерированного изображения до и после перекодирования",
+    buckets=(100_000, 250_000, 500_000, 1_000_000, 2_000_000, 5_000_000, 10_000_000),
+)
+input_image_bytes = metrics.histogram(
+    "openrouter_input_image_bytes",
+    "Размер исходного фото до и после подготовки",
+    buckets=(50_000, 100_000, 250_000, 500_000, 1_000_000, 2_000_000, 5_000_000),
+)
+ttfb_seconds = metrics.histogram(
+    "openrouter_ttfb_seconds",
+    "Время от отправки запроса до первого байта тела ответа",
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120),
+)
+first_event_seconds = metrics.histogram(
+    "openrouter_sse_first_event_seconds",
+    "Время от отправки запроса до первого события с данными (SSE)",
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120),
+)
+sse_aborts_total = metrics.counter(
+    "openrouter_sse_aborts_total",
+    "Потоки SSE, прерванные до конца: refusal - отказ модели, text - ответ текстом",
+)
 
-class OpenRouterService:
-    """Класс для работы с OpenRouter API"""
+# Ошибки, которые повтор не исправит (ключ, оплата, доступ)
+NON_RETRYABLE_STATUSES = {401, 402, 403}
+
+# Ошибки запроса, не говорящие о сбое самого OpenRouter
+CLIENT_ERROR_STATUSES = {400, 404, 413, 422}
+
+# Значения метрики openrouter_circuit_state
+CIRCUIT_STATE_VALUES = {"closed": 0, "half_open": 1, "open": 2}
+
+# Сколько байт потока копить перед передачей в парсер вне цикла событий
+FEED_BATCH_SIZE = 256 * 1024
+
+# Расширение файла результата по формату перекодирования
+OUTPUT_EXTENSIONS = {"jpeg": "jpg", "webp": "webp"}
+
+
+class OpenRouterAPIError(ImageBackendError):
+    """Ответ OpenRouter с ошибочным HTTP-статусом"""
+
+    @classmethod
+    def from_response(cls, response: httpx.Response, text: str) -> "OpenRouterAPIError":
+        """Создать ошибку по ответу, разобрав заголовок Retry-After"""
+        return cls(response.status_code, text, parse_retry_after(response.headers.get("Retry-After")))
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Разобрать заголовок Retry-After
+
+    Args:
+        value: Число секунд или HTTP-дата
+
+    Returns:
+        float: Сколько секунд ждать или None, если заголовка нет
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def prepare_image(image_bytes: bytes, settings: OpenRouterInputImageConfig) -> bytes:
+    """
+    Уменьшить и пережать фото под бюджет размера перед отправкой
+
+    Фото не трогается, если уже укладывается в max_side и max_bytes.
+    Иначе уменьшается по длинной стороне (не ниже минимального разрешения)
+    и кодируется в JPEG с понижением качества до попадания в бюджет.
+    Функция синхронная и нагружает CPU - вызывать вне event loop
+
+    Args:
+        image_bytes: Исходное фото
+        settings: Настройки входного фото
+
+    Returns:
+        bytes: Подготовленное фото в JPEG
+    """
+    if not settings.resize:
+        return image_bytes
+
+    with Image.open(BytesIO(image_bytes)) as image:
+        if (
+            len(image_bytes) <= settings.max_bytes
+            and max(image.size) <= settings.max_side
+        ):
+            return image_bytes
+
+        image = image.convert("RGB")
+        min_long = max(settings.min_width, settings.min_height)
+        long_side = max(image.size)
+        if long_side > settings.max_side:
+            scale = max(settings.max_side, min_long) / long_side
+            if scale < 1:
+                new_size = (round(image.width * scale), round(image.height * scale))
+                image = image.resize(new_size, Image.LANCZOS)
+
+        quality = settings.jpeg_quality
+        while True:
+            output = BytesIO()
+            image.save(output, format="JPEG", quality=quality, optimize=True)
+            if output.tell() <= settings.max_bytes or quality <= 50:
+                return output.getvalue()
+            quality -= 10
+
+
+def transcode_result(image_bytes: bytes, settings: OpenRouterOutputImageConfig) -> bytes:
+    """
+    Перекодировать сгенерированное изображение перед отправкой в Telegram
+
+    Формат определяется по содержимому, а не по data URL. Изображение
+    уменьшается до max_side и кодируется в прогрессивный JPEG или WebP
+    с понижением качества до попадания в max_bytes. Если оно уже в целевом
+    формате и в пределах лимитов, возвращается без изменений.
+    Функция синхронная и нагружает CPU - вызывать вне event loop
+
+    Args:
+        image_bytes: Декодированный ответ модели
+        settings: Настройки результата
+
+    Returns:
+        bytes: Изображение для загрузки в Telegram
+    """
+    with Image.open(BytesIO(image_bytes)) as image:
+        if (
+            (image.format or "").lower() == settings.format
+            and len(image_bytes) <= settings.max_bytes
+            and max(image.size) <= settings.max_side
+        ):
+            return image_bytes
+
+        has_alpha = "A" in image.getbands() or "transparency" in image.info
+        if has_alpha and settings.format == "jpeg":
+            # JPEG без прозрачности: кладём изображение на белый фон
+            rgba = image.convert("RGBA")
+            image = Image.new("RGB", rgba.size, (255, 255, 255))
+            image.paste(rgba, mask=rgba.getchannel("A"))
+        else:
+            image = image.convert("RGBA" if has_alpha else "RGB")
+
+        long_side = max(image.size)
+        if long_side > settings.max_side:
+            scale = settings.max_side / long_side
+            new_size = (round(image.width * scale), round(image.height * scale))
+            image = image.resize(new_size, Image.LANCZOS)
+
+        quality = settings.quality
+        while True:
+            output = BytesIO()
+            if settings.format == "jpeg":
+                image.save(output, format="JPEG", quality=quality, optimize=True, progressive=True)
+            else:
+                image.save(output, format="WEBP", quality=quality, method=4)
+            if output.tell() <= settings.max_bytes or quality <= 50:
+                return output.getvalue()
+            quality -= 10
+
+
+class CircuitOpenError(Exception):
+    """Запрос не отправлен: автомат защиты OpenRouter разомкнут"""
+
+
+class CircuitBreaker:
+    """
+    Автомат защиты от деградации OpenRouter
+
+    Считает долю ошибок и медленных ответов за скользящее окно. Если доля
+    превышает порог, цепь размыкается и запросы отклоняются сразу. Через
+    open_seconds цепь переходит в полуоткрытое состояние и пропускает
+    несколько пробных запросов: успех замыкает цепь, ошибка снова размыкает.
+
+    Запросы видит только процесс с воркерами, поэтому при share_state срок
+    размыкания записывается в БД (circuit_breakers), а процесс бота читает
+    его в is_open_shared - и с воркерами в отдельном процессе
+    """
+
+    CLOSED = "closed"
+    HALF_OPEN = "half_open"
+    OPEN = "open"
+
+    def __init__(self, settings: OpenRouterCircuitBreakerConfig, name: str = "openrouter"):
+        self.settings = settings
+        self.name = name
+        self._state = self.CLOSED
+        self._opened_at = 0.0
+        # (время, успех, длительность) за последние window_seconds
+        self._calls: Deque[Tuple[float, bool, float]] = deque()
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+        # Срок размыкания из БД и когда он прочитан
+        self._shared_open_until: Optional[datetime] = None
+        self._shared_checked_at = float("-inf")
+        self._publish_tasks: set = set()
+        circuit_state.set_function(lambda: CIRCUIT_STATE_VALUES[self.state])
+
+    @property
+    def state(self) -> str:
+        """Текущее состояние (open переходит в half_open по таймеру)"""
+        if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.settings.open_seconds:
+            self._transition(self.HALF_OPEN)
+        return self._state
+
+    @property
+    def is_open(self) -> bool:
+        """Разомкнута ли цепь (новые задачи принимать не стоит)"""
+        return self.settings.enabled and self.state == self.OPEN
+
+    async def is_open_shared(self) -> bool:
+        """
+        Разомкнута ли цепь в этом или любом другом процессе с воркерами
+
+        Общий срок размыкания читается из БД не чаще shared_refresh_seconds.
+        Если БД недоступна, решение принимается по состоянию этого процесса
+        """
+        if self.is_open:
+            return True
+        if not (self.settings.enabled and self.settings.share_state):
+            return False
+
+        # bot.database импортирует bot.services, поэтому импорт не на уровне модуля
+        from bot.database import database
+
+        now = time.monotonic()
+        if now - self._shared_checked_at >= self.settings.shared_refresh_seconds:
+            self._shared_checked_at = now
+            try:
+                async with database.get_autocommit_session() as session:
+                    self._shared_open_until = await CircuitBreakerRepository(
+                        session
+                    ).get_open_until(self.name)
+            except Exception as e:
+                logger.error(f"Не удалось прочитать состояние автомата защиты {self.name}: {e}")
+
+        return (
+            self._shared_open_until is not None
+            and self._shared_open_until > datetime.utcnow()
+        )
+
+    def allow_request(self) -> bool:
+        """
+        Можно ли отправить запрос
+
+        В полуоткрытом состоянии занимает слот пробного запроса, который
+        освобождается в record_success/record_failure/record_cancelled
+        """
+        if not self.settings.enabled:
+            return True
+
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN and self._probes_in_flight < self.settings.half_open_probes:
+            self._probes_in_flight += 1
+            return True
+
+        circuit_rejected_total.inc()
+        return False
+
+    def record_success(self, duration: float):
+        """Учесть успешный запрос"""
+        if self._state == self.HALF_OPEN:
+            self._probes_in_flight = max(0, self._probes_in_flight - 1)
+            self._probe_successes += 1
+            if self._probe_successes >= self.settings.half_open_probes:
+                self._transition(self.CLOSED)
+            return
+        self._record(True, duration)
+
+    def record_failure(self, duration: float):
+        """Учесть неудачный запрос"""
+        if self._state == self.HALF_OPEN:
+            self._probes_in_flight = max(0, self._probes_in_flight - 1)
+            self._transition(self.OPEN)
+            return
+        self._record(False, duration)
+
+    def record_cancelled(self):
+        """Запрос отменён до результата (проигравший хедж, дедлайн)"""
+        if self._state == self.HALF_OPEN:
+            self._probes_in_flight = max(0, self._probes_in_flight - 1)
+
+    def _record(self, success: bool, duration: float):
+        now = time.monotonic()
+        self._calls.append((now, success, duration))
+        horizon = now - self.settings.window_seconds
+        while self._calls and self._calls[0][0] < horizon:
+            self._calls.popleft()
+
+        if self._state != self.CLOSED or len(self._calls) < self.settings.min_requests:
+            return
+
+        total = len(self._calls)
+        failures = sum(1 for _, ok, _ in self._calls if not ok)
+        slow = sum(1 for _, _, spent in self._calls if spent >= self.settings.slow_call_seconds)
+        if failures / total >= self.settings.error_rate or slow / total >= self.settings.slow_call_rate:
+            logger.error(
+                f"Автомат защиты OpenRouter разомкнут: ошибок {failures}/{total}, "
+                f"медленных {slow}/{total} за {self.settings.window_seconds:.0f} с"
+            )
+            self._transition(self.OPEN)
+
+    def _transition(self, state: str):
+        if state == self._state:
+            return
+        logger.warning(f"Автомат защиты OpenRouter: {self._state} -> {state}")
+        circuit_transitions_total.inc(state=state)
+        self._state = state
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+        if state == self.OPEN:
+            self._opened_at = time.monotonic()
+            self._publish(datetime.utcnow() + timedelta(seconds=self.settings.open_seconds))
+        elif state == self.CLOSED:
+            self._calls.clear()
+            self._publish(None)
+
+    def _publish(self, open_until: Optional[datetime]):
+        """Записать срок размыкания в БД в фоне (переход случается в коде воркера)"""
+        if not (self.settings.enabled and self.settings.share_state):
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        task = loop.create_task(self._store_open_until(open_until))
+        self._publish_tasks.add(task)
+        task.add_done_callback(self._publish_tasks.discard)
+
+    async def _store_open_until(self, open_until: Optional[datetime]):
+        from bot.database import get_db_session
+
+        try:
+            async with get_db_session() as session:
+                await CircuitBreakerRepository(session).set_open_until(self.name, open_until)
+        except Exception as e:
+            logger.error(f"Не удалось записать состояние автомата защиты {self.name}: {e}")
+
+
+@dataclass
+class GeneratedImage:
+    """Результат обработки изображения пользователя"""
+    # Файл для загрузки или Telegram file_id ранее отправленного результата
+    photo: Union[BufferedInputFile, str]
+    # Ключ кеша результатов (None, если кеш выключен)
+    cache_key: Optional[str] = None
+    # Результат взят из кеша без обращения к OpenRouter
+    from_cache: bool = False
+
+
+class OpenRouterBackend:
+    """
+    Бэкенд генерации через OpenRouter chat completions
+
+    Держит общий на процесс пул HTTP-соединений и пул для CPU-ёмкого
+    кодирования base64/JSON
+    """
+
+    name = "openrouter"
 
     def __init__(self):
-        self.api_url = "https://openrouter.ai/api/v1/chat/completions"
+        self.api_url = config.openrouter.api_url
         self.api_key = config.openrouter_api_key
+        self.http_config = config.openrouter.http
+        self.stream_response = config.openrouter.stream_response
+        self.sse_config = config.openrouter.sse
+        self.executor_config = config.openrouter.executor
+        self._client: Optional[httpx.AsyncClient] = None
+        self._executor: Optional[Executor] = None
+
+    async def start(self):
+        """Создать общий пул HTTP-соединений к OpenRouter"""
+        if self._client is not None:
+            return
+
+        limits = httpx.Limits(
+            max_connections=self.http_config.max_connections,
+            max_keepalive_connections=self.http_config.max_keepalive_connections,
+            keepalive_expiry=self.http_config.keepalive_expiry,
+        )
+        self._client = httpx.AsyncClient(
+            http2=self.http_config.http2,
+            limits=limits,
+            timeout=httpx.Timeout(
+                self.http_config.timeout,
+                connect=self.http_config.connect_timeout,
+                read=self.http_config.read_timeout,
+            ),
+            headers={"Authorization": f"Bearer {self.api_key}"},
+        )
+
+        logger.info(
+            f"HTTP клиент OpenRouter создан: max_connections={self.http_config.max_connections}, "
+            f"keepalive={self.http_config.max_keepalive_connections}, http2={self.http_config.http2}"
+        )
+
+        kind = self.executor_config.kind
+        if kind == "thread":
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.executor_config.max_workers,
+                thread_name_prefix="openrouter-codec",
+            )
+        elif kind == "process":
+            # forkserver не копирует потоки и состояние цикла событий родителя
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.executor_config.max_workers,
+                mp_context=multiprocessing.get_context("forkserver"),
+            )
+        logger.info(
+            f"Пул для base64/JSON OpenRouter: {kind}, "
+            f"max_workers={self.executor_config.max_workers}"
+        )
+
+    async def close(self):
+        """Закрыть пул HTTP-соединений"""
+        if self._client is None:
+            return
+
+        await self._client.aclose()
+        self._client = None
+        logger.info(f"HTTP клиент OpenRouter закрыт, статистика пула: {self.get_pool_stats()}")
+
+        if self._executor is not None:
+            executor, self._executor = self._executor, None
+            await asyncio.to_thread(executor.shutdown)
+            logger.info("Пул для base64/JSON OpenRouter остановлен")
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """Общий HTTP клиент (создаётся в start)"""
+        if self._client is None:
+            raise RuntimeError("HTTP клиент OpenRouter не инициализирован, вызовите start()")
+        return self._client
+
+    @property
+    def executor(self) -> Optional[Executor]:
+        """
+        Пул для CPU-ёмкой работы (None - стандартный пул потоков цикла событий)
+
+        Функции для пула процессов должны сериализоваться pickle
+        """
+        return self._executor
+
+    async def _run_cpu(self, func: Callable[..., Any], *args) -> Any:
+        """
+        Выполнить CPU-ёмкую функцию без состояния в пуле кодирования
+
+        Функция и аргументы должны сериализоваться pickle (для пула процессов)
+        """
+        if self._executor is None:
+            return func(*args)
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def _run_stateful(self, func: Callable[..., Any], *args) -> Any:
+        """
+        Выполнить CPU-ёмкий метод объекта с состоянием (например, парсера)
+
+        Такой объект нельзя передать в другой процесс, поэтому при пуле
+        процессов вызов уходит в стандартный пул потоков
+        """
+        kind = self.executor_config.kind
+        if kind == "none":
+            return func(*args)
+        executor = self._executor if kind == "thread" else None
+        return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+    def get_pool_stats(self) -> dict:
+        """
+        Статистика переиспользования соединений пула
+
+        Returns:
+            dict: Количество запросов, новых и переиспользованных соединений
+        """
+        requests = requests_total.get()
+        opened = connections_opened_total.get()
+        return {
+            "requests": int(requests),
+            "connections_opened": int(opened),
+            "connections_reused": int(connections_reused_total.get()),
+            "reuse_ratio": round(1 - opened / requests, 3) if requests else 0.0,
+        }
+
+    @staticmethod
+    def _make_trace():
+        """
+        Создать колбэк трассировки httpcore для одного запроса
+
+        Считает новые соединения, запросы, ушедшие по уже открытому соединению,
+        и время отправки тела запроса
+        """
+        connected = False
+        upload_started = None
+
+        async def trace(event_name: str, info: dict):
+            nonlocal connected, upload_started
+            if event_name == "connection.connect_tcp.complete":
+                connected = True
+                connections_opened_total.inc()
+            elif event_name.endswith(".send_request_headers.started"):
+                upload_started = time.monotonic()
+                requests_total.inc()
+                if not connected:
+                    connections_reused_total.inc()
+            elif event_name.endswith(".send_request_body.complete") and upload_started:
+                upload_seconds.observe(time.monotonic() - upload_started)
+
+        return trace
+
+    async def generate(
+        self, image: bytes, prompt: str, options: GenerationOptions
+    ) -> Optional[bytes]:
+        """
+        Один запрос генерации к модели OpenRouter
+
+        Тело запроса на модель собирается один раз за генерацию, вне цикла
+        событий, и переиспользуется повторами и дублирующими запросами.
+        Ответ читается событиями SSE (openrouter.sse), потоково или целиком
+
+        Returns:
+            bytes: Изображение или None, если в ответе его нет
+
+        Raises:
+            OpenRouterAPIError: При ответе OpenRouter с ошибочным статусом
+        """
+        body = options.scratch.get(options.model)
+        if body is None:
+            with stage_timer.stage("encode"):
+                body = await self._run_cpu(
+                    encode_request, image, options.model, prompt, self.sse_config.enabled
+                )
+            options.scratch[options.model] = body
+
+        if self.sse_config.enabled:
+            return await self._request_image_sse(body, options.log_prefix)
+        if self.stream_response:
+            return await self._request_image_streaming(body, options.log_prefix)
+        return await self._request_image_buffered(body, options.log_prefix)
+
+    async def _request_image_streaming(self, body: bytes, prefix: str) -> Optional[bytes]:
+        """
+        Отправить запрос и декодировать изображение по мере чтения ответа
+
+        Data URL ищется в потоке, base64 декодируется кусками в один буфер -
+        ответ целиком в памяти не держится
+
+        Returns:
+            bytes: Изображение или None, если в ответе его нет
+
+        Raises:
+            OpenRouterAPIError: При ответе с ошибочным статусом
+        """
+        started = time.monotonic()
+        decode_elapsed = 0.0
+        try:
+            async with self.client.stream(
+                "POST",
+                self.api_url,
+                content=body,
+                headers={"Content-Type": "application/json"},
+                extensions={"trace": self._make_trace()},
+            ) as response:
+                upload_bytes_total.inc(len(body))
+
+                if response.status_code != 200:
+                    error_body = await response.aread()
+                    raise OpenRouterAPIError.from_response(
+                        response, error_body[:1000].decode("utf-8", "replace")
+                    )
+
+                parser = ImageDataURLParser()
+                batch = bytearray()
+                first_byte = True
+                async for chunk in response.aiter_bytes():
+                    if first_byte:
+                        first_byte = False
+                        self._record_ttfb(time.monotonic() - started, "stream")
+                    batch += chunk
+                    if len(batch) >= FEED_BATCH_SIZE:
+                        feed_started = time.monotonic()
+                        await self._run_stateful(parser.feed, bytes(batch))
+                        decode_elapsed += time.monotonic() - feed_started
+                        batch.clear()
+                if batch:
+                    feed_started = time.monotonic()
+                    await self._run_stateful(parser.feed, bytes(batch))
+                    decode_elapsed += time.monotonic() - feed_started
+                parser.close()
+        finally:
+            # Разбор идёт по мере чтения: время ожидания сети и время
+            # декодирования учитываются раздельно
+            stage_timer.record("upstream", time.monotonic() - started - decode_elapsed)
+            if decode_elapsed:
+                stage_timer.record("decode", decode_elapsed)
+
+        response_peak_bytes.observe(parser.peak_bytes, mode="stream")
+        logger.info(
+            f"{prefix}: Ответ от OpenRouter получен, пиковая память разбора: "
+            f"{parser.peak_bytes} байт"
+        )
+
+        if parser.complete and parser.image:
+            logger.info(f"{prefix}: Изображение успешно декодировано из base64 ({parser.mime_type})")
+            return bytes(parser.image)
+
+        if parser.found:
+            logger.warning(f"{prefix}: Data URL изображения оборван")
+        else:
+            logger.warning(
+                f"{prefix}: В ответе нет сгенерированных изображений: "
+                f"{describe_response(bytes(parser.text))}"
+            )
+        return None
+
+    async def _request_image_sse(self, body: bytes, prefix: str) -> Optional[bytes]:
+        """
+        Отправить запрос со stream: true и разбирать события по мере прихода
+
+        Если до изображения модель отказала или (при text_abort_chars > 0)
+        пишет текст дольше text_abort_chars, поток прерывается и возвращается None - попытка
+        повторяется сразу, не дожидаясь конца ответа
+
+        Returns:
+            bytes: Изображение или None, если в ответе его нет
+
+        Raises:
+            OpenRouterAPIError: При ошибочном статусе или ошибке посреди потока
+        """
+        started = time.monotonic()
+        decode_elapsed = 0.0
+        parser = ChatStreamParser()
+        try:
+            async with self.client.stream(
+                "POST",
+                self.api_url,
+                content=body,
+                headers={"Content-Type": "application/json", "Accept": "text/event-stream"},
+                extensions={"trace": self._make_trace()},
+            ) as response:
+                upload_bytes_total.inc(len(body))
+
+                if response.status_code != 200:
+                    error_body = await response.aread()
+                    raise OpenRouterAPIError.from_response(
+                        response, error_body[:1000].decode("utf-8", "replace")
+                    )
+
+                first_byte = True
+                first_event = True
+                batch = bytearray()
+                async for chunk in response.aiter_bytes():
+                    if first_byte:
+                        first_byte = False
+                        self._record_ttfb(time.monotonic() - started, "sse")
+
+                    # Текстовые события разбираются сразу, изображение - пачками
+                    batch += chunk
+                    if parser.in_image_event and len(batch) < FEED_BATCH_SIZE:
+                        continue
+                    feed_started = time.monotonic()
+                    await self._run_stateful(parser.feed, bytes(batch))
+                    decode_elapsed += time.monotonic() - feed_started
+                    batch.clear()
+
+                    if first_event and parser.events:
+                        first_event = False
+                        first_event_seconds.observe(time.monotonic() - started)
+                    if parser.error:
+                        break
+
+                    abort = parser.abort_reason(self.sse_config.text_abort_chars)
+                    if abort is not None:
+                        kind, description = abort
+                        sse_aborts_total.inc(reason=kind)
+                        logger.warning(
+                            f"{prefix}: Поток прерван через "
+                            f"{time.monotonic() - started:.1f} с, {description}"
+                        )
+                        return None
+
+                if batch:
+                    feed_started = time.monotonic()
+                    await self._run_stateful(parser.feed, bytes(batch))
+                    decode_elapsed += time.monotonic() - feed_started
+                parser.close()
+        finally:
+            stage_timer.record("upstream", time.monotonic() - started - decode_elapsed)
+            if decode_elapsed:
+                stage_timer.record("decode", decode_elapsed)
+
+        if parser.error:
+            code = parser.error.get("code")
+            raise OpenRouterAPIError(
+                code if isinstance(code, int) else 502,
+                str(parser.error.get("message") or parser.error)[:1000],
+            )
+
+        response_peak_bytes.observe(parser.peak_bytes, mode="sse")
+        logger.info(
+            f"{prefix}: Ответ от OpenRouter получен (SSE, событий: {parser.events}), "
+            f"пиковая память разбора: {parser.peak_bytes} байт"
+        )
+
+        if parser.complete and parser.image:
+            logger.info(f"{prefix}: Изображение успешно декодировано из base64 ({parser.mime_type})")
+            return bytes(parser.image)
+
+        if parser.image_parser.found:
+            logger.warning(f"{prefix}: Data URL изображения оборван")
+        else:
+            logger.warning(f"{prefix}: В ответе нет сгенерированных изображений: {parser.describe()}")
+        return None
+
+    @staticmethod
+    def _record_ttfb(seconds: float, mode: str):
+        """Учесть время до первого байта ответа отдельно от общего времени"""
+        ttfb_seconds.observe(seconds, mode=mode)
+        stage_timer.record("ttfb", seconds)
+
+    async def _request_image_buffered(self, body: bytes, prefix: str) -> Optional[bytes]:
+        """
+        Отправить запрос и разобрать ответ целиком через response.json()
+
+        Returns:
+            bytes: Изображение или None, если в ответе его нет
+
+        Raises:
+            OpenRouterAPIError: При ответе с ошибочным статусом
+        """
+        with stage_timer.stage("upstream"):
+            response = await self.client.post(
+                self.api_url,
+                content=body,
+                headers={"Content-Type": "application/json"},
+                extensions={"trace": self._make_trace()},
+            )
+        upload_bytes_total.inc(len(body))
+
+        if response.status_code != 200:
+            raise OpenRouterAPIError.from_response(response, response.text[:1000])
+
+        with stage_timer.stage("decode"):
+            decoded = await self._run_cpu(decode_response, response.content)
+        logger.info(f"{prefix}: Ответ от OpenRouter получен")
+
+        if decoded.image is None:
+            logger.warning(f"{prefix}: {decoded.problem}")
+            return None
+
+        response_peak_bytes.observe(decoded.peak_bytes, mode="buffered")
+        logger.info(
+            f"{prefix}: Получено изображений: {decoded.images_count}, "
+            f"пиковая память разбора: {decoded.peak_bytes} байт"
+        )
+        logger.info(f"{prefix}: Изображение успешно декодировано из base64 ({decoded.mime_type})")
+        return decoded.image
+
+
+class OpenRouterService:
+    """
+    Генерация изображений: подготовка фото, повторы, хеджирование и
+    автомат защиты поверх сменного бэкенда (openrouter.backend)
+    """
+
+    def __init__(self):
+        # Основная модель определяет ключи кеша и single-flight
         self.model = config.openrouter.model
+        self.models = [config.openrouter.model] + config.openrouter.fallback_models
+        self.hedging = config.openrouter.hedging
+        self.retry_config = config.openrouter.retry
+        self.circuit_breaker = CircuitBreaker(config.openrouter.circuit_breaker)
         self.prompt = config.openrouter.generation_prompt
+        self.input_config = config.openrouter.input_image
+        self.output_config = config.openrouter.output_image
+        self.backend: ImageBackend = BACKENDS[config.openrouter.backend]()
+
+    async def start(self):
+        """Подготовить бэкенд генерации"""
+        await self.backend.start()
+        logger.info(f"Бэкенд генерации: {self.backend.name}")
 
-    async def download_photo(self, bot, photo: PhotoSize) -> bytes:
+    async def close(self):
+        """Закрыть соединения бэкенда генерации"""
+        await self.backend.close()
+
+    def select_photo(self, photos: List[PhotoSize]) -> PhotoSize:
+        """
+        Выбрать наименьший размер фото, достаточный для кадра 2:3
+
+        Telegram присылает несколько размеров одного фото по возрастанию.
+        Берём наименьший, который покрывает min_width x min_height в любой
+        ориентации, иначе наибольший из доступных
+
+        Args:
+            photos: Список размеров из message.photo
+
+        Returns:
+            PhotoSize: Выбранный размер
+        """
+        need_short = min(self.input_config.min_width, self.input_config.min_height)
+        need_long = max(self.input_config.min_width, self.input_config.min_height)
+
+        for photo in sorted(photos, key=lambda p: p.width * p.height):
+            if min(photo.width, photo.height) >= need_short and max(photo.width, photo.height) >= need_long:
+                return photo
+
+        return max(photos, key=lambda p: p.width * p.height)
+
+    @property
+    def result_filename(self) -> str:
+        """Имя файла результата при загрузке в Telegram"""
+        if not self.output_config.enabled:
+            return "generated_image.jpg"
+        return f"generated_image.{OUTPUT_EXTENSIONS[self.output_config.format]}"
+
+    async def _run_image(self, func: Callable[..., bytes], *args) -> bytes:
+        """
+        Выполнить обработку изображения в пуле бэкенда
+
+        Пул ограничивает Pillow тем же max_workers, что и кодирование
+        base64/JSON. У бэкенда без пула работа уходит в стандартный пул потоков
+        """
+        executor = getattr(self.backend, "executor", None)
+        return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+    async def download_photo(self, bot, file_id: str) -> bytes:
         """
         Скачать фотографию от пользователя
 
         Args:
             bot: Экземпляр бота
-            photo: Объект фотографии
+            file_id: file_id фотографии в Telegram
 
         Returns:
             bytes: Содержимое фотографии
         """
         try:
-            file = await bot.get_file(photo.file_id)
-            downloaded_file = await bot.download_file(file.file_path)
-
-            # Читаем содержимое
-            if isinstance(downloaded_file, BytesIO):
-                photo_bytes = downloaded_file.read()
-            else:
-                photo_bytes = downloaded_file
-
+            photo_bytes = await telegram_file_downloader.download(bot, file_id)
             logger.debug(f"Фото скачано: {len(photo_bytes)} байт")
             return photo_bytes
 
@@ -48,171 +939,313 @@ class OpenRouterService:
             logger.error(f"Ошибка при скачивании фото: {e}")
             raise
 
-    async def generate_image(self, image_bytes: bytes, max_retries: int = 3) -> Optional[bytes]:
+    async def generate_image(
+        self, image_bytes: bytes, max_retries: Optional[int] = None
+    ) -> Optional[bytes]:
         """
         Сгенерировать новое изображение на основе исходного с механизмом retry
 
+        Все попытки укладываются в общий дедлайн openrouter.retry.deadline.
+        Между попытками - экспоненциальная задержка со случайным разбросом
+        (не меньше Retry-After от OpenRouter), каждый повтор берёт разрешение
+        у общего на процесс бюджета повторов
+
         Args:
             image_bytes: Исходное изображение в байтах
-            max_retries: Максимальное количество попыток (по умолчанию 3)
+            max_retries: Максимальное количество попыток (по умолчанию из конфига)
 
         Returns:
             bytes: Сгенерированное изображение или None при ошибке
         """
-        # Кодируем изображение в base64 один раз
-        image_base64 = base64.b64encode(image_bytes).decode('utf-8')
-        image_url = f"data:image/jpeg;base64,{image_base64}"
+        max_retries = max_retries or self.retry_config.max_attempts
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.retry_config.deadline
+        retry_budget.record_request()
 
-        # Подготовка запроса
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json",
-        }
+        # Данные, подготовленные бэкендом (тело запроса на модель), общие
+        # для всех попыток генерации
+        scratch: Dict[str, Any] = {}
 
-        payload = {
-            "model": self.model,
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": self.prompt
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": image_url
-                            }
-                        }
-                    ]
-                }
-            ],
-            "modalities": ["image", "text"]
-        }
+        def request(model: str, prefix: str) -> Awaitable[Optional[bytes]]:
+            return self._request_model(model, image_bytes, prefix, scratch)
 
-        # Попытки генерации с retry
+        # Попытки генерации: основная модель, затем резервные по кругу
         for attempt in range(1, max_retries + 1):
-            try:
-                logger.info(f"Попытка {attempt}/{max_retries}: Отправка запроса к OpenRouter, модель: {self.model}")
-
-                # Отправка запроса к OpenRouter
-                async with httpx.AsyncClient(timeout=300.0) as client:
-                    response = await client.post(
-                        self.api_url,
-                        headers=headers,
-                        json=payload
-                    )
+            prefix = f"Попытка {attempt}/{max_retries}"
+            model = self.models[(attempt - 1) % len(self.models)]
+            alternate = None
+            if self.hedging.enabled and len(self.models) > 1:
+                alternate = self.models[attempt % len(self.models)]
 
-                    if response.status_code != 200:
-                        logger.warning(
-                            f"Попытка {attempt}/{max_retries}: Ошибка OpenRouter API: "
-                            f"{response.status_code} - {response.text}"
-                        )
-                        # Если это не последняя попытка, ждем и пробуем снова
-                        if attempt < max_retries:
-                            await asyncio.sleep(2 * attempt)  # Увеличивающаяся задержка
-                            continue
-                        return None
+            retry_after = None
+            try:
+                generated = await asyncio.wait_for(
+                    self._hedged_request(model, alternate, request, prefix),
+                    timeout=deadline - loop.time(),
+                )
+                if generated:
+                    return generated
+            except asyncio.TimeoutError:
+                deadline_exceeded_total.inc()
+                logger.warning(
+                    f"{prefix}: Превышено общее время генерации "
+                    f"({self.retry_config.deadline:.0f} с)"
+                )
+                break
+            except CircuitOpenError:
+                logger.warning(f"{prefix}: Автомат защиты OpenRouter разомкнут, запрос не отправлен")
+                break
+            except ImageBackendError as e:
+                if e.status_code in NON_RETRYABLE_STATUSES:
+                    logger.error(f"{prefix}: Ошибка {e.status_code} не исправится повтором")
+                    break
+                retry_after = e.retry_after
 
-                    result = response.json()
-                    logger.info(f"Попытка {attempt}/{max_retries}: Ответ от OpenRouter получен")
-                    logger.debug(f"Полный ответ: {result}")
+            # Если это не последняя попытка, ждем и пробуем снова
+            if attempt == max_retries:
+                break
 
-                    # Проверяем наличие choices
-                    if not result.get("choices"):
-                        logger.warning(f"Попытка {attempt}/{max_retries}: В ответе нет choices")
-                        if attempt < max_retries:
-                            await asyncio.sleep(2 * attempt)
-                            continue
-                        return None
+            delay = self._backoff_delay(attempt)
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+            if loop.time() + delay >= deadline:
+                logger.warning(f"{prefix}: Повтор через {delay:.1f} с не укладывается в дедлайн")
+                break
+            if not retry_budget.try_acquire():
+                logger.warning(f"{prefix}: Бюджет повторов исчерпан, повтор не выполняется")
+                break
 
-                    message = result["choices"][0]["message"]
-
-                    # Проверяем наличие сгенерированных изображений
-                    if message.get("images"):
-                        logger.info(f"Попытка {attempt}/{max_retries}: Получено изображений: {len(message['images'])}")
-
-                        # Берем первое изображение
-                        image_data = message["images"][0]
-                        image_url_from_response = image_data.get("image_url", {}).get("url", "")
-
-                        if image_url_from_response.startswith("data:image"):
-                            # Это base64 data URL
-                            # Формат: data:image/png;base64,<base64_data>
-                            if "base64," in image_url_from_response:
-                                base64_data = image_url_from_response.split("base64,")[1]
-                                decoded_image = base64.b64decode(base64_data)
-                                logger.info(f"Попытка {attempt}/{max_retries}: Изображение успешно декодировано из base64")
-                                return decoded_image
-                            else:
-                                logger.warning(f"Попытка {attempt}/{max_retries}: Base64 data не найдена в URL")
-                                if attempt < max_retries:
-                                    await asyncio.sleep(2 * attempt)
-                                    continue
-                                return None
-                        else:
-                            logger.warning(
-                                f"Попытка {attempt}/{max_retries}: Неожиданный формат URL изображения: "
-                                f"{image_url_from_response[:50] if image_url_from_response else 'empty'}"
-                            )
-                            if attempt < max_retries:
-                                await asyncio.sleep(2 * attempt)
-                                continue
-                            return None
-                    else:
-                        logger.warning(f"Попытка {attempt}/{max_retries}: В ответе нет сгенерированных изображений")
-                        logger.debug(f"Message content: {message.get('content')}")
-                        # Если это не последняя попытка, ждем и пробуем снова
-                        if attempt < max_retries:
-                            await asyncio.sleep(2 * attempt)
-                            continue
-                        return None
-
-            except httpx.TimeoutException:
-                logger.warning(f"Попытка {attempt}/{max_retries}: Таймаут при обращении к OpenRouter API")
-                if attempt < max_retries:
-                    await asyncio.sleep(2 * attempt)
-                    continue
-                logger.error(f"Все {max_retries} попытки завершились таймаутом")
-                return None
-            except Exception as e:
-                logger.warning(f"Попытка {attempt}/{max_retries}: Ошибка при генерации изображения: {e}")
-                if attempt < max_retries:
-                    await asyncio.sleep(2 * attempt)
-                    continue
-                logger.error(f"Все {max_retries} попытки завершились ошибкой: {e}", exc_info=True)
-                return None
+            logger.info(f"{prefix}: Повтор через {delay:.1f} с")
+            await asyncio.sleep(delay)
 
         # Если дошли сюда, все попытки исчерпаны
-        logger.error(f"Не удалось сгенерировать изображение после {max_retries} попыток")
+        logger.error(f"Не удалось сгенерировать изображение после {attempt} попыток")
         return None
 
+    def _backoff_delay(self, attempt: int) -> float:
+        """Экспоненциальная задержка перед повтором с полным случайным разбросом"""
+        ceiling = min(
+            self.retry_config.backoff_max,
+            self.retry_config.backoff_base * 2 ** (attempt - 1),
+        )
+        return random.uniform(0, ceiling)
+
+    def _hedge_delay(self, model: str) -> float:
+        """
+        Через сколько секунд дублировать запрос к модели на резервную
+
+        Пока наблюдений мало, используется initial_delay, затем скользящий
+        перцентиль (по умолчанию p90) времени успешных ответов модели
+        """
+        if generation_seconds.count(model=model) < self.hedging.min_samples:
+            return self.hedging.initial_delay
+        delay = generation_seconds.percentile(self.hedging.quantile, model=model)
+        return max(self.hedging.min_delay, delay)
+
+    async def _hedged_request(
+        self,
+        model: str,
+        alternate: Optional[str],
+        request: Callable[[str, str], Awaitable[Optional[bytes]]],
+        prefix: str,
+    ) -> Optional[bytes]:
+        """
+        Запрос к модели с подстраховкой резервной моделью
+
+        Если основная модель не ответила за свой скользящий p90, тот же
+        запрос отправляется в alternate. Побеждает первое успешно полученное
+        изображение, второй запрос отменяется
+
+        Returns:
+            bytes: Изображение или None, если ни одна модель не справилась
+
+        Raises:
+            ImageBackendError: Если ни одна модель не справилась и провайдер вернул ошибку
+            CircuitOpenError: Если автомат защиты не пропустил запрос
+        """
+        tasks = {asyncio.create_task(request(model, prefix)): model}
+        try:
+            delay = self._hedge_delay(model) if alternate else None
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+
+            # Дублирующий запрос - тоже повтор и расходует бюджет повторов;
+            # пока автомат защиты не замкнут, запросы не дублируются
+            if (
+                not done
+                and self.circuit_breaker.state == CircuitBreaker.CLOSED
+                and retry_budget.try_acquire()
+            ):
+                logger.info(
+                    f"{prefix}: {model} не ответила за {delay:.1f} с, "
+                    f"дублируем запрос в {alternate}"
+                )
+                hedges_total.inc(model=alternate)
+                tasks[asyncio.create_task(request(alternate, prefix))] = alternate
+
+            error = None
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    try:
+                        generated = task.result()
+                    except (ImageBackendError, CircuitOpenError) as e:
+                        error = e
+                        continue
+                    if generated:
+                        if len(tasks) > 1:
+                            hedge_wins_total.inc(model=tasks[task])
+                            logger.info(f"{prefix}: Первым ответила модель {tasks[task]}")
+                        return generated
+
+            if error is not None:
+                raise error
+            return None
+        finally:
+            # Проигравший запрос больше не нужен
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _request_model(
+        self, model: str, image_bytes: bytes, prefix: str, scratch: Dict[str, Any]
+    ) -> Optional[bytes]:
+        """
+        Один запрос генерации к конкретной модели через бэкенд
+
+        Returns:
+            bytes: Изображение или None при ошибке
+
+        Raises:
+            ImageBackendError: При ответе провайдера с ошибочным статусом
+            CircuitOpenError: Если автомат защиты не пропускает запрос
+        """
+        if not self.circuit_breaker.allow_request():
+            raise CircuitOpenError()
+
+        prefix = f"{prefix} [{model}]"
+        started = time.monotonic()
+        # Исход для автомата защиты: None - запрос не дал сведений о здоровье OpenRouter
+        healthy: Optional[bool] = None
+        try:
+            logger.info(f"{prefix}: Отправка запроса к {self.backend.name}")
+
+            generated = await self.backend.generate(
+                image_bytes,
+                self.prompt,
+                GenerationOptions(model=model, log_prefix=prefix, scratch=scratch),
+            )
+            # Ответ без изображения (отказ модели) - не сбой провайдера
+            healthy = True
+
+        except ImageBackendError as e:
+            logger.warning(f"{prefix}: {e}")
+            model_results_total.inc(model=model, result="failure")
+            healthy = e.status_code in CLIENT_ERROR_STATUSES
+            raise
+        except (httpx.TimeoutException, TimeoutError):
+            logger.warning(f"{prefix}: Таймаут при обращении к {self.backend.name}")
+            generated = None
+            healthy = False
+        except (httpx.TransportError, ConnectionError) as e:
+            logger.warning(f"{prefix}: Сетевая ошибка при обращении к {self.backend.name}: {e}")
+            generated = None
+            healthy = False
+        except Exception as e:
+            logger.warning(f"{prefix}: Ошибка при генерации изображения: {e}")
+            generated = None
+        finally:
+            duration = time.monotonic() - started
+            if healthy is True:
+                self.circuit_breaker.record_success(duration)
+            elif healthy is False:
+                self.circuit_breaker.record_failure(duration)
+            else:
+                # Отмена (проигравший хедж, дедлайн) или ошибка разбора
+                self.circuit_breaker.record_cancelled()
+
+        if generated:
+            generation_seconds.observe(duration, model=model)
+            model_results_total.inc(model=model, result="success")
+        else:
+            model_results_total.inc(model=model, result="failure")
+        return generated
+
     async def process_user_image(
-        self, bot, photo: PhotoSize
-    ) -> Optional[BufferedInputFile]:
+        self, bot, file_id: str, timings: Optional[dict] = None
+    ) -> Optional[GeneratedImage]:
         """
         Обработать изображение пользователя и вернуть сгенерированное
 
+        Перед обращением к OpenRouter проверяется кеш результатов по хешу
+        (исходное изображение, промпт, модель)
+
         Args:
             bot: Экземпляр бота
-            photo: Фотография от пользователя
+            file_id: file_id фотографии от пользователя
+            timings: Словарь для записи длительности этапов (секунды)
 
         Returns:
-            BufferedInputFile: Готовое к отправке изображение или None
+            GeneratedImage: Готовое к отправке изображение или None
         """
+        if timings is None:
+            timings = {}
+
         try:
-            # Скачиваем исходное изображение
-            image_bytes = await self.download_photo(bot, photo)
+            # Скачиваем исходное изображение (этапы get_file и download)
+            image_bytes = await self.download_photo(bot, file_id)
+
+            cache_key = None
+            if result_cache.enabled:
+                cache_key = result_cache.make_key(image_bytes, self.prompt, self.model)
+                cached = await result_cache.get(cache_key)
+                if cached is not None:
+                    if cached.telegram_file_id:
+                        logger.info(f"Результат найден в кеше (file_id): {cache_key[:12]}")
+                        return GeneratedImage(
+                            photo=cached.telegram_file_id, cache_key=cache_key, from_cache=True
+                        )
 
-            # Генерируем новое изображение
-            generated_bytes = await self.generate_image(image_bytes)
+                    cached_bytes = await result_cache.read(cache_key)
+                    if cached_bytes:
+                        logger.info(f"Результат найден в кеше: {cache_key[:12]}")
+                        return GeneratedImage(
+                            photo=BufferedInputFile(file=cached_bytes, filename=self.result_filename),
+                            cache_key=cache_key,
+                            from_cache=True,
+                        )
+
+            # Подбираем размер и вес фото перед отправкой
+            input_image_bytes.observe(len(image_bytes), stage="original")
+            with stage_timer.stage("prepare", timings):
+                prepared_bytes = await self._run_image(prepare_image, image_bytes, self.input_config)
+            input_image_bytes.observe(len(prepared_bytes), stage="prepared")
+
+            # Генерируем новое изображение (этапы encode, upstream и decode внутри)
+            with stage_timer.stage("generate", timings):
+                generated_bytes = await self.generate_image(prepared_bytes)
 
             if generated_bytes:
+                output_image_bytes.observe(len(generated_bytes), stage="generated")
+                if self.output_config.enabled:
+                    # Пережимаем PNG модели вне event loop: загрузка быстрее,
+                    # и в кеш попадает уже готовый к отправке файл
+                    try:
+                        with stage_timer.stage("transcode", timings):
+                            generated_bytes = await self._run_image(
+                                transcode_result, generated_bytes, self.output_config
+                            )
+                    except Exception as e:
+                        logger.warning(f"Не удалось перекодировать результат, отправляется исходный: {e}")
+                    output_image_bytes.observe(len(generated_bytes), stage="transcoded")
+
+                if cache_key:
+                    await result_cache.put(cache_key, generated_bytes)
+
                 # Создаем BufferedInputFile для отправки в Telegram
-                return BufferedInputFile(
-                    file=generated_bytes,
-                    filename="generated_image.jpg"
+                return GeneratedImage(
+                    photo=BufferedInputFile(file=generated_bytes, filename=self.result_filename),
+                    cache_key=cache_key,
                 )
 
             return None
@@ -222,5 +1255,18 @@ class OpenRouterService:
             return None
 
 
+# Общий на процесс бюджет повторов и дублирующих запросов к OpenRouter
+retry_budget = RetryBudget(
+    ratio=config.openrouter.retry.budget_ratio,
+    min_per_second=config.openrouter.retry.budget_min_per_second,
+    ttl=config.openrouter.retry.budget_window_seconds,
+)
+
+# Доступные бэкенды генерации (openrouter.backend)
+BACKENDS: Dict[str, Callable[[], ImageBackend]] = {
+    "openrouter": OpenRouterBackend,
+    "mock": MockBackend,
+}
+
 # Глобальный экземпляр сервиса
 openrouter_service = OpenRouterService()
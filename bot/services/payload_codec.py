@@ -0,0 +1,132 @@
+"""
+Кодирование запросов и декодирование ответов OpenRouter
+
+CPU-ёмкие шаги вынесены в чистые функции модуля, чтобы их можно было
+выполнять в пуле потоков или процессов, не блокируя цикл событий
+"""
+import base64
+import json
+from dataclasses import dataclass
+from typing import Optional
+
+
+@dataclass
+class DecodedResponse:
+    """Результат разбора буферизованного ответа OpenRouter"""
+    # Декодированное изображение или None
+    image: Optional[bytes] = None
+    # MIME-тип изображения из data URL
+    mime_type: Optional[str] = None
+    # Количество изображений в ответе
+    images_count: int = 0
+    # Описание проблемы, если изображения нет
+    problem: Optional[str] = None
+    # Пиковая память на разбор ответа
+    peak_bytes: int = 0
+
+
+def encode_request(image_bytes: bytes, model: str, prompt: str, stream: bool = False) -> bytes:
+    """
+    Собрать тело запроса генерации
+
+    Args:
+        image_bytes: Исходное изображение (JPEG)
+        model: Модель OpenRouter
+        prompt: Промпт генерации
+        stream: Запросить ответ событиями SSE
+
+    Returns:
+        bytes: JSON тела запроса в UTF-8
+    """
+    image_base64 = base64.b64encode(image_bytes).decode("ascii")
+
+    payload = {
+        "model": model,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": prompt
+                    },
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": f"data:image/jpeg;base64,{image_base64}"
+                        }
+                    }
+                ]
+            }
+        ],
+        "modalities": ["image", "text"]
+    }
+    if stream:
+        payload["stream"] = True
+    return json.dumps(payload, ensure_ascii=False).encode("utf-8")
+
+
+def decode_response(content: bytes) -> DecodedResponse:
+    """
+    Разобрать ответ OpenRouter целиком и декодировать первое изображение
+
+    Args:
+        content: Тело ответа
+
+    Returns:
+        DecodedResponse: Изображение или описание проблемы
+    """
+    result = json.loads(content)
+
+    # Проверяем наличие choices
+    if not result.get("choices"):
+        return DecodedResponse(problem=f"В ответе нет choices: {describe_response(content)}")
+
+    message = result["choices"][0]["message"]
+
+    # Проверяем наличие сгенерированных изображений
+    if not message.get("images"):
+        return DecodedResponse(
+            problem=f"В ответе нет сгенерированных изображений: {describe_response(content)}"
+        )
+
+    images_count = len(message["images"])
+
+    # Берем первое изображение, формат: data:image/png;base64,<base64_data>
+    image_url = message["images"][0].get("image_url", {}).get("url", "")
+    if not image_url.startswith("data:image") or "base64," not in image_url:
+        return DecodedResponse(
+            images_count=images_count,
+            problem=f"Неожиданный формат URL изображения: {image_url[:50] if image_url else 'empty'}",
+        )
+
+    header, base64_data = image_url.split("base64,", 1)
+    image = base64.b64decode(base64_data)
+
+    # Тело, строка data URL, копия после split и результат живут одновременно
+    peak_bytes = len(content) + len(image_url) + len(base64_data) + len(image)
+
+    return DecodedResponse(
+        image=image,
+        mime_type=header[len("data:"):].rstrip(";"),
+        images_count=images_count,
+        peak_bytes=peak_bytes,
+    )
+
+
+def describe_response(text: bytes) -> str:
+    """Краткое описание ответа без изображения для логов"""
+    try:
+        result = json.loads(text)
+    except ValueError:
+        return text[:300].decode("utf-8", "replace")
+
+    if result.get("error"):
+        return f"ошибка: {str(result['error'])[:300]}"
+
+    choices = result.get("choices") or []
+    if choices:
+        content = (choices[0].get("message") or {}).get("content")
+        return f"текст модели: {str(content)[:300]}"
+
+    return text[:300].decode("utf-8", "replace")
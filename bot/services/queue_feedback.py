@@ -0,0 +1,221 @@
+"""Позиция в очереди и примерное время ожидания в сообщении о начале обработки"""
+import asyncio
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+
+from bot.config import config
+from bot.database import get_db_session
+from bot.logger import logger
+from bot.models.generation_job import LANES
+from bot.repositories.generation_job_repository import GenerationJobRepository, WaitingJob
+from bot.services.lane_scheduler import LaneScheduler
+from bot.services.metrics import metrics
+
+feedback_edits_total = metrics.counter(
+    "queue_feedback_edits_total", "Правки сообщений о позиции в очереди"
+)
+estimated_wait_seconds = metrics.gauge(
+    "generation_estimated_wait_seconds",
+    "Оценка ожидания для новой задачи по классам приоритета (p50)",
+)
+
+
+def format_duration(seconds: float) -> str:
+    """Человекочитаемая длительность: секунды до минуты, дальше минуты"""
+    if seconds < 60:
+        return f"{max(5, int(round(seconds / 5)) * 5)} сек"
+    return f"{int(round(seconds / 60))} мин"
+
+
+class QueueFeedbackService:
+    """
+    Обратная связь о положении задачи в очереди
+
+    По скользящим перцентилям длительности обработки (из последних
+    выполненных задач) и длине очереди оценивает позицию и время ожидания.
+    Фоновый цикл обновляет сообщения "Начинаем волшебство", но не чаще
+    update_interval на сообщение и не больше max_edits_per_update за проход,
+    чтобы не упереться в лимиты Telegram API
+    """
+
+    def __init__(self):
+        self.settings = config.queue_feedback
+        self.concurrency = max(1, config.workers.concurrency)
+        self.scheduler = (
+            LaneScheduler(config.priority_lanes.weights)
+            if config.priority_lanes.enabled else None
+        )
+        self._durations: Tuple[float, float] = (
+            self.settings.default_seconds, self.settings.default_seconds * 2
+        )
+        self._durations_updated_at = 0.0
+        # Последний показанный текст по задаче
+        self._shown: Dict[str, str] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    async def get_durations(self, job_repo: GenerationJobRepository) -> Tuple[float, float]:
+        """
+        Перцентили p50 и p90 длительности обработки задачи
+
+        Обновляются из БД не чаще stats_refresh секунд, поэтому одинаково
+        работают и со встроенными воркерами, и с отдельным процессом
+        """
+        if time.monotonic() - self._durations_updated_at >= self.settings.stats_refresh:
+            self._durations_updated_at = time.monotonic()
+            percentiles = await job_repo.get_duration_percentiles((0.5, 0.9))
+            if percentiles:
+                self._durations = (percentiles[0], max(percentiles[0], percentiles[1]))
+        return self._durations
+
+    def estimate_position(
+        self, lane: str, ahead_in_lane: int, ahead_total: int, depths: Dict[str, int]
+    ) -> int:
+        """
+        Примерное число задач, которые будут взяты раньше
+
+        Args:
+            lane: Класс задачи
+            ahead_in_lane: Задач того же класса, поставленных раньше
+            ahead_total: Всех задач, поставленных раньше
+            depths: Длина очереди по классам
+        """
+        if self.scheduler is None:
+            return ahead_total
+        return self.scheduler.estimate_position(lane, ahead_in_lane, depths)
+
+    def estimate_wait(self, position: int, durations: Tuple[float, float]) -> Tuple[float, float]:
+        """
+        Оценка времени до готовности результата
+
+        Returns:
+            Кортеж (по p50, по p90) в секундах
+        """
+        rounds = position // self.concurrency + 1
+        return rounds * durations[0], rounds * durations[1]
+
+    @staticmethod
+    def build_queued_text(position: int, wait: Tuple[float, float]) -> str:
+        """Текст сообщения для задачи в очереди"""
+        low, high = format_duration(wait[0]), format_duration(wait[1])
+        estimate = low if low == high else f"{low} – {high}"
+        if position == 0:
+            queue_line = "🚀 Твоё фото следующее в очереди\n"
+        else:
+            queue_line = f"👥 Перед тобой в очереди: <b>{position}</b>\n"
+        return (
+            "✨ <b>Начинаем волшебство!</b>\n\n"
+            "🎨 Превращаем твоё фото в винтажную фотографию в стиле 90х...\n"
+            f"{queue_line}"
+            f"🎬 Примерное время ожидания: <b>{estimate}</b>\n\n"
+            "⏳ Пожалуйста, подожди немного - повторно отправлять фото не нужно"
+        )
+
+    @staticmethod
+    def build_processing_text(durations: Tuple[float, float]) -> str:
+        """Текст сообщения для задачи, взятой в работу"""
+        return (
+            "✨ <b>Начинаем волшебство!</b>\n\n"
+            "🎨 Твоё фото уже обрабатывается...\n"
+            f"🎬 Обычно это занимает около {format_duration(durations[0])}\n\n"
+            "⏳ Пожалуйста, подожди немного - повторно отправлять фото не нужно"
+        )
+
+    async def initial_text(self, job_repo: GenerationJobRepository, lane: str) -> str:
+        """
+        Текст подтверждения для только что поставленной задачи
+
+        Задача уже в очереди (её транзакция зафиксирована), поэтому все
+        задачи её класса, кроме неё самой, - впереди неё
+        """
+        depths = await job_repo.get_queue_depths()
+        durations = await self.get_durations(job_repo)
+        position = self.estimate_position(
+            lane,
+            max(0, depths.get(lane, 1) - 1),
+            max(0, sum(depths.values()) - 1),
+            depths,
+        )
+        return self.build_queued_text(position, self.estimate_wait(position, durations))
+
+    def remember(self, job_id, text: str):
+        """Запомнить текст, уже показанный пользователю"""
+        self._shown[str(job_id)] = text
+
+    def start(self, bot: Bot):
+        """Запустить фоновое обновление сообщений"""
+        if self.settings.enabled and self._task is None:
+            self._task = asyncio.create_task(self._update_loop(bot))
+
+    async def stop(self):
+        """Остановить фоновое обновление"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _update_loop(self, bot: Bot):
+        while True:
+            try:
+                await self._update_messages(bot)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка при обновлении позиций в очереди: {e}", exc_info=True)
+
+            await asyncio.sleep(self.settings.update_interval)
+
+    async def _update_messages(self, bot: Bot):
+        """Пересчитать позиции и обновить изменившиеся сообщения"""
+        async with get_db_session() as session:
+            job_repo = GenerationJobRepository(session)
+            jobs = await job_repo.get_waiting_with_messages()
+            depths = Counter(await job_repo.get_queue_depths())
+            durations = await self.get_durations(job_repo)
+
+        total = sum(depths.values())
+
+        # Оценка для задачи, которая встала бы в очередь сейчас
+        for lane in LANES:
+            position = self.estimate_position(lane, depths[lane], total, depths + Counter({lane: 1}))
+            estimated_wait_seconds.set(self.estimate_wait(position, durations)[0], lane=lane)
+
+        updates: List[Tuple[WaitingJob, str]] = []
+        for job in jobs:
+            if job.status == "queued":
+                position = self.estimate_position(
+                    job.lane, job.ahead_in_lane, job.ahead_total, depths
+                )
+                text = self.build_queued_text(position, self.estimate_wait(position, durations))
+            else:
+                text = self.build_processing_text(durations)
+
+            if self._shown.get(str(job.id)) != text:
+                updates.append((job, text))
+
+        # Забываем завершённые задачи
+        active = {str(job.id) for job in jobs}
+        for job_id in list(self._shown):
+            if job_id not in active:
+                del self._shown[job_id]
+
+        for job, text in updates[: self.settings.max_edits_per_update]:
+            try:
+                await bot.edit_message_text(
+                    text=text, chat_id=job.chat_id, message_id=job.processing_message_id
+                )
+                feedback_edits_total.inc()
+            except TelegramBadRequest:
+                # Сообщение уже удалено воркером или текст не изменился
+                pass
+            self.remember(job.id, text)
+
+
+# Глобальный экземпляр сервиса
+queue_feedback_service = QueueFeedbackService()
@@ -0,0 +1,252 @@
+"""Кеш результатов генерации, адресуемый по содержимому"""
+import asyncio
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+from bot.config import config
+from bot.logger import logger
+from bot.services.metrics import metrics
+
+cache_hits_total = metrics.counter(
+    "result_cache_hits_total", "Попадания в кеш результатов генерации"
+)
+cache_misses_total = metrics.counter(
+    "result_cache_misses_total", "Промахи кеша результатов генерации"
+)
+cache_file_id_hits_total = metrics.counter(
+    "result_cache_file_id_hits_total",
+    "Попадания, отданные по Telegram file_id без повторной загрузки",
+)
+cache_evictions_total = metrics.counter(
+    "result_cache_evictions_total", "Записи, вытесненные из кеша по размеру"
+)
+cache_size_bytes = metrics.gauge(
+    "result_cache_size_bytes", "Текущий размер кеша результатов на диске"
+)
+
+
+@dataclass
+class CachedResult:
+    """Запись кеша результатов"""
+    key: str
+    size: int
+    telegram_file_id: Optional[str] = None
+
+
+class ResultCache:
+    """
+    Кеш сгенерированных изображений на диске с вытеснением LRU по размеру
+
+    Ключ - sha256 от (исходное изображение, промпт, модель). Помимо байтов
+    результата хранится Telegram file_id отправленного фото, чтобы повторный
+    запрос можно было отдать без загрузки файла в Telegram
+    """
+
+    def __init__(self, directory: Path, max_bytes: int, enabled: bool = True):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self._entries: "OrderedDict[str, CachedResult]" = OrderedDict()
+        self._total_bytes = 0
+        self._loaded = False
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def make_key(image_bytes: bytes, prompt: str, model: str) -> str:
+        """Вычислить ключ кеша"""
+        digest = hashlib.sha256()
+        digest.update(image_bytes)
+        digest.update(b"\0")
+        digest.update(prompt.encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(model.encode("utf-8"))
+        return digest.hexdigest()
+
+    def _data_path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.bin"
+
+    def _meta_path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.json"
+
+    def _load_index(self):
+        """Восстановить индекс по файлам на диске (порядок LRU по mtime)"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        found = []
+        for data_path in self.directory.glob("*/*.bin"):
+            key = data_path.stem
+            stat = data_path.stat()
+            file_id = None
+            meta_path = self._meta_path(key)
+            if meta_path.exists():
+                try:
+                    file_id = json.loads(meta_path.read_text()).get("telegram_file_id")
+                except (OSError, ValueError):
+                    pass
+            found.append((stat.st_mtime, CachedResult(key, stat.st_size, file_id)))
+
+        for _, entry in sorted(found, key=lambda item: item[0]):
+            self._entries[entry.key] = entry
+            self._total_bytes += entry.size
+
+        cache_size_bytes.set(self._total_bytes)
+        logger.info(
+            f"Кеш результатов загружен: {len(self._entries)} записей, {self._total_bytes} байт"
+        )
+
+    async def _ensure_loaded(self):
+        if not self._loaded:
+            await asyncio.to_thread(self._load_index)
+            self._loaded = True
+
+    async def get(self, key: str) -> Optional[CachedResult]:
+        """
+        Найти результат в кеше
+
+        Args:
+            key: Ключ кеша
+
+        Returns:
+            CachedResult или None при промахе
+        """
+        if not self.enabled:
+            return None
+
+        async with self._lock:
+            await self._ensure_loaded()
+            entry = self._entries.get(key)
+            if entry is None:
+                cache_misses_total.inc()
+                return None
+
+            self._entries.move_to_end(key)
+
+        cache_hits_total.inc()
+        if entry.telegram_file_id:
+            cache_file_id_hits_total.inc()
+
+        # Обновляем mtime, чтобы порядок LRU пережил перезапуск
+        try:
+            await asyncio.to_thread(os.utime, self._data_path(key))
+        except OSError:
+            pass
+
+        return entry
+
+    async def read(self, key: str) -> Optional[bytes]:
+        """Прочитать байты результата с диска"""
+        try:
+            return await asyncio.to_thread(self._data_path(key).read_bytes)
+        except OSError as e:
+            logger.warning(f"Не удалось прочитать запись кеша {key}: {e}")
+            await self._remove(key)
+            return None
+
+    async def put(self, key: str, data: bytes):
+        """
+        Сохранить результат в кеш
+
+        Args:
+            key: Ключ кеша
+            data: Байты сгенерированного изображения
+        """
+        if not self.enabled:
+            return
+
+        def write():
+            path = self._data_path(key)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix(".tmp")
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, path)
+
+        try:
+            await asyncio.to_thread(write)
+        except OSError as e:
+            logger.warning(f"Не удалось записать результат в кеш: {e}")
+            return
+
+        async with self._lock:
+            await self._ensure_loaded()
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._total_bytes -= previous.size
+            self._entries[key] = CachedResult(key, len(data))
+            self._total_bytes += len(data)
+            evicted = self._evict()
+
+        for evicted_key in evicted:
+            await asyncio.to_thread(self._delete_files, evicted_key)
+
+        cache_size_bytes.set(self._total_bytes)
+
+    async def set_file_id(self, key: str, telegram_file_id: str):
+        """
+        Запомнить Telegram file_id отправленного результата
+
+        Args:
+            key: Ключ кеша
+            telegram_file_id: file_id фото, возвращённый answer_photo
+        """
+        if not self.enabled:
+            return
+
+        async with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry.telegram_file_id = telegram_file_id
+
+        payload = json.dumps({"telegram_file_id": telegram_file_id})
+        try:
+            await asyncio.to_thread(self._meta_path(key).write_text, payload)
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить file_id в кеш: {e}")
+
+    async def invalidate_file_id(self, key: str):
+        """Забыть file_id (например, если Telegram его больше не принимает)"""
+        async with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.telegram_file_id = None
+        try:
+            await asyncio.to_thread(self._meta_path(key).unlink, True)
+        except OSError:
+            pass
+
+    def _evict(self) -> list:
+        """Вытеснить самые старые записи сверх лимита размера"""
+        evicted = []
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            key, entry = self._entries.popitem(last=False)
+            self._total_bytes -= entry.size
+            evicted.append(key)
+            cache_evictions_total.inc()
+        return evicted
+
+    async def _remove(self, key: str):
+        async with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._total_bytes -= entry.size
+        cache_size_bytes.set(self._total_bytes)
+        await asyncio.to_thread(self._delete_files, key)
+
+    def _delete_files(self, key: str):
+        for path in (self._data_path(key), self._meta_path(key)):
+            try:
+                path.unlink(missing_ok=True)
+            except OSError:
+                pass
+
+
+# Глобальный экземпляр кеша
+result_cache = ResultCache(
+    directory=Path(__file__).parent.parent.parent / config.result_cache.directory,
+    max_bytes=config.result_cache.max_size_mb * 1024 * 1024,
+    enabled=config.result_cache.enabled,
+)
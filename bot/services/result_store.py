@@ -0,0 +1,63 @@
+"""Хранилище сгенерированных изображений до их доставки пользователю"""
+import asyncio
+import os
+import uuid
+from pathlib import Path
+from typing import Optional
+
+from bot.config import config
+from bot.logger import logger
+
+
+class ResultStore:
+    """
+    Результаты задач на диске по ID задачи
+
+    В отличие от кеша результатов, записи не вытесняются: файл живёт, пока
+    задача не будет доставлена или окончательно не завершится ошибкой.
+    Так сбой на стороне Telegram не приводит к повторной оплате генерации
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+
+    def _path(self, job_id: uuid.UUID) -> Path:
+        return self.directory / f"{job_id}.bin"
+
+    async def save(self, job_id: uuid.UUID, data: bytes):
+        """
+        Сохранить результат задачи (атомарно: через временный файл)
+
+        Args:
+            job_id: ID задачи
+            data: Байты сгенерированного изображения
+        """
+        def write():
+            self.directory.mkdir(parents=True, exist_ok=True)
+            path = self._path(job_id)
+            tmp_path = path.with_suffix(".tmp")
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, path)
+
+        await asyncio.to_thread(write)
+
+    async def read(self, job_id: uuid.UUID) -> Optional[bytes]:
+        """Прочитать результат задачи или None, если его нет"""
+        try:
+            return await asyncio.to_thread(self._path(job_id).read_bytes)
+        except OSError as e:
+            logger.warning(f"Не удалось прочитать результат задачи {job_id}: {e}")
+            return None
+
+    async def delete(self, job_id: uuid.UUID):
+        """Удалить результат задачи после доставки"""
+        try:
+            await asyncio.to_thread(self._path(job_id).unlink, True)
+        except OSError as e:
+            logger.warning(f"Не удалось удалить результат задачи {job_id}: {e}")
+
+
+# Глобальный экземпляр хранилища
+result_store = ResultStore(
+    directory=Path(__file__).parent.parent.parent / config.delivery.directory,
+)
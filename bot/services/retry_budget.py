@@ -0,0 +1,63 @@
+"""Общий на процесс бюджет повторных запросов"""
+import time
+from collections import deque
+from typing import Deque
+
+from bot.services.metrics import metrics
+
+retries_total = metrics.counter(
+    "retry_budget_retries_total", "Повторные и дублирующие запросы, разрешённые бюджетом"
+)
+exhausted_total = metrics.counter(
+    "retry_budget_exhausted_total", "Повторы, отклонённые из-за исчерпания бюджета"
+)
+
+
+class RetryBudget:
+    """
+    Ограничение доли повторов относительно первичных запросов
+
+    За скользящее окно ttl секунд разрешается не больше
+    ratio * (число первичных запросов) + min_per_second * ttl повторов.
+    При сбое провайдера повторы не умножают нагрузку на него сверх этой доли.
+    Окно должно быть длиннее генерации: повторы проверяются через десятки
+    секунд после первичного запроса
+    """
+
+    def __init__(self, ratio: float, min_per_second: float, ttl: float):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.ttl = ttl
+        self._requests: Deque[float] = deque()
+        self._retries: Deque[float] = deque()
+
+    def _prune(self, now: float):
+        horizon = now - self.ttl
+        while self._requests and self._requests[0] < horizon:
+            self._requests.popleft()
+        while self._retries and self._retries[0] < horizon:
+            self._retries.popleft()
+
+    def record_request(self):
+        """Учесть первичный запрос"""
+        now = time.monotonic()
+        self._prune(now)
+        self._requests.append(now)
+
+    def try_acquire(self) -> bool:
+        """
+        Попросить разрешение на повтор
+
+        Returns:
+            bool: True, если повтор укладывается в бюджет (и он учтён)
+        """
+        now = time.monotonic()
+        self._prune(now)
+        allowed = self.ratio * len(self._requests) + self.min_per_second * self.ttl
+        if len(self._retries) >= allowed:
+            exhausted_total.inc()
+            return False
+
+        self._retries.append(now)
+        retries_total.inc()
+        return True
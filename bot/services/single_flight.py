@@ -0,0 +1,75 @@
+"""Объединение одновременных одинаковых запросов (single-flight)"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+from bot.logger import logger
+from bot.services.metrics import metrics
+
+coalesced_total = metrics.counter(
+    "single_flight_coalesced_total",
+    "Запросы, присоединившиеся к уже выполняющемуся одинаковому запросу",
+)
+in_flight = metrics.gauge(
+    "single_flight_in_flight", "Уникальные запросы, выполняющиеся прямо сейчас"
+)
+
+
+class SingleFlight:
+    """
+    Выполняет не более одного вызова на ключ одновременно
+
+    Повторные вызовы с тем же ключом, пришедшие во время выполнения,
+    ждут результата первого вызова вместо запуска собственного
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Future] = {}
+
+    async def do(
+        self, key: str, func: Callable[[], Awaitable[Any]]
+    ) -> Tuple[Any, bool]:
+        """
+        Выполнить func или присоединиться к уже идущему вызову
+
+        Args:
+            key: Ключ идентичности запроса
+            func: Корутинная функция без аргументов
+
+        Returns:
+            Кортеж (результат, присоединился_ли_к_чужому_вызову)
+        """
+        while True:
+            future = self._calls.get(key)
+            if future is None:
+                break
+
+            coalesced_total.inc()
+            logger.info(f"Запрос {key} объединён с уже выполняющимся")
+            try:
+                return await asyncio.shield(future), True
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    # Отменили нас самих, а не ведущий вызов
+                    raise
+                # Ведущий вызов отменён (например, остановка воркера) - пробуем сами
+
+        future = asyncio.get_running_loop().create_future()
+        self._calls[key] = future
+        in_flight.set(len(self._calls))
+
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Исключение получат ожидающие; помечаем его как обработанное
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            self._calls.pop(key, None)
+            in_flight.set(len(self._calls))
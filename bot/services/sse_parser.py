@@ -0,0 +1,160 @@
+"""Потоковый разбор ответа chat completions в режиме stream: true (SSE)"""
+import json
+from typing import Optional, Tuple
+
+from bot.services.data_url_parser import ImageDataURLParser
+
+# Событие длиннее этого не может быть текстовой дельтой - это изображение,
+# оно передаётся в парсер data URL по частям, не дожидаясь конца строки
+EVENT_BUFFER_LIMIT = 64 * 1024
+
+# Сколько символов текста модели хранить для логов
+TEXT_KEEP_CHARS = 1000
+
+# Признак data URL изображения в событии
+_IMAGE_MARKER = b"data:image"
+
+
+class ChatStreamParser:
+    """
+    Инкрементальный разбор server-sent events от OpenRouter
+
+    Небольшие события (текстовые дельты, finish_reason, ошибки) разбираются
+    как JSON по мере прихода, поэтому текстовый ответ или отказ модели
+    виден до конца потока. Событие с изображением не копится целиком:
+    его base64 декодируется по частям через ImageDataURLParser
+    """
+
+    def __init__(self):
+        self.image_parser = ImageDataURLParser()
+        # Текст модели (начало) и его полная длина
+        self.text = ""
+        self.text_chars = 0
+        self.refusal = ""
+        self.finish_reason: Optional[str] = None
+        # Ошибка, пришедшая событием посреди потока
+        self.error: Optional[dict] = None
+        # Получено событий с данными и признак [DONE]
+        self.events = 0
+        self.done = False
+        self._line = bytearray()
+        self._in_image_event = False
+
+    @property
+    def in_image_event(self) -> bool:
+        """Идёт чтение длинного события с изображением"""
+        return self._in_image_event
+
+    @property
+    def image(self) -> bytearray:
+        return self.image_parser.image
+
+    @property
+    def mime_type(self) -> Optional[str]:
+        return self.image_parser.mime_type
+
+    @property
+    def complete(self) -> bool:
+        """Изображение прочитано полностью"""
+        return self.image_parser.complete
+
+    @property
+    def peak_bytes(self) -> int:
+        return self.image_parser.peak_bytes + len(self._line)
+
+    def feed(self, chunk: bytes):
+        """Обработать очередной кусок потока"""
+        position = 0
+        while position < len(chunk):
+            end = chunk.find(b"\n", position)
+
+            if self._in_image_event:
+                self.image_parser.feed(chunk[position:] if end == -1 else chunk[position:end])
+                if end == -1:
+                    return
+                self._in_image_event = False
+                self.image_parser.close()
+                position = end + 1
+                continue
+
+            if end == -1:
+                self._line += chunk[position:]
+                if len(self._line) > EVENT_BUFFER_LIMIT and self._line.startswith(b"data:"):
+                    self._in_image_event = True
+                    self.image_parser.feed(bytes(self._line))
+                    self._line.clear()
+                return
+
+            self._line += chunk[position:end]
+            position = end + 1
+            line = bytes(self._line)
+            self._line.clear()
+            self._handle_line(line.rstrip(b"\r"))
+
+    def close(self):
+        """Завершить разбор после окончания потока"""
+        if self._line:
+            line = bytes(self._line)
+            self._line.clear()
+            self._handle_line(line.rstrip(b"\r"))
+        self.image_parser.close()
+
+    def abort_reason(self, text_abort_chars: int) -> Optional[Tuple[str, str]]:
+        """
+        Причина прервать поток, не дожидаясь конца ответа
+
+        Returns:
+            (вид, описание) - refusal или text, либо None, если ждём дальше
+        """
+        if self.image_parser.found:
+            return None
+        if self.refusal:
+            return "refusal", f"отказ модели: {self.refusal[:300]}"
+        if text_abort_chars and self.text_chars > text_abort_chars:
+            return "text", f"модель отвечает текстом: {self.text[:300]}"
+        return None
+
+    def describe(self) -> str:
+        """Краткое описание ответа без изображения для логов"""
+        if self.refusal:
+            return f"отказ модели: {self.refusal[:300]}"
+        if self.text:
+            return f"текст модели: {self.text[:300]}"
+        return f"finish_reason={self.finish_reason}, событий: {self.events}"
+
+    def _handle_line(self, line: bytes):
+        # Пустая строка разделяет события, ":" - комментарий (keep-alive)
+        if not line.startswith(b"data:"):
+            return
+
+        data = line[len(b"data:"):].strip()
+        if data == b"[DONE]":
+            self.done = True
+            return
+
+        self.events += 1
+        if _IMAGE_MARKER in data:
+            # Изображение в коротком событии
+            self.image_parser.feed(data)
+            self.image_parser.close()
+            return
+
+        try:
+            event = json.loads(data)
+        except ValueError:
+            return
+
+        if event.get("error"):
+            self.error = event["error"]
+
+        for choice in event.get("choices") or []:
+            delta = choice.get("delta") or {}
+            content = delta.get("content")
+            if isinstance(content, str) and content:
+                self.text_chars += len(content)
+                if len(self.text) < TEXT_KEEP_CHARS:
+                    self.text += content[: TEXT_KEEP_CHARS - len(self.text)]
+            if delta.get("refusal"):
+                self.refusal += str(delta["refusal"])
+            if choice.get("finish_reason"):
+                self.finish_reason = choice["finish_reason"]
@@ -0,0 +1,87 @@
+"""Замер длительности этапов обработки фото"""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, Optional
+
+from bot.logger import logger
+from bot.services.metrics import metrics
+
+stage_seconds = metrics.histogram(
+    "photo_stage_seconds",
+    "Длительность этапов обработки фото",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300),
+)
+stage_seconds_recent = metrics.summary(
+    "photo_stage_seconds_recent",
+    "Перцентили длительности этапов обработки фото по последним наблюдениям",
+    quantiles=(0.5, 0.9, 0.99),
+)
+
+# Этапы в порядке прохождения - для сводки в логе
+STAGE_ORDER = (
+    "spend", "ack", "queue_wait", "get_file", "download", "prepare", "encode",
+    "ttfb", "upstream", "decode", "generate", "transcode", "persist", "deliver",
+    "balance_message", "refund", "total",
+)
+
+# Словарь этапов текущей задачи: глубокие вызовы (кодирование, запрос
+# к модели, разбор ответа) пишут в него, не получая его параметром
+_current_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar(
+    "stage_timings", default=None
+)
+
+
+def record(name: str, seconds: float, timings: Optional[dict] = None):
+    """
+    Учесть длительность этапа
+
+    В метриках каждое наблюдение отдельное, в словаре этапов повторяющиеся
+    этапы (повторы запроса, порции разбора) суммируются
+
+    Args:
+        name: Название этапа
+        seconds: Длительность в секундах
+        timings: Словарь этапов; по умолчанию - словарь текущей задачи
+    """
+    stage_seconds.observe(seconds, stage=name)
+    stage_seconds_recent.observe(seconds, stage=name)
+
+    target = timings if timings is not None else _current_timings.get()
+    if target is not None:
+        target[name] = round(target.get(name, 0) + seconds, 3)
+
+
+@contextmanager
+def stage(name: str, timings: Optional[dict] = None) -> Iterator[None]:
+    """Замерить этап (в том числе при выходе по исключению)"""
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        record(name, time.monotonic() - started, timings)
+
+
+@contextmanager
+def bind(timings: dict) -> Iterator[dict]:
+    """Сделать словарь этапами текущей задачи (наследуется дочерними задачами asyncio)"""
+    token = _current_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _current_timings.reset(token)
+
+
+def format_summary(timings: dict) -> str:
+    """Сводка этапов для лога: известные этапы по порядку, затем прочие поля"""
+    names = [name for name in STAGE_ORDER if name in timings]
+    names += [name for name in timings if name not in STAGE_ORDER]
+    return ", ".join(
+        f"{name}={timings[name]:.3f}s" if isinstance(timings[name], float) else f"{name}={timings[name]}"
+        for name in names
+    )
+
+
+def log_summary(prefix: str, timings: dict):
+    """Записать сводку этапов в лог на уровне INFO"""
+    logger.info(f"{prefix}: {format_summary(timings)}")
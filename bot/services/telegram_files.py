@@ -0,0 +1,196 @@
+"""Скачивание файлов из Telegram с кешем file_path"""
+import asyncio
+import mmap
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional, Union
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import SimpleFilesPathWrapper, TelegramAPIServer
+from aiohttp import ClientResponseError
+
+from bot.config import TelegramFilesConfig, config
+from bot.logger import logger
+from bot.services import stage_timer
+from bot.services.metrics import metrics
+
+file_path_cache_total = metrics.counter(
+    "telegram_file_path_cache_total", "Поиск file_path по file_id в кеше: hit, miss"
+)
+download_seconds = metrics.histogram(
+    "telegram_download_seconds",
+    "Время скачивания фото пользователя (http - по сети, local - с диска сервера Bot API)",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+download_bytes = metrics.histogram(
+    "telegram_download_bytes",
+    "Размер скачанных фото пользователей",
+    buckets=(50_000, 100_000, 250_000, 500_000, 1_000_000, 2_000_000, 5_000_000),
+)
+
+# Статусы, с которыми Telegram отвечает на просроченный file_path
+EXPIRED_PATH_STATUSES = {400, 404}
+
+
+@dataclass
+class CachedFilePath:
+    """Результат getFile"""
+    file_path: str
+    file_size: Optional[int]
+    expires_at: float
+
+
+def create_bot_session() -> Optional[AiohttpSession]:
+    """
+    Сессия бота для собственного сервера Bot API
+
+    Returns:
+        AiohttpSession или None, если используется официальный сервер
+    """
+    settings = config.telegram_files
+    if not settings.api_server:
+        return None
+
+    options = {"is_local": settings.local_mode}
+    if settings.local_mode and settings.server_files_dir and settings.local_files_dir:
+        # Каталог сервера смонтирован у бота по другому пути
+        options["wrap_local_file"] = SimpleFilesPathWrapper(
+            settings.server_files_dir, settings.local_files_dir
+        )
+
+    return AiohttpSession(api=TelegramAPIServer.from_base(settings.api_server, **options))
+
+
+class TelegramFileDownloader:
+    """
+    Скачивание фото пользователей
+
+    - file_path по file_id кешируется на path_ttl: повторная обработка того
+      же фото (повтор задачи, пересылка) не делает лишний getFile
+    - тело читается потоком сразу в буфер размера file_size, без BytesIO
+      и копирования при чтении
+    - с сервером Bot API в режиме --local файл читается с диска через mmap
+    """
+
+    def __init__(self, settings: TelegramFilesConfig):
+        self.settings = settings
+        self._paths: "OrderedDict[str, CachedFilePath]" = OrderedDict()
+
+    async def resolve(self, bot: Bot, file_id: str) -> CachedFilePath:
+        """
+        Получить file_path и размер файла, используя кеш
+
+        Args:
+            bot: Экземпляр бота
+            file_id: file_id файла в Telegram
+
+        Returns:
+            CachedFilePath
+        """
+        cached = self._paths.get(file_id)
+        if cached is not None and cached.expires_at > time.monotonic():
+            self._paths.move_to_end(file_id)
+            file_path_cache_total.inc(result="hit")
+            return cached
+
+        file_path_cache_total.inc(result="miss")
+        with stage_timer.stage("get_file"):
+            file = await bot.get_file(file_id)
+        cached = CachedFilePath(
+            file_path=file.file_path,
+            file_size=file.file_size,
+            expires_at=time.monotonic() + self.settings.path_ttl,
+        )
+
+        self._paths[file_id] = cached
+        self._paths.move_to_end(file_id)
+        while len(self._paths) > self.settings.path_cache_size:
+            self._paths.popitem(last=False)
+
+        return cached
+
+    def invalidate(self, file_id: str):
+        """Забыть file_path (например, если Telegram его больше не отдаёт)"""
+        self._paths.pop(file_id, None)
+
+    async def download(self, bot: Bot, file_id: str) -> Union[bytes, bytearray]:
+        """
+        Скачать файл по file_id
+
+        Args:
+            bot: Экземпляр бота
+            file_id: file_id файла в Telegram
+
+        Returns:
+            Содержимое файла
+        """
+        started = time.monotonic()
+        source = "local" if bot.session.api.is_local else "http"
+
+        cached = await self.resolve(bot, file_id)
+        try:
+            with stage_timer.stage("download"):
+                data = await self._read(bot, cached)
+        except ClientResponseError as e:
+            if e.status not in EXPIRED_PATH_STATUSES:
+                raise
+            # file_path истёк раньше TTL - запрашиваем новый один раз
+            logger.info(f"file_path для {file_id} устарел ({e.status}), запрашиваем заново")
+            self.invalidate(file_id)
+            cached = await self.resolve(bot, file_id)
+            with stage_timer.stage("download"):
+                data = await self._read(bot, cached)
+
+        download_seconds.observe(time.monotonic() - started, source=source)
+        download_bytes.observe(len(data))
+        return data
+
+    async def _read(self, bot: Bot, cached: CachedFilePath) -> Union[bytes, bytearray]:
+        if bot.session.api.is_local:
+            path = bot.session.api.wrap_local_file.to_local(cached.file_path)
+            return await asyncio.to_thread(self._read_local, str(path))
+        return await self._read_http(bot, cached)
+
+    @staticmethod
+    def _read_local(path: str) -> bytes:
+        """Прочитать файл сервера Bot API через mmap"""
+        with open(path, "rb") as file:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return mapped[:]
+
+    async def _read_http(self, bot: Bot, cached: CachedFilePath) -> Union[bytes, bytearray]:
+        """Скачать файл потоком в заранее выделенный буфер"""
+        url = bot.session.api.file_url(bot.token, cached.file_path)
+        stream = bot.session.stream_content(
+            url=url,
+            timeout=self.settings.timeout,
+            chunk_size=self.settings.chunk_size,
+            raise_for_status=True,
+        )
+
+        buffer = bytearray(cached.file_size or 0)
+        view = memoryview(buffer)
+        offset = 0
+        try:
+            async for chunk in stream:
+                end = offset + len(chunk)
+                if end <= len(buffer):
+                    view[offset:end] = chunk
+                else:
+                    # Размер не был известен или оказался больше заявленного
+                    view.release()
+                    buffer[offset:] = chunk
+                    view = memoryview(buffer)
+                offset = end
+        finally:
+            view.release()
+
+        if offset == len(buffer):
+            return buffer
+        return bytes(memoryview(buffer)[:offset])
+
+
+# Глобальный экземпляр загрузчика
+telegram_file_downloader = TelegramFileDownloader(config.telegram_files)
@@ -93,12 +93,15 @@ async def handle_robokassa_result(request: web.Request) -> web.Response:
 
             # Зачисляем генерации (если еще не зачислены)
             if not payment.credited:
-                success = await user_repo.update_generations(
+                snapshot = await user_repo.update_generations(
                     payment.telegram_id,
-                    payment.generations
+                    payment.generations,
+                    lane="paid",
+                    entry_type="payment",
+                    source_id=str(payment.id)
                 )
 
-                if success:
+                if snapshot:
                     await payment_repo.mark_as_credited(payment.id)
                     logger.info(
                         f"Платеж {payment.id} успешно обработан: "
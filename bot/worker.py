@@ -0,0 +1,210 @@
+"""Пул воркеров, выполняющих задачи генерации из очереди"""
+import argparse
+import asyncio
+import os
+import socket
+import sys
+from typing import List, Optional
+
+from aiogram import Bot
+from aiogram.client.default import DefaultBotProperties
+from aiogram.enums import ParseMode
+
+from bot.config import config
+from bot.database import database, get_db_session
+from bot.logger import logger
+from bot.models.generation_job import LANES
+from bot.repositories.generation_job_repository import GenerationJobRepository
+from bot.services.generation import generation_service
+from bot.services.lane_scheduler import LaneScheduler
+from bot.services.metrics import loop_lag_monitor, metrics, metrics_server
+from bot.services.openrouter import openrouter_service
+from bot.services.telegram_files import create_bot_session
+
+queue_depth = metrics.gauge(
+    "generation_queue_depth", "Задачи генерации в очереди по классам приоритета"
+)
+
+# Как часто обновлять длину очереди в метриках, секунды
+QUEUE_DEPTH_INTERVAL = 5
+
+
+class GenerationWorkerPool:
+    """
+    Пул воркеров очереди generation_jobs
+
+    Задачи забираются через SELECT ... FOR UPDATE SKIP LOCKED, поэтому пулы
+    можно запускать в нескольких процессах одновременно
+    """
+
+    def __init__(self):
+        self.concurrency = config.workers.concurrency
+        self.poll_interval = config.workers.poll_interval
+        self.lease_seconds = config.workers.lease_seconds
+        self.host = socket.gethostname()
+        self.instance_id = f"{self.host}:{os.getpid()}"
+        self.scheduler = (
+            LaneScheduler(config.priority_lanes.weights)
+            if config.priority_lanes.enabled else None
+        )
+        self._tasks: List[asyncio.Task] = []
+        self._bot: Optional[Bot] = None
+
+    async def start(self, bot: Bot):
+        """Запустить воркеры"""
+        if self._tasks:
+            return
+
+        self._bot = bot
+        self._tasks = [
+            asyncio.create_task(self._worker_loop(f"{self.instance_id}/{number}"))
+            for number in range(self.concurrency)
+        ]
+        self._tasks.append(asyncio.create_task(self._requeue_stale_loop()))
+        self._tasks.append(asyncio.create_task(self._queue_depth_loop()))
+        self._tasks.append(
+            asyncio.create_task(self._delivery_loop(f"{self.instance_id}/delivery"))
+        )
+
+        logger.info(f"Запущен пул воркеров генерации: {self.concurrency} воркеров")
+
+    async def stop(self):
+        """Остановить воркеры, вернув незавершённые задачи в очередь"""
+        if not self._tasks:
+            return
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+        logger.info("Пул воркеров генерации остановлен")
+
+    async def _worker_loop(self, worker_id: str):
+        """Основной цикл воркера"""
+        while True:
+            try:
+                async with get_db_session() as session:
+                    job_repo = GenerationJobRepository(session)
+                    lane_order = self.scheduler.order() if self.scheduler else None
+                    job = await job_repo.claim_next(worker_id, self.lease_seconds, lane_order)
+
+                if job is None:
+                    await generation_service.wait_for_job(self.poll_interval)
+                    continue
+
+                if self.scheduler:
+                    self.scheduler.charge(job.lane)
+
+                await generation_service.run_job(self._bot, job)
+
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка в воркере {worker_id}: {e}", exc_info=True)
+                await asyncio.sleep(self.poll_interval)
+
+    async def _delivery_loop(self, worker_id: str):
+        """Повторно доставлять сохранённые результаты, отправка которых не удалась"""
+        while True:
+            try:
+                async with get_db_session() as session:
+                    # Результат лежит на диске хоста, который его сгенерировал
+                    job = await GenerationJobRepository(session).claim_delivery(
+                        worker_id,
+                        config.delivery.lease_seconds,
+                        host=None if config.delivery.shared_directory else self.host,
+                    )
+
+                if job is None:
+                    await asyncio.sleep(config.delivery.poll_interval)
+                    continue
+
+                await generation_service.retry_delivery(self._bot, job)
+
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка при повторной доставке результата: {e}", exc_info=True)
+                await asyncio.sleep(config.delivery.poll_interval)
+
+    async def _requeue_stale_loop(self):
+        """Периодически возвращать в очередь задачи упавших воркеров"""
+        while True:
+            try:
+                async with get_db_session() as session:
+                    await GenerationJobRepository(session).requeue_stale()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка при возврате зависших задач: {e}", exc_info=True)
+
+            await asyncio.sleep(60)
+
+    async def _queue_depth_loop(self):
+        """Периодически обновлять длину очереди по классам в метриках"""
+        while True:
+            try:
+                async with get_db_session() as session:
+                    depths = await GenerationJobRepository(session).get_queue_depths()
+                for lane in LANES:
+                    queue_depth.set(depths.get(lane, 0), lane=lane)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка при подсчёте длины очереди: {e}")
+
+            await asyncio.sleep(QUEUE_DEPTH_INTERVAL)
+
+
+# Глобальный пул воркеров
+generation_worker_pool = GenerationWorkerPool()
+
+
+async def main(metrics_port: int):
+    """
+    Запуск воркеров отдельным процессом: python -m bot.worker
+
+    Args:
+        metrics_port: Порт метрик (у бота свой порт metrics.port)
+    """
+    bot = Bot(
+        token=config.bot_token,
+        session=create_bot_session(),
+        default=DefaultBotProperties(parse_mode=ParseMode.HTML)
+    )
+
+    await openrouter_service.start()
+    if config.metrics.enabled:
+        await metrics_server.start(config.metrics.host, metrics_port)
+        loop_lag_monitor.start(config.metrics.loop_lag_interval)
+    await generation_worker_pool.start(bot)
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await generation_worker_pool.stop()
+        await openrouter_service.close()
+        await loop_lag_monitor.stop()
+        await metrics_server.stop()
+        await database.close()
+        await bot.session.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Воркеры очереди генераций")
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=config.metrics.worker_port,
+        help="Порт метрик (по умолчанию metrics.worker_port)",
+    )
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(main(args.metrics_port))
+    except KeyboardInterrupt:
+        logger.info("Воркеры остановлены пользователем (Ctrl+C)")
+    except Exception as e:
+        logger.error(f"Неожиданная ошибка: {e}", exc_info=True)
+        sys.exit(1)
@@ -0,0 +1,56 @@
+"""create generation_jobs table
+
+Revision ID: 008
+Revises: 007
+Create Date: 2026-10-17
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision: str = '008'
+down_revision: Union[str, None] = '007'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Создание таблицы очереди задач генерации
+    op.create_table(
+        'generation_jobs',
+        sa.Column('id', postgresql.UUID(as_uuid=True), primary_key=True),
+        sa.Column('telegram_id', sa.BigInteger(), nullable=False, comment='Telegram ID пользователя'),
+        sa.Column('chat_id', sa.BigInteger(), nullable=False, comment='Чат для доставки результата'),
+        sa.Column('file_id', sa.String(255), nullable=False, comment='file_id исходной фотографии'),
+        sa.Column('file_unique_id', sa.String(64), nullable=False, comment='file_unique_id исходной фотографии'),
+        sa.Column('status', sa.String(20), nullable=False, server_default='queued', comment='Статус задачи: queued, processing, done, failed'),
+        sa.Column('attempts', sa.Integer(), nullable=False, server_default='0', comment='Количество взятий в работу'),
+        sa.Column('balance_after', sa.Integer(), nullable=True, comment='Баланс пользователя после списания'),
+        sa.Column('processing_message_id', sa.BigInteger(), nullable=True, comment="ID сообщения 'Начинаем волшебство'"),
+        sa.Column('worker_id', sa.String(100), nullable=True, comment='Воркер, обрабатывающий задачу'),
+        sa.Column('locked_until', sa.TIMESTAMP(), nullable=True, comment='Срок аренды задачи воркером'),
+        sa.Column('error', sa.Text(), nullable=True, comment='Причина ошибки'),
+        sa.Column('timings', postgresql.JSONB(), nullable=True, comment='Длительность этапов обработки в секундах'),
+        sa.Column('created_at', sa.TIMESTAMP(), nullable=False, server_default=sa.text('CURRENT_TIMESTAMP')),
+        sa.Column('started_at', sa.TIMESTAMP(), nullable=True),
+        sa.Column('finished_at', sa.TIMESTAMP(), nullable=True),
+    )
+
+    # Индекс для поиска задач пользователя
+    op.create_index('ix_generation_jobs_telegram_id', 'generation_jobs', ['telegram_id'])
+
+    # Индекс для выборки следующей задачи из очереди
+    op.create_index('ix_generation_jobs_status_created_at', 'generation_jobs', ['status', 'created_at'])
+
+
+def downgrade() -> None:
+    # Удаление индексов
+    op.drop_index('ix_generation_jobs_status_created_at', table_name='generation_jobs')
+    op.drop_index('ix_generation_jobs_telegram_id', table_name='generation_jobs')
+
+    # Удаление таблицы
+    op.drop_table('generation_jobs')
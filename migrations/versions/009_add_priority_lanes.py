@@ -0,0 +1,76 @@
+"""add priority lanes
+
+Revision ID: 009
+Revises: 008
+Create Date: 2026-10-17
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = '009'
+down_revision: Union[str, None] = '008'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Части баланса по источнику: купленные и промо/реферальные генерации
+    op.add_column('users', sa.Column('paid_generation', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('users', sa.Column('promo_generation', sa.Integer(), nullable=False, server_default='0'))
+
+    # Оценка для существующих балансов: сначала купленные, затем промо и бонусы
+    op.execute("""
+        UPDATE users u
+        SET paid_generation = LEAST(u.available_generation, p.total)
+        FROM (
+            SELECT telegram_id, SUM(generations) AS total
+            FROM payments
+            WHERE credited
+            GROUP BY telegram_id
+        ) p
+        WHERE p.telegram_id = u.telegram_id
+    """)
+    op.execute("""
+        UPDATE users u
+        SET promo_generation = LEAST(
+            u.available_generation - u.paid_generation,
+            u.referral_generation + COALESCE((
+                SELECT SUM(pc.generation)
+                FROM promo_code_usages pcu
+                JOIN promo_codes pc ON pc.id = pcu.promo_code_id
+                WHERE pcu.user_id = u.id
+            ), 0)
+        )
+    """)
+
+    op.create_check_constraint(
+        'check_lane_generation_not_negative',
+        'users',
+        'paid_generation >= 0 AND promo_generation >= 0'
+    )
+
+    # Класс приоритета задачи
+    op.add_column(
+        'generation_jobs',
+        sa.Column('lane', sa.String(10), nullable=False, server_default='free', comment='Класс приоритета: paid, promo, free')
+    )
+
+    # Индекс для выборки задач с учётом класса и подсчёта очереди по классам
+    op.create_index(
+        'ix_generation_jobs_status_lane_created_at',
+        'generation_jobs',
+        ['status', 'lane', 'created_at']
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_generation_jobs_status_lane_created_at', table_name='generation_jobs')
+    op.drop_column('generation_jobs', 'lane')
+
+    op.drop_constraint('check_lane_generation_not_negative', 'users', type_='check')
+    op.drop_column('users', 'promo_generation')
+    op.drop_column('users', 'paid_generation')
@@ -0,0 +1,59 @@
+"""add result delivery
+
+Revision ID: 010
+Revises: 009
+Create Date: 2026-10-17
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = '010'
+down_revision: Union[str, None] = '009'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Повторная доставка сохранённого результата без новой генерации
+    op.add_column(
+        'generation_jobs',
+        sa.Column('delivery_attempts', sa.Integer(), nullable=False, server_default='0', comment='Количество попыток доставки результата')
+    )
+    op.add_column(
+        'generation_jobs',
+        sa.Column('next_delivery_at', sa.TIMESTAMP(), nullable=True, comment='Время следующей попытки доставки')
+    )
+    op.add_column(
+        'generation_jobs',
+        sa.Column('result_file_id', sa.String(255), nullable=True, comment='Telegram file_id результата из кеша')
+    )
+    op.alter_column(
+        'generation_jobs',
+        'status',
+        existing_type=sa.String(20),
+        comment='Статус задачи: queued, processing, delivering, done, failed'
+    )
+
+    # Индекс для выборки результатов, ожидающих повторной доставки
+    op.create_index(
+        'ix_generation_jobs_status_next_delivery_at',
+        'generation_jobs',
+        ['status', 'next_delivery_at']
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_generation_jobs_status_next_delivery_at', table_name='generation_jobs')
+    op.alter_column(
+        'generation_jobs',
+        'status',
+        existing_type=sa.String(20),
+        comment='Статус задачи: queued, processing, done, failed'
+    )
+    op.drop_column('generation_jobs', 'result_file_id')
+    op.drop_column('generation_jobs', 'next_delivery_at')
+    op.drop_column('generation_jobs', 'delivery_attempts')
@@ -0,0 +1,93 @@
+"""create generation_ledger table
+
+Revision ID: 011
+Revises: 010
+Create Date: 2026-10-17
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = '011'
+down_revision: Union[str, None] = '010'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Журнал движений генераций: счётчики users становятся его проекцией
+    op.create_table(
+        'generation_ledger',
+        sa.Column('id', sa.BigInteger(), sa.Identity(), primary_key=True),
+        sa.Column('telegram_id', sa.BigInteger(), nullable=False, comment='Telegram ID пользователя'),
+        sa.Column('entry_type', sa.String(20), nullable=False, comment='Вид записи: opening, initial, spend, refund, payment, referral, promo, adjustment'),
+        sa.Column('delta', sa.Integer(), nullable=False, comment='Изменение баланса'),
+        sa.Column('lane', sa.String(10), nullable=False, server_default='free', comment='Класс генераций: paid, promo, free'),
+        sa.Column('source_id', sa.String(64), nullable=True, comment='Источник: платёж, задача, приглашённый, промокод'),
+        sa.Column('created_at', sa.TIMESTAMP(), nullable=False, server_default=sa.text('CURRENT_TIMESTAMP')),
+        sa.Column('applied_at', sa.TIMESTAMP(), nullable=True, comment='Когда запись перенесена в счётчики users'),
+    )
+
+    op.create_index('ix_generation_ledger_telegram_id', 'generation_ledger', ['telegram_id'])
+
+    # Повтор начисления с тем же источником не создаёт второй записи
+    op.create_index(
+        'ux_generation_ledger_source',
+        'generation_ledger',
+        ['telegram_id', 'entry_type', 'source_id'],
+        unique=True,
+        postgresql_where=sa.text('source_id IS NOT NULL')
+    )
+
+    # Записи, ещё не перенесённые в счётчики users
+    op.create_index(
+        'ix_generation_ledger_pending',
+        'generation_ledger',
+        ['telegram_id'],
+        postgresql_where=sa.text('applied_at IS NULL')
+    )
+
+    # Остатки существующих пользователей: журнал сходится со счётчиками.
+    # Реферальные бонусы - отдельной записью, чтобы сходился referral_generation
+    op.execute("""
+        INSERT INTO generation_ledger (telegram_id, entry_type, delta, lane, source_id, applied_at)
+        SELECT telegram_id, entry_type, delta, lane, 'opening:' || lane, CURRENT_TIMESTAMP
+        FROM users
+        CROSS JOIN LATERAL (VALUES
+            ('opening', available_generation - paid_generation - promo_generation, 'free'),
+            ('opening', paid_generation, 'paid'),
+            ('opening', promo_generation - referral_generation, 'promo'),
+            ('referral', referral_generation, 'promo')
+        ) AS opening (entry_type, delta, lane)
+        WHERE delta <> 0
+    """)
+
+
+def downgrade() -> None:
+    # Перенос ещё не применённых записей, чтобы не потерять начисления
+    op.execute("""
+        UPDATE users u
+        SET available_generation = u.available_generation + p.total,
+            paid_generation = u.paid_generation + p.paid,
+            promo_generation = u.promo_generation + p.promo,
+            referral_generation = u.referral_generation + p.referral
+        FROM (
+            SELECT telegram_id,
+                   SUM(delta) AS total,
+                   COALESCE(SUM(delta) FILTER (WHERE lane = 'paid'), 0) AS paid,
+                   COALESCE(SUM(delta) FILTER (WHERE lane = 'promo'), 0) AS promo,
+                   COALESCE(SUM(delta) FILTER (WHERE entry_type = 'referral'), 0) AS referral
+            FROM generation_ledger
+            WHERE applied_at IS NULL
+            GROUP BY telegram_id
+        ) p
+        WHERE p.telegram_id = u.telegram_id
+    """)
+
+    op.drop_index('ix_generation_ledger_pending', table_name='generation_ledger')
+    op.drop_index('ux_generation_ledger_source', table_name='generation_ledger')
+    op.drop_index('ix_generation_ledger_telegram_id', table_name='generation_ledger')
+    op.drop_table('generation_ledger')
@@ -0,0 +1,31 @@
+"""create circuit_breakers table
+
+Revision ID: 012
+Revises: 011
+Create Date: 2026-10-17
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = '012'
+down_revision: Union[str, None] = '011'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Состояние автомата защиты OpenRouter, общее для бота и отдельных воркеров
+    op.create_table(
+        'circuit_breakers',
+        sa.Column('name', sa.String(50), primary_key=True, comment='Имя автомата'),
+        sa.Column('open_until', sa.TIMESTAMP(), nullable=True, comment='До какого времени цепь разомкнута'),
+        sa.Column('updated_at', sa.TIMESTAMP(), nullable=False, server_default=sa.text('CURRENT_TIMESTAMP')),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('circuit_breakers')